@@ -1,9 +1,12 @@
+import asyncio
+import ipaddress
 import socket
 import json
 import subprocess
-import threading
 import time
-from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from sengled_udp_transport import RateLimiter, get_transport
+from sengled_discovery import local_subnets
 
 def ping_test(ip):
     """Test if IP responds to ping"""
@@ -89,67 +92,111 @@ def test_sengled_commands(ip):
     
     return False, None, None, None
 
-def scan_network_for_bulbs():
+SCAN_PORTS = [9080, 8080, 80, 8899, 38899]  # Common IoT ports
+SCAN_COMMANDS = [
+    {"func": "get_device_info", "param": {}},
+    {"func": "get_device_status", "param": {}},
+    {"cmd": "get_info"},
+    {"command": "status"},
+    "status",  # Simple string
+]
+
+# Larger networks (shorter prefixes) are not scanned: a /8 is 16M hosts
+MIN_SCAN_PREFIX = 16
+
+async def probe_host(transport, ip, ports=SCAN_PORTS, commands=SCAN_COMMANDS, timeout=2, limiter=None):
+    """Probe every port at once, the command variations on each port one after another; first reply wins"""
+    
+    async def probe_port(port):
+        # One at a time per port: a reply does not say which command it answers
+        for command in commands:
+            message = command.encode('utf-8') if isinstance(command, str) else json.dumps(command).encode('utf-8')
+            if limiter is not None:
+                await limiter.wait()
+            started = time.perf_counter()
+            try:
+                # Most probes go to empty addresses or unknown commands: sent once, nothing recorded
+                response = await transport.request(ip, message, port=port, timeout=timeout, probe=True)
+            except OSError:
+                continue
+            return {
+                'ip': ip,
+                'port': port,
+                'command': command,
+                'response': response.decode('utf-8', errors='replace'),
+                'rtt_ms': round((time.perf_counter() - started) * 1000, 1)
+            }
+        return None
+    
+    tasks = [asyncio.ensure_future(probe_port(port)) for port in ports]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            result = await next_done
+            if result:
+                return result
+    finally:
+        for task in tasks:
+            task.cancel()
+    return None
+
+async def scan_hosts(transport, hosts, concurrency=256, rate=500, timeout=2, on_hit=None):
+    """Probe hosts concurrently and hand each hit to on_hit as soon as it resolves.
+    
+    hosts may be a lazy iterable; rate caps the datagrams sent per second.
+    """
+    limiter = RateLimiter(rate)
+    hosts = iter(hosts)
+    found_devices = []
+    
+    async def worker():
+        # Workers share one iterator, so only `concurrency` hosts exist at a time
+        for ip in hosts:
+            result = await probe_host(transport, ip, timeout=timeout, limiter=limiter)
+            if result:
+                found_devices.append(result)
+                if on_hit:
+                    on_hit(result)
+    
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return found_devices
+
+def scan_network_for_bulbs(cidrs=None, concurrency=256, rate=500, timeout=2,
+                           output_path="sengled_scan.jsonl"):
     """Scan entire local network for potential Sengled bulbs"""
     print("Scanning local network for Sengled bulbs...")
-    print("This will take 2-3 minutes...\n")
     
     # Try to detect network range
-    try:
-        result = subprocess.run(['ip', 'route', 'show', 'default'], 
-                              capture_output=True, text=True)
-        if '192.168.1.' in result.stdout:
-            base_ip = "192.168.1."
-        elif '192.168.0.' in result.stdout:
-            base_ip = "192.168.0."
-        else:
-            base_ip = "192.168.1."  # Default guess
-    except:
-        base_ip = "192.168.1."
+    if cidrs is None:
+        cidrs, own = local_subnets()
+    else:
+        own = set()
+    if not cidrs:
+        cidrs = ["192.168.1.0/24"]  # Default guess
     
-    print(f"Scanning network range: {base_ip}x")
+    networks = []
+    for cidr in cidrs:
+        network = ipaddress.ip_network(cidr, strict=False)
+        if network.prefixlen < MIN_SCAN_PREFIX:
+            print(f"⚠️  Skipping {cidr}: larger than /{MIN_SCAN_PREFIX}, scan a smaller range explicitly")
+            continue
+        networks.append(network)
     
-    def test_ip_comprehensive(ip):
-        """Comprehensive test for Sengled bulb"""
-        # First, ping test
-        if not ping_test(ip):
-            return None
-        
-        print(f"📍 {ip} responds to ping, testing for Sengled...")
-        
-        # Test common IoT ports with UDP
-        ports = [9080, 8080, 80, 8899, 38899]
-        for port in ports:
-            udp_result, udp_msg = test_udp_port(ip, port)
-            if udp_result:
-                print(f"  🔍 UDP port {port} responds: {udp_msg}")
-                
-                # Try Sengled commands
-                success, working_port, working_cmd, response = test_sengled_commands(ip)
-                if success:
-                    return {
-                        'ip': ip, 
-                        'port': working_port, 
-                        'command': working_cmd, 
-                        'response': response
-                    }
-        
-        return None
+    hosts = (str(host) for network in networks for host in network.hosts() if str(host) not in own)
+    total = sum(max(network.num_addresses - 2, 1) for network in networks)
+    print(f"Scanning network range: {', '.join(str(network) for network in networks)} ({total} hosts)")
+    print(f"Streaming hits to {output_path}\n")
     
-    # Scan in parallel
-    with ThreadPoolExecutor(max_workers=20) as executor:
-        futures = []
-        for i in range(2, 255):
-            ip = f"{base_ip}{i}"
-            futures.append(executor.submit(test_ip_comprehensive, ip))
+    started = time.monotonic()
+    with open(output_path, 'a') as output:
+        def on_hit(result):
+            print(f"\n🎉 FOUND SENGLED BULB: {result}")
+            output.write(json.dumps(dict(result, found_at=datetime.now(timezone.utc).isoformat())) + "\n")
+            output.flush()
         
-        found_devices = []
-        for future in futures:
-            result = future.result()
-            if result:
-                found_devices.append(result)
-                print(f"\n🎉 FOUND SENGLED BULB: {result}")
+        transport = get_transport()
+        found_devices = transport.run(scan_hosts(transport, hosts, concurrency, rate, timeout, on_hit))
     
+    print(f"\nScan finished in {time.monotonic() - started:.1f}s")
     return found_devices
 
 def debug_specific_ip(ip):
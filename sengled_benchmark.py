@@ -0,0 +1,634 @@
+#!/usr/bin/env python3
+"""
+Sengled Benchmarks
+==================
+Reproducible local load tests for the rescue stack.
+
+    # Reconnect storm: N bulbs call accessCloud.json + bimqtt within a window
+    python3 sengled_benchmark.py storm --serve rescue --server waitress --bulbs 2000
+
+    # Or point it at an already running server
+    python3 sengled_benchmark.py storm --host 127.0.0.1 --port 80
+
+    # Per-request CPU cost of jsonify vs the precompiled response templates
+    python3 sengled_benchmark.py encode
+
+    # Steady load on every rescue endpoint
+    python3 sengled_benchmark.py http --serve rescue
+
+    # Control stack against virtual bulbs (sengled_bulb_simulator) on loopback
+    python3 sengled_benchmark.py discovery --bulbs 1000
+    python3 sengled_benchmark.py command --bulbs 50 --mongodb mongodb://localhost:27017
+    python3 sengled_benchmark.py scene --bulbs 50 --latency 5 --jitter 10 --loss 0.01
+
+Each run reports requests per second and p50/p95/p99 latency (or CPU time
+per call for microbenchmarks). Use --seed to replay the same arrival
+pattern and --json to keep results for comparison between runs;
+--baseline compares against such a file and exits non-zero when p99,
+throughput or CPU time regressed by more than --tolerance percent.
+
+command and scene drive a real SengledMongoDBSystem, so they need a
+MongoDB server; they use a throwaway database that is dropped afterwards.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+
+from sengled_bulb_simulator import BulbSimulator, http_request
+from sengled_command_queue import DEFAULT_RATE
+
+SERVER_SCRIPTS = {
+    "rescue": "sengled_cloud_rescue.py",
+    "emulator": "sengled_cloud_emulator.py",
+}
+
+
+# ----------------------------------------------------------------------
+# Reporting
+# ----------------------------------------------------------------------
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+def summarize(name, latencies, errors, elapsed):
+    """Throughput and latency summary for one scenario"""
+    ordered = sorted(latencies)
+    total = len(ordered) + errors
+    return {
+        "scenario": name,
+        "requests": total,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "rps": round(len(ordered) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(ordered, 50) * 1000, 2),
+        "p95_ms": round(percentile(ordered, 95) * 1000, 2),
+        "p99_ms": round(percentile(ordered, 99) * 1000, 2),
+        "max_ms": round(ordered[-1] * 1000, 2) if ordered else 0.0,
+    }
+
+
+def print_summary(summary):
+    print(f"\n📊 {summary['scenario']}")
+    print(f"   requests: {summary['requests']}  errors: {summary['errors']}  "
+          f"elapsed: {summary['elapsed_s']}s")
+    print(f"   throughput: {summary['rps']} req/s")
+    print(f"   latency: p50 {summary['p50_ms']}ms  p95 {summary['p95_ms']}ms  "
+          f"p99 {summary['p99_ms']}ms  max {summary['max_ms']}ms")
+
+
+# ----------------------------------------------------------------------
+# Reconnect storm
+# ----------------------------------------------------------------------
+
+async def run_storm(host, port, bulbs, window, seed, concurrency, timeout):
+    rng = random.Random(seed)
+    arrivals = sorted(rng.uniform(0, window) for _ in range(bulbs))
+    macs = [":".join(f"{rng.randrange(256):02X}" for _ in range(6)) for _ in range(bulbs)]
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], [0]
+
+    async def timed(method, path, body):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                status, _ = await http_request(host, port, method, path, body, timeout)
+                if status != 200:
+                    raise RuntimeError(f"HTTP {status}")
+                latencies.append(time.perf_counter() - started)
+            except Exception:
+                errors[0] += 1
+
+    async def bulb(arrival, mac):
+        await asyncio.sleep(arrival)
+        await timed("POST", "/life2/device/accessCloud.json", {
+            "deviceUuid": mac,
+            "userId": "618",
+            "productCode": "wifielement",
+            "typeCode": "W31-N11",
+        })
+        await timed("POST", "/jbalancer/new/bimqtt", {"deviceUuid": mac})
+
+    started = time.perf_counter()
+    await asyncio.gather(*(bulb(arrival, mac) for arrival, mac in zip(arrivals, macs)))
+    return latencies, errors[0], time.perf_counter() - started
+
+
+# ----------------------------------------------------------------------
+# Server under test
+# ----------------------------------------------------------------------
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(target, server, port, threads=None):
+    """Launch the rescue server or emulator in a subprocess and wait for it"""
+    env = dict(os.environ,
+               SENGLED_HTTP_PORT=str(port),
+               SENGLED_HTTP_SERVER=server,
+               SENGLED_LOG_PAYLOADS="0",
+               SENGLED_LOG_LEVEL="WARNING")
+    if threads:
+        env["SENGLED_HTTP_THREADS"] = str(threads)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), SERVER_SCRIPTS[target])
+    process = subprocess.Popen([sys.executable, script], env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{target} server exited with code {process.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"{target} server did not start on port {port}")
+
+
+def cmd_storm(args):
+    process = None
+    host, port = args.host, args.port
+    if args.serve:
+        host, port = "127.0.0.1", free_port()
+        process = start_server(args.serve, args.server, port, args.threads)
+        print(f"🔧 Started {args.serve} server ({args.server}) on port {port}")
+
+    try:
+        print(f"⚡ Reconnect storm: {args.bulbs} bulbs over {args.window}s (seed {args.seed})")
+        latencies, errors, elapsed = asyncio.run(run_storm(
+            host, port, args.bulbs, args.window, args.seed, args.concurrency, args.timeout))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    name = f"storm {args.serve or f'{host}:{port}'}" + (f" [{args.server}]" if args.serve else "")
+    summary = summarize(name, latencies, errors, elapsed)
+    print_summary(summary)
+    return [summary]
+
+
+# ----------------------------------------------------------------------
+# Response encoding microbenchmark
+# ----------------------------------------------------------------------
+
+def cpu_per_call(func, iterations):
+    """CPU microseconds per call, best of three runs"""
+    timer = timeit.Timer(func, timer=time.process_time)
+    return min(timer.repeat(repeat=3, number=iterations)) / iterations * 1e6
+
+
+def encode_cases(jsonify):
+    """(endpoint, legacy handler body, template handler body) pairs"""
+    import sengled_cloud_rescue as rescue
+    import sengled_cloud_emulator as emulator
+
+    ip = "192.168.1.79"
+    data = {"deviceUuid": "E8:DB:84:F9:BE:B4", "userId": "618",
+            "productCode": "wifielement", "typeCode": "W31-N11"}
+
+    def legacy_access_cloud():
+        return jsonify({
+            "info": "OK",
+            "jsessionId": f"rescue_{int(time.time())}",
+            "deviceUuid": data.get('deviceUuid', 'unknown'),
+            "userId": data.get('userId', '618'),
+            "productCode": data.get('productCode', 'wifielement'),
+            "typeCode": data.get('typeCode', 'W31-N11'),
+            "status": "active",
+            "timestamp": int(time.time() * 1000),
+            "serverTime": int(time.time() * 1000),
+            "result": True,
+            "code": 0,
+            "message": "Device registered successfully"
+        })
+
+    def fast_access_cloud():
+        now = time.time()
+        now_ms = int(now * 1000)
+        return rescue.ACCESS_CLOUD_RESPONSE.response(
+            jsessionId=f"rescue_{int(now)}",
+            deviceUuid=data.get('deviceUuid', 'unknown'),
+            userId=data.get('userId', '618'),
+            productCode=data.get('productCode', 'wifielement'),
+            typeCode=data.get('typeCode', 'W31-N11'),
+            timestamp=now_ms,
+            serverTime=now_ms
+        )
+
+    def legacy_mqtt_balancer():
+        return jsonify({
+            "info": "OK",
+            "inceptionAddr": f"ws://{ip}:9001/mqtt",
+            "mqttServer": {"host": ip, "port": 1883, "wsPort": 9001, "path": "/mqtt"}
+        })
+
+    def fast_mqtt_balancer():
+        return rescue.MQTT_BALANCER_RESPONSE.response(inceptionAddr=f"ws://{ip}:9001/mqtt", host=ip)
+
+    def legacy_server_info():
+        return jsonify({
+            "info": "OK",
+            "inceptionAddr": f"ws://{ip}:9001/mqtt",
+            "serverTime": int(time.time() * 1000)
+        })
+
+    def fast_server_info():
+        return rescue.SERVER_INFO_RESPONSE.response(
+            inceptionAddr=f"ws://{ip}:9001/mqtt", serverTime=int(time.time() * 1000))
+
+    def legacy_session_timeout():
+        return jsonify({"info": "OK", "timeout": False})
+
+    def fast_session_timeout():
+        return rescue.SESSION_TIMEOUT_RESPONSE.response()
+
+    def legacy_registration():
+        now_ms = int(time.time() * 1000)
+        return jsonify({
+            "info": "OK", "jsessionId": "0123456789abcdef01234567",
+            "deviceUuid": data["deviceUuid"], "userId": data["userId"],
+            "productCode": data["productCode"], "typeCode": data["typeCode"],
+            "status": "online", "timestamp": now_ms, "serverTime": now_ms
+        })
+
+    def fast_registration():
+        now_ms = int(time.time() * 1000)
+        return emulator.REGISTRATION_RESPONSE.response(
+            jsessionId="0123456789abcdef01234567",
+            deviceUuid=data["deviceUuid"], userId=data["userId"],
+            productCode=data["productCode"], typeCode=data["typeCode"],
+            timestamp=now_ms, serverTime=now_ms
+        )
+
+    return [
+        ("rescue accessCloud", legacy_access_cloud, fast_access_cloud),
+        ("rescue bimqtt", legacy_mqtt_balancer, fast_mqtt_balancer),
+        ("rescue getServerInfo", legacy_server_info, fast_server_info),
+        ("rescue isSessionTimeout", legacy_session_timeout, fast_session_timeout),
+        ("emulator accessCloud", legacy_registration, fast_registration),
+    ]
+
+
+def cmd_encode(args):
+    from flask import Flask, jsonify
+    from sengled_http import orjson
+
+    print(f"🧮 Response encoding, {args.iterations} calls per case "
+          f"(codec: {'orjson' if orjson else 'json'})\n")
+    print(f"   {'endpoint':<26}{'jsonify':>12}{'template':>12}{'saving':>9}")
+
+    summaries = []
+    with Flask("sengled-benchmark").app_context():
+        for name, legacy, fast in encode_cases(jsonify):
+            legacy_us = cpu_per_call(legacy, args.iterations)
+            fast_us = cpu_per_call(fast, args.iterations)
+            saving = (1 - fast_us / legacy_us) * 100 if legacy_us else 0.0
+            print(f"   {name:<26}{legacy_us:>10.2f}us{fast_us:>10.2f}us{saving:>8.1f}%")
+            summaries.append({
+                "scenario": f"encode {name}",
+                "jsonify_us": round(legacy_us, 3),
+                "template_us": round(fast_us, 3),
+                "saving_pct": round(saving, 1),
+            })
+    return summaries
+
+
+# ----------------------------------------------------------------------
+# Rescue HTTP endpoints
+# ----------------------------------------------------------------------
+
+HTTP_ENDPOINTS = [
+    ("accessCloud", "POST", "/life2/device/accessCloud.json",
+     {"deviceUuid": "B0:CE:18:77:FF:FF", "userId": "618", "productCode": "wifielement", "typeCode": "W31-N11"}),
+    ("bimqtt", "POST", "/jbalancer/new/bimqtt", {"deviceUuid": "B0:CE:18:77:FF:FF"}),
+    ("getServerInfo", "POST", "/life2/server/getServerInfo.json", {}),
+    ("AuthenCross", "POST", "/user/app/customer/v2/AuthenCross.json", {"user": "618"}),
+    ("isSessionTimeout", "POST", "/user/app/customer/isSessionTimeout.json", {}),
+    ("list.json", "POST", "/life2/device/list.json", {}),
+    ("api/status", "GET", "/api/status", None),
+    ("api/bulbs", "GET", "/api/bulbs", None),
+]
+
+
+async def run_closed_loop(host, port, method, path, body, requests, concurrency, timeout):
+    """requests calls split over concurrency back-to-back clients"""
+    latencies, errors = [], [0]
+    remaining = [requests]
+
+    async def client():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            started = time.perf_counter()
+            try:
+                status, _ = await http_request(host, port, method, path, body, timeout)
+                if status != 200:
+                    raise RuntimeError(f"HTTP {status}")
+                latencies.append(time.perf_counter() - started)
+            except Exception:
+                errors[0] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(min(concurrency, requests))))
+    return latencies, errors[0], time.perf_counter() - started
+
+
+def cmd_http(args):
+    process = None
+    host, port = args.host, args.port
+    if args.serve:
+        host, port = "127.0.0.1", free_port()
+        process = start_server(args.serve, args.server, port, args.threads)
+        print(f"🔧 Started {args.serve} server ({args.server}) on port {port}")
+
+    endpoints = [endpoint for endpoint in HTTP_ENDPOINTS
+                 if not args.endpoints or endpoint[0] in args.endpoints]
+    summaries = []
+    try:
+        for name, method, path, body in endpoints:
+            latencies, errors, elapsed = asyncio.run(run_closed_loop(
+                host, port, method, path, body, args.requests, args.concurrency, args.timeout))
+            summary = summarize(f"http {name}", latencies, errors, elapsed)
+            print_summary(summary)
+            summaries.append(summary)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    return summaries
+
+
+# ----------------------------------------------------------------------
+# Control stack against virtual bulbs
+# ----------------------------------------------------------------------
+
+def start_simulator(args):
+    simulator = BulbSimulator(args.bulbs, latency=args.latency / 1000, jitter=args.jitter / 1000,
+                              loss=args.loss, seed=args.seed).start()
+    print(f"💡 {args.bulbs} virtual bulbs (latency {args.latency}ms, jitter {args.jitter}ms, "
+          f"loss {args.loss * 100:.1f}%)")
+    return simulator
+
+
+def start_system(args, simulator):
+    """A SengledMongoDBSystem on a throwaway database, wired to the virtual bulbs"""
+    # Keep the benchmark's registry in memory and out of the working directory
+    os.environ.setdefault("SENGLED_REGISTRY_PATH", "")
+    from sengled_mongodb_system import SengledMongoDBSystem
+
+    database = f"sengled_benchmark_{os.getpid()}"
+    index_path = os.path.join(tempfile.mkdtemp(prefix="sengled-benchmark-"), "index.json")
+    system = SengledMongoDBSystem(args.mongodb, database_name=database, discovery_subnets=simulator.subnets,
+                                  index_path=index_path, command_rate=args.rate, run_scheduler=False,
+                                  telemetry_interval=0, journal=False)
+    for device_uuid, ip in simulator.addresses().items():
+        system.active_bulbs[device_uuid] = {"ip": ip, "last_command": None, "last_response": None}
+        system.scene_cache.invalidate_device(device_uuid)
+    return system, database
+
+
+def stop_system(system, database):
+    system.writer.flush(10)
+    system.client.drop_database(database)
+    system.close()
+
+
+def is_error(result):
+    if not isinstance(result, dict):
+        return True
+    inner = result.get("result")
+    return "error" in result or (isinstance(inner, dict) and inner.get("ret", 0) != 0)
+
+
+def cmd_discovery(args):
+    from sengled_discovery import sweep
+    from sengled_udp_transport import get_transport
+
+    simulator = start_simulator(args)
+    transport = get_transport()
+    latencies, missing = [], 0
+    started = time.perf_counter()
+    try:
+        for _ in range(args.runs):
+            found = transport.run(sweep(transport, simulator.subnets, timeout=args.timeout))
+            latencies.extend(bulb.rtt for bulb in found.values())
+            missing += args.bulbs - len(found)
+    finally:
+        simulator.close()
+
+    # Per-bulb reply times within a sweep; errors are bulbs a sweep missed
+    summary = summarize(f"discovery {args.bulbs} bulbs", latencies, missing, time.perf_counter() - started)
+    print_summary(summary)
+    return [summary]
+
+
+def cmd_command(args):
+    simulator = start_simulator(args)
+    system, database = start_system(args, simulator)
+    uuids = list(simulator.addresses())
+    rng = random.Random(args.seed)
+    commands = [(uuids[i % len(uuids)], rng.choice((
+        {"func": "set_device_switch", "param": {"switch": rng.randrange(2)}},
+        {"func": "set_device_brightness", "param": {"brightness": rng.randrange(1, 101)}},
+        {"func": "set_device_color_temp", "param": {"color_temp": rng.randrange(101)}},
+    ))) for i in range(args.requests)]
+    latencies, errors = [], [0]
+
+    def one(target):
+        device_uuid, command = target
+        started = time.perf_counter()
+        result = system.send_command_to_bulb(device_uuid, command)
+        if is_error(result):
+            errors[0] += 1
+        else:
+            latencies.append(time.perf_counter() - started)
+
+    print(f"🎛️  send_command_to_bulb: {args.requests} commands, {args.concurrency} callers")
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            list(pool.map(one, commands))
+        elapsed = time.perf_counter() - started
+    finally:
+        stop_system(system, database)
+        simulator.close()
+
+    summary = summarize(f"command {args.bulbs} bulbs", latencies, errors[0], elapsed)
+    print_summary(summary)
+    return [summary]
+
+
+def cmd_scene(args):
+    simulator = start_simulator(args)
+    system, database = start_system(args, simulator)
+    actions = [{"device_uuid": device_uuid, "command": {"func": "set_device_switch", "param": {"switch": 1}}}
+               for device_uuid in simulator.addresses()]
+    system.create_scene("benchmark", actions)
+    # First run compiles the scene
+    system.execute_scene("benchmark")
+
+    print(f"🎬 execute_scene: {args.runs} runs of a {len(actions)}-bulb scene")
+    latencies, errors = [], 0
+    started = time.perf_counter()
+    try:
+        for _ in range(args.runs):
+            run_started = time.perf_counter()
+            results = system.execute_scene("benchmark")
+            if any(is_error(result) for result in results.values()):
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - run_started)
+        elapsed = time.perf_counter() - started
+    finally:
+        stop_system(system, database)
+        simulator.close()
+
+    summary = summarize(f"scene {args.bulbs} bulbs", latencies, errors, elapsed)
+    print_summary(summary)
+    return [summary]
+
+
+# ----------------------------------------------------------------------
+# Regression check
+# ----------------------------------------------------------------------
+
+# metric -> True when a higher value is better
+COMPARED_METRICS = {"p99_ms": False, "rps": True, "template_us": False}
+
+
+def find_regressions(summaries, baseline_path, tolerance):
+    """Scenarios that got worse than their latest entry in a --json file"""
+    baseline = {}
+    with open(baseline_path) as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                baseline[entry["scenario"]] = entry
+
+    regressions = []
+    for summary in summaries:
+        previous = baseline.get(summary["scenario"])
+        if previous is None:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            old, new = previous.get(metric), summary.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append((summary["scenario"], metric, old, new, change))
+    return regressions
+
+
+# ----------------------------------------------------------------------
+# CLI
+# ----------------------------------------------------------------------
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Sengled rescue stack benchmarks")
+    parser.add_argument("--json", help="Append results to this JSON-lines file")
+    parser.add_argument("--baseline", help="Fail if results regressed against this JSON-lines file")
+    parser.add_argument("--tolerance", type=float, default=10.0, help="Allowed regression in percent")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    storm = commands.add_parser("storm", help="Post-outage reconnect storm against the HTTP endpoints")
+    storm.add_argument("--host", default="127.0.0.1")
+    storm.add_argument("--port", type=int, default=80)
+    storm.add_argument("--serve", choices=sorted(SERVER_SCRIPTS),
+                       help="Start this server locally instead of using --host/--port")
+    storm.add_argument("--server", default="auto", help="HTTP server for --serve: auto, waitress or flask")
+    storm.add_argument("--threads", type=int, help="Worker threads for --serve")
+    storm.add_argument("--bulbs", type=int, default=1000)
+    storm.add_argument("--window", type=float, default=5.0, help="Seconds over which bulbs come back")
+    storm.add_argument("--concurrency", type=int, default=512, help="Max open client connections")
+    storm.add_argument("--timeout", type=float, default=10.0)
+    storm.add_argument("--seed", type=int, default=1)
+    storm.set_defaults(func=cmd_storm)
+
+    encode = commands.add_parser("encode", help="CPU cost of response encoding per endpoint")
+    encode.add_argument("--iterations", type=int, default=20000)
+    encode.set_defaults(func=cmd_encode)
+
+    http = commands.add_parser("http", help="Steady closed-loop load on each rescue endpoint")
+    http.add_argument("--host", default="127.0.0.1")
+    http.add_argument("--port", type=int, default=80)
+    http.add_argument("--serve", choices=sorted(SERVER_SCRIPTS),
+                      help="Start this server locally instead of using --host/--port")
+    http.add_argument("--server", default="auto", help="HTTP server for --serve: auto, waitress or flask")
+    http.add_argument("--threads", type=int, help="Worker threads for --serve")
+    http.add_argument("--endpoints", nargs="+", metavar="NAME",
+                      help=f"Subset of: {' '.join(name for name, *_ in HTTP_ENDPOINTS)}")
+    http.add_argument("--requests", type=int, default=2000, help="Requests per endpoint")
+    http.add_argument("--concurrency", type=int, default=32)
+    http.add_argument("--timeout", type=float, default=10.0)
+    http.set_defaults(func=cmd_http)
+
+    simulated = argparse.ArgumentParser(add_help=False)
+    simulated.add_argument("--bulbs", type=int, default=50)
+    simulated.add_argument("--latency", type=float, default=0.0, help="Bulb reply delay in ms")
+    simulated.add_argument("--jitter", type=float, default=0.0, help="Extra random reply delay, up to this many ms")
+    simulated.add_argument("--loss", type=float, default=0.0, help="Fraction of requests bulbs drop (0-1)")
+    simulated.add_argument("--seed", type=int, default=1)
+
+    system = argparse.ArgumentParser(add_help=False)
+    system.add_argument("--mongodb", default="mongodb://localhost:27017")
+    system.add_argument("--rate", type=float, default=DEFAULT_RATE, help="Commands per second per bulb (0 = no cap)")
+
+    discovery = commands.add_parser("discovery", parents=[simulated], help="Subnet sweep for virtual bulbs")
+    discovery.add_argument("--runs", type=int, default=5)
+    discovery.add_argument("--timeout", type=float, default=1.0, help="Sweep reply window in seconds")
+    discovery.set_defaults(func=cmd_discovery, bulbs=500)
+
+    command = commands.add_parser("command", parents=[simulated, system], help="send_command_to_bulb throughput")
+    command.add_argument("--requests", type=int, default=2000)
+    command.add_argument("--concurrency", type=int, default=32, help="Calling threads")
+    command.set_defaults(func=cmd_command)
+
+    scene = commands.add_parser("scene", parents=[simulated, system], help="execute_scene latency")
+    scene.add_argument("--runs", type=int, default=100)
+    scene.set_defaults(func=cmd_scene)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    summaries = args.func(args)
+
+    regressions = []
+    if args.baseline:
+        regressions = find_regressions(summaries, args.baseline, args.tolerance)
+        for scenario, metric, old, new, change in regressions:
+            print(f"❌ {scenario}: {metric} {old} -> {new} ({change:+.1f}%)")
+        if not regressions:
+            print(f"\n✅ No regressions beyond {args.tolerance}% against {args.baseline}")
+
+    if args.json:
+        with open(args.json, "a") as f:
+            for summary in summaries:
+                f.write(json.dumps(dict(summary, ts=time.time())) + "\n")
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+"""
+Sengled Virtual Bulbs
+=====================
+Simulated Wi-Fi bulbs on loopback, for testing the control stack without
+real hardware.
+
+Each virtual bulb binds its own loopback address (127.77.x.y on Linux,
+where all of 127.0.0.0/8 is local) on UDP port 9080 and speaks both
+protocols a real bulb does:
+
+- control: {"func": "get_device_info" | "set_device_switch" | ..., "param": {...}}
+- setup:   {"name": "startConfigRequest" | "setParamsRequest" | ..., "payload": ...}
+
+With a cloud URL (or after setParamsRequest/endConfigRequest in setup mode)
+a bulb boots like the real thing: it POSTs accessCloud.json and the bimqtt
+balancer from its own address, and stays silent on the control protocol
+until registration succeeds. Replies can be delayed (latency + jitter) or
+dropped (loss) to mimic a congested 2.4 GHz network.
+
+Usage:
+    python3 sengled_bulb_simulator.py --bulbs 50
+    python3 sengled_bulb_simulator.py --bulbs 200 --cloud http://127.0.0.1:80 --latency 5 --jitter 10 --loss 0.02
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import random
+import threading
+import time
+
+from sengled_udp_transport import BULB_PORT
+
+try:
+    from Crypto.Cipher import ARC4
+except ImportError:
+    ARC4 = None
+
+SETUP_KEY = "SengledSetupKey123"
+REGISTRATION_RETRY = 5
+
+
+def bulb_address(index):
+    """Loopback address of the index-th virtual bulb (250 per /24 of 127.77.0.0/16)"""
+    return f"127.77.{index // 250}.{index % 250 + 1}"
+
+
+def simulator_subnets(count):
+    """/24s that hold count virtual bulbs (for discovery sweeps)"""
+    return [f"127.77.{block}.0/24" for block in range((count + 249) // 250)]
+
+
+async def http_request(host, port, method, path, body=None, timeout=10, local_addr=None,
+                       user_agent="ESP32 HTTP Client/1.0"):
+    """One request on a fresh connection, like the bulb's ESP32 HTTP client.
+
+    Returns (status, body bytes).
+    """
+    payload = json.dumps(body).encode('utf-8') if body is not None else b""
+    head = (f"{method} {path} HTTP/1.1\r\n"
+            f"Host: {host}\r\n"
+            f"User-Agent: {user_agent}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            f"Connection: close\r\n\r\n").encode('ascii')
+
+    async def exchange():
+        reader, writer = await asyncio.open_connection(host, port, local_addr=local_addr)
+        try:
+            writer.write(head + payload)
+            await writer.drain()
+            status_line = await reader.readline()
+            response = await reader.read()
+            return int(status_line.split()[1]), response.split(b"\r\n\r\n", 1)[-1]
+        finally:
+            writer.close()
+
+    return await asyncio.wait_for(exchange(), timeout)
+
+
+class VirtualBulb(asyncio.DatagramProtocol):
+    def __init__(self, simulator, index):
+        self.simulator = simulator
+        self.ip = bulb_address(index)
+        self.mac = ":".join(f"{b:02X}" for b in (0xB0, 0xCE, 0x18, 0x77, index >> 8 & 0xFF, index & 0xFF))
+        self.state = {"switch": 0, "brightness": 100, "color_temp": 50, "rssi": -40 - index % 40}
+        self.booted_at = time.monotonic()
+        self.registered = simulator.cloud is None
+        self.setup_params = None
+        self.transport = None
+
+        # Stats
+        self.received = 0
+        self.dropped = 0
+
+    @property
+    def device_uuid(self):
+        # Sengled Wi-Fi bulbs use their MAC as device UUID
+        return self.mac
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.received += 1
+        simulator = self.simulator
+        if simulator.loss and simulator.rng.random() < simulator.loss:
+            self.dropped += 1
+            return
+        try:
+            message = json.loads(data.decode('utf-8'))
+        except ValueError:
+            return
+        if not isinstance(message, dict):
+            return
+
+        if "func" in message:
+            if not self.registered:
+                # Real bulbs ignore local control until the cloud accepted them
+                return
+            reply = self.handle_command(message.get("func"), message.get("param") or {})
+        elif "name" in message:
+            reply = self.handle_setup(message["name"], message.get("payload"))
+        else:
+            return
+
+        payload = json.dumps(reply).encode('utf-8')
+        delay = simulator.delay()
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self.transport.sendto, payload, addr)
+        else:
+            self.transport.sendto(payload, addr)
+
+    def info(self):
+        return dict(self.state, ret=0, deviceUuid=self.device_uuid, mac=self.mac,
+                    typeCode="W31-N11", productCode="wifielement",
+                    uptime=int(time.monotonic() - self.booted_at))
+
+    def handle_command(self, func, param):
+        if func == "get_device_info":
+            return {"func": func, "result": self.info()}
+        if func and func.startswith("set_device_"):
+            unknown = [key for key in param if key not in self.state or key == "rssi"]
+            if unknown or not param:
+                return {"func": func, "result": {"ret": 1, "msg": f"bad param: {', '.join(unknown) or 'none'}"}}
+            self.state.update(param)
+            return {"func": func, "result": {"ret": 0}}
+        return {"func": func, "result": {"ret": 1, "msg": "unknown func"}}
+
+    def handle_setup(self, name, payload):
+        response = name.replace("Request", "Response")
+        if name == "startConfigRequest":
+            return {"name": response, "payload": {"result": True, "mac": self.mac, "protocol": 1}}
+        if name == "scanWifiRequest":
+            return {"name": response, "payload": {"result": True}}
+        if name == "getAPListRequest":
+            return {"name": response, "payload": {"result": True, "routers": [
+                {"ssid": "SimulatedWiFi", "rssi": self.state["rssi"], "auth": 4}]}}
+        if name == "setParamsRequest":
+            self.setup_params = decode_setup_params(payload)
+            return {"name": response, "payload": {"result": self.setup_params is not None}}
+        if name == "endConfigRequest":
+            ok = self.setup_params is not None
+            if ok:
+                # Reboot onto the configured cloud
+                url = self.setup_params.get("appServerDomain", "")
+                self.simulator.boot(self, url.split("/life2/")[0] or None)
+            return {"name": response, "payload": {"result": ok}}
+        return {"name": response, "payload": {"result": False}}
+
+    async def register(self, base_url):
+        """Boot sequence: accessCloud.json, then the bimqtt balancer"""
+        address = base_url.split("://", 1)[-1].rstrip("/")
+        host, _, port = address.partition(":")
+        port = int(port or 80)
+        body = {"deviceUuid": self.device_uuid, "userId": "618",
+                "productCode": "wifielement", "typeCode": "W31-N11"}
+        while not self.simulator.stopping:
+            try:
+                status, _ = await http_request(host, port, "POST", "/life2/device/accessCloud.json",
+                                               body, local_addr=(self.ip, 0))
+                if status == 200:
+                    await http_request(host, port, "POST", "/jbalancer/new/bimqtt",
+                                       {"deviceUuid": self.device_uuid}, local_addr=(self.ip, 0))
+                    self.registered = True
+                    return True
+            except (OSError, asyncio.TimeoutError, ValueError, IndexError):
+                pass
+            await asyncio.sleep(REGISTRATION_RETRY)
+        return False
+
+
+def decode_setup_params(payload):
+    """Parameters from setParamsRequest: RC4+base64 like the app, or plain JSON"""
+    if isinstance(payload, dict):
+        return payload
+    if not isinstance(payload, str):
+        return None
+    candidates = []
+    try:
+        raw = base64.b64decode(payload, validate=True)
+        if ARC4 is not None:
+            candidates.append(ARC4.new(SETUP_KEY.encode()).decrypt(raw))
+        candidates.append(raw)
+    except ValueError:
+        pass
+    candidates.append(payload.encode('utf-8'))
+    for candidate in candidates:
+        try:
+            params = json.loads(candidate.decode('utf-8'))
+        except ValueError:
+            continue
+        if isinstance(params, dict):
+            return params
+    return None
+
+
+class BulbSimulator:
+    def __init__(self, count, cloud=None, latency=0.0, jitter=0.0, loss=0.0,
+                 port=BULB_PORT, seed=None):
+        """latency and jitter in seconds, loss as a probability (0-1).
+
+        With cloud (http://host:port) every bulb registers there on start.
+        """
+        if count > 250 * 256:
+            raise ValueError("At most 64000 virtual bulbs")
+        self.count = count
+        self.cloud = cloud
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.port = port
+        self.rng = random.Random(seed)
+        self.bulbs = []
+        self.stopping = False
+
+        self._loop = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._error = None
+
+    def delay(self):
+        return self.latency + (self.rng.uniform(0, self.jitter) if self.jitter else 0.0)
+
+    # ------------------------------------------------------------------
+    # Lifecycle
+    # ------------------------------------------------------------------
+
+    def start(self, timeout=30):
+        """Bind every bulb (and start registering them) on a background loop"""
+        if self._thread is not None:
+            return self
+        self._thread = threading.Thread(target=self._run_loop, name="sengled-simulator", daemon=True)
+        self._thread.start()
+        self._ready.wait(timeout)
+        if self._error is not None:
+            raise self._error
+        return self
+
+    def _run_loop(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_until_complete(self._bind_all())
+        except Exception as e:
+            self._error = e
+            self._ready.set()
+            return
+        self._ready.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            self._loop.close()
+
+    async def _bind_all(self):
+        loop = asyncio.get_running_loop()
+        for index in range(self.count):
+            bulb = VirtualBulb(self, index)
+            await loop.create_datagram_endpoint(lambda bulb=bulb: bulb, local_addr=(bulb.ip, self.port))
+            self.bulbs.append(bulb)
+            if self.cloud:
+                self.boot(bulb, self.cloud)
+
+    def boot(self, bulb, cloud):
+        """(Re)start a bulb's cloud registration"""
+        bulb.booted_at = time.monotonic()
+        if cloud:
+            bulb.registered = False
+            asyncio.ensure_future(bulb.register(cloud))
+        else:
+            bulb.registered = True
+
+    def close(self):
+        self.stopping = True
+        if self._loop is None or not self._loop.is_running():
+            return
+
+        def shutdown():
+            for bulb in self.bulbs:
+                if bulb.transport is not None:
+                    bulb.transport.close()
+            # After the sockets' close callbacks, which are already queued
+            self._loop.call_soon(self._loop.stop)
+
+        self._loop.call_soon_threadsafe(shutdown)
+        self._thread.join(5)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # ------------------------------------------------------------------
+    # Views
+    # ------------------------------------------------------------------
+
+    @property
+    def subnets(self):
+        return simulator_subnets(self.count)
+
+    def addresses(self):
+        """{device_uuid: ip} of every virtual bulb"""
+        return {bulb.device_uuid: bulb.ip for bulb in self.bulbs}
+
+    def registered(self):
+        return sum(1 for bulb in self.bulbs if bulb.registered)
+
+    def wait_registered(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.registered() == self.count:
+                return True
+            time.sleep(0.05)
+        return False
+
+    def stats(self):
+        return {
+            "bulbs": self.count,
+            "registered": self.registered(),
+            "received": sum(bulb.received for bulb in self.bulbs),
+            "dropped": sum(bulb.dropped for bulb in self.bulbs),
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulated Sengled Wi-Fi bulbs on loopback")
+    parser.add_argument("--bulbs", type=int, default=10)
+    parser.add_argument("--cloud", help="Register with this server on boot, e.g. http://127.0.0.1:80")
+    parser.add_argument("--latency", type=float, default=0.0, help="Reply delay in ms")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Extra random delay, up to this many ms")
+    parser.add_argument("--loss", type=float, default=0.0, help="Fraction of requests dropped (0-1)")
+    parser.add_argument("--port", type=int, default=BULB_PORT)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args(argv)
+
+    simulator = BulbSimulator(args.bulbs, cloud=args.cloud, latency=args.latency / 1000,
+                              jitter=args.jitter / 1000, loss=args.loss, port=args.port, seed=args.seed)
+    simulator.start()
+    first, last = simulator.bulbs[0].ip, simulator.bulbs[-1].ip
+    print(f"💡 {args.bulbs} virtual bulbs on {first} - {last} port {args.port}")
+    print(f"   discovery: python3 sengled_discovery.py {' '.join(simulator.subnets)}")
+    try:
+        while True:
+            time.sleep(10)
+            stats = simulator.stats()
+            print(f"   registered {stats['registered']}/{stats['bulbs']}  "
+                  f"requests {stats['received']}  dropped {stats['dropped']}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,48 @@
 from flask import Flask, request, jsonify
 import json
 import uuid
-from datetime import datetime, timezone
 import threading
 import time
+from sengled_logging import log_event
+from sengled_network import get_network_context
+from sengled_http import Field, ResponseTemplate, http_port, serve
+from sengled_registry import get_registry, parse_listing_args
 
 app = Flask(__name__)
 
-# Store registered devices
-registered_devices = {}
+# Registered devices, shared with the rescue server and the MongoDB system
+registered_devices = get_registry()
+
+# Standard successful registration response
+# Based on patterns from working Sengled integrations
+REGISTRATION_RESPONSE = ResponseTemplate({
+    "info": "OK",
+    "jsessionId": Field("jsessionId"),
+    "deviceUuid": Field("deviceUuid"),
+    "userId": Field("userId"),
+    "productCode": Field("productCode"),
+    "typeCode": Field("typeCode"),
+    "status": "online",
+    "timestamp": Field("timestamp"),
+    "serverTime": Field("serverTime")
+})
+
+MQTT_BALANCER_RESPONSE = ResponseTemplate({
+    "info": "OK",
+    "inceptionAddr": Field("inceptionAddr"),  # Your local MQTT broker
+    "mqtt": {
+        "host": Field("host"),
+        "port": 1883,
+        "wsPort": 9001,
+        "path": "/mqtt"
+    }
+})
+
+SERVER_INFO_RESPONSE = ResponseTemplate({
+    "info": "OK",
+    "inceptionAddr": Field("inceptionAddr"),
+    "serverTime": Field("serverTime")
+})
 
 @app.route('/life2/device/accessCloud.json', methods=['POST'])
 def access_cloud():
@@ -18,8 +52,8 @@ def access_cloud():
     """
     
     request_data = request.get_json()
-    print(f"[{datetime.now()}] Device registration request:")
-    print(f"Request: {json.dumps(request_data, indent=2)}")
+    log_event("register_request", f"Device registration request from {request.remote_addr}",
+              payload=request_data, payload_label="Request", ip=request.remote_addr)
     
     device_uuid = request_data.get('deviceUuid')
     user_id = request_data.get('userId')
@@ -29,33 +63,30 @@ def access_cloud():
     # Generate a session ID (mimicking real cloud behavior)
     jsession_id = str(uuid.uuid4()).replace('-', '')[:24]
     
-    # Standard successful registration response
-    # Based on patterns from working Sengled integrations
-    response_data = {
-        "info": "OK",
+    now_ms = int(time.time() * 1000)
+    response_fields = {
         "jsessionId": jsession_id,
         "deviceUuid": device_uuid,
         "userId": user_id,
         "productCode": product_code,
         "typeCode": type_code,
-        "status": "online",
-        "timestamp": int(datetime.now(timezone.utc).timestamp() * 1000),
-        "serverTime": int(datetime.now(timezone.utc).timestamp() * 1000)
+        "timestamp": now_ms,
+        "serverTime": now_ms
     }
     
     # Store device info for later reference
-    registered_devices[device_uuid] = {
-        'registration_time': datetime.now(timezone.utc),
-        'last_seen': datetime.now(timezone.utc),
-        'user_id': user_id,
-        'jsession_id': jsession_id,
-        'ip': request.remote_addr
-    }
+    if device_uuid:
+        registered_devices.register(
+            device_uuid,
+            request.remote_addr,
+            user_id=user_id,
+            jsession_id=jsession_id
+        )
     
-    print(f"[{datetime.now()}] Responding with registration success:")
-    print(f"Response: {json.dumps(response_data, indent=2)}")
+    log_event("register_response", f"Responding with registration success for {device_uuid}",
+              payload=response_fields, payload_label="Response", device_uuid=device_uuid)
     
-    return jsonify(response_data)
+    return REGISTRATION_RESPONSE.response(**response_fields)
 
 @app.route('/jbalancer/new/bimqtt', methods=['GET', 'POST'])
 def mqtt_balancer():
@@ -64,23 +95,20 @@ def mqtt_balancer():
     The bulb expects to get MQTT server details here.
     """
     
-    print(f"[{datetime.now()}] MQTT broker info request")
+    log_event("mqtt_balancer", f"MQTT broker info request from {request.remote_addr}",
+              ip=request.remote_addr)
     
     # Provide local MQTT broker information
     # This tells the bulb where to connect for MQTT commands
-    response_data = {
-        "info": "OK",
-        "inceptionAddr": "ws://192.168.1.100:9001/mqtt",  # Your local MQTT broker
-        "mqtt": {
-            "host": "192.168.1.100",
-            "port": 1883,
-            "wsPort": 9001,
-            "path": "/mqtt"
-        }
+    server_ip = get_network_context().server_ip
+    response_fields = {
+        "inceptionAddr": f"ws://{server_ip}:9001/mqtt",
+        "host": server_ip
     }
     
-    print(f"MQTT response: {json.dumps(response_data, indent=2)}")
-    return jsonify(response_data)
+    log_event("mqtt_balancer_response", "MQTT response",
+              payload=response_fields, payload_label="MQTT response")
+    return MQTT_BALANCER_RESPONSE.response(**response_fields)
 
 @app.route('/life2/server/getServerInfo.json', methods=['POST'])
 def get_server_info():
@@ -89,21 +117,24 @@ def get_server_info():
     Based on WebThingsIO adapter patterns.
     """
     
-    response_data = {
-        "info": "OK",
-        "inceptionAddr": "ws://192.168.1.100:9001/mqtt",
-        "serverTime": int(datetime.now(timezone.utc).timestamp() * 1000)
-    }
-    
-    return jsonify(response_data)
+    return SERVER_INFO_RESPONSE.response(
+        inceptionAddr=f"ws://{get_network_context().server_ip}:9001/mqtt",
+        serverTime=int(time.time() * 1000)
+    )
 
 @app.route('/api/devices', methods=['GET'])
 def list_devices():
-    """API endpoint to see all registered devices"""
-    return jsonify(registered_devices)
+    """API endpoint to see registered devices (since=<version> for changes, cursor/limit to page)"""
+    try:
+        since, cursor, limit = parse_listing_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if since is None and cursor is None and limit is None:
+        return jsonify(registered_devices.to_dict())
+    return jsonify(registered_devices.snapshot().select(since, cursor, limit).to_dict("devices"))
 
 if __name__ == '__main__':
     print("Starting Sengled Cloud Emulator...")
-    print("This will respond to bulb registration requests on port 80")
+    print(f"This will respond to bulb registration requests on port {http_port()}")
     print("Make sure to point bulbs to this server's IP in the setup process")
-    app.run(host='0.0.0.0', port=80, debug=True)
+    serve(app, host='0.0.0.0')
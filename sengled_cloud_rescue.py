@@ -11,17 +11,78 @@ This will:
 """
 
 import json
+import os
 import time
 import threading
 import socket
 from datetime import datetime, timezone
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+from sengled_udp_transport import get_transport
+from sengled_state_cache import DeviceStateCache
+from sengled_request_log import RequestLog
+from sengled_logging import log_event
+from sengled_network import get_network_context
+from sengled_http import Field, ResponseTemplate, http_port, serve
+from sengled_registry import get_registry, parse_listing_args
+from sengled_mqtt_broker import get_broker
+from sengled_metrics import CONTENT_TYPE, REGISTRY, instrument_app, uptime
 
 app = Flask(__name__)
 
-# Store intercepted requests and bulb info
-intercepted_requests = []
-active_bulbs = {}
+# Latency and status code histograms for every route, served on /api/metrics
+instrument_app(app)
+
+# Store intercepted requests (bounded ring buffer + rotating spool)
+intercepted_requests = RequestLog()
+
+# Rescued bulbs, shared with the emulator and the MongoDB system
+active_bulbs = get_registry()
+
+# Last-known bulb attributes reported by device_list
+device_states = DeviceStateCache()
+
+# device_list checks for stale bulb states at most this often (seconds)
+STATE_SWEEP_INTERVAL = 5
+_last_state_sweep = 0.0
+
+# Static cloud responses, serialized once; only Field values change per request
+ACCESS_CLOUD_RESPONSE = ResponseTemplate({
+    "info": "OK",
+    "jsessionId": Field("jsessionId"),
+    "deviceUuid": Field("deviceUuid"),
+    "userId": Field("userId"),
+    "productCode": Field("productCode"),
+    "typeCode": Field("typeCode"),
+    "status": "active",
+    "timestamp": Field("timestamp"),
+    "serverTime": Field("serverTime"),
+    "result": True,
+    "code": 0,
+    "message": "Device registered successfully"
+})
+
+MQTT_BALANCER_RESPONSE = ResponseTemplate({
+    "info": "OK",
+    "inceptionAddr": Field("inceptionAddr"),
+    "mqttServer": {
+        "host": Field("host"),
+        "port": 1883,
+        "wsPort": 9001,
+        "path": "/mqtt"
+    }
+})
+
+SERVER_INFO_RESPONSE = ResponseTemplate({
+    "info": "OK",
+    "inceptionAddr": Field("inceptionAddr"),
+    "serverTime": Field("serverTime")
+})
+
+# Never timeout
+SESSION_TIMEOUT_RESPONSE = ResponseTemplate({
+    "info": "OK",
+    "timeout": False
+})
 
 class SengledCloudRescue:
     def __init__(self):
@@ -39,34 +100,32 @@ class SengledCloudRescue:
             log_request("accessCloud", data)
             
             # Standard success response based on working integrations
-            response = {
-                "info": "OK",
-                "jsessionId": f"rescue_{int(time.time())}",
-                "deviceUuid": data.get('deviceUuid', 'unknown'),
-                "userId": data.get('userId', '618'),
-                "productCode": data.get('productCode', 'wifielement'),
-                "typeCode": data.get('typeCode', 'W31-N11'),
-                "status": "active",
-                "timestamp": int(time.time() * 1000),
-                "serverTime": int(time.time() * 1000),
-                "result": True,
-                "code": 0,
-                "message": "Device registered successfully"
-            }
+            now = time.time()
+            now_ms = int(now * 1000)
+            response = ACCESS_CLOUD_RESPONSE.response(
+                jsessionId=f"rescue_{int(now)}",
+                deviceUuid=data.get('deviceUuid', 'unknown'),
+                userId=data.get('userId', '618'),
+                productCode=data.get('productCode', 'wifielement'),
+                typeCode=data.get('typeCode', 'W31-N11'),
+                timestamp=now_ms,
+                serverTime=now_ms
+            )
             
             # Track this bulb
             device_uuid = data.get('deviceUuid')
             if device_uuid:
-                active_bulbs[device_uuid] = {
-                    'registration_time': datetime.now(),
-                    'ip': request.remote_addr,
-                    'user_agent': request.headers.get('User-Agent', ''),
-                    'last_seen': datetime.now()
-                }
+                active_bulbs.register(
+                    device_uuid,
+                    request.remote_addr,
+                    user_id=data.get('userId'),
+                    user_agent=request.headers.get('User-Agent', '')
+                )
                 
-                print(f"🎉 RESCUED BULB: {device_uuid} from {request.remote_addr}")
+                log_event("rescued", f"🎉 RESCUED BULB: {device_uuid} from {request.remote_addr}",
+                          device_uuid=device_uuid, ip=request.remote_addr)
             
-            return jsonify(response)
+            return response
         
         @app.route('/jbalancer/new/bimqtt', methods=['POST', 'GET'])
         def mqtt_balancer():
@@ -75,18 +134,11 @@ class SengledCloudRescue:
             log_request("mqtt_balancer", data)
             
             # Point to local MQTT broker (we'll set one up)
-            response = {
-                "info": "OK", 
-                "inceptionAddr": f"ws://{get_local_ip()}:9001/mqtt",
-                "mqttServer": {
-                    "host": get_local_ip(),
-                    "port": 1883,
-                    "wsPort": 9001,
-                    "path": "/mqtt"
-                }
-            }
-            
-            return jsonify(response)
+            local_ip = get_local_ip()
+            return MQTT_BALANCER_RESPONSE.response(
+                inceptionAddr=f"ws://{local_ip}:9001/mqtt",
+                host=local_ip
+            )
         
         @app.route('/life2/server/getServerInfo.json', methods=['POST'])
         def get_server_info():
@@ -94,13 +146,10 @@ class SengledCloudRescue:
             data = request.get_json()
             log_request("getServerInfo", data)
             
-            response = {
-                "info": "OK",
-                "inceptionAddr": f"ws://{get_local_ip()}:9001/mqtt",
-                "serverTime": int(time.time() * 1000)
-            }
-            
-            return jsonify(response)
+            return SERVER_INFO_RESPONSE.response(
+                inceptionAddr=f"ws://{get_local_ip()}:9001/mqtt",
+                serverTime=int(time.time() * 1000)
+            )
         
         @app.route('/user/app/customer/v2/AuthenCross.json', methods=['POST'])
         def authen_cross():
@@ -123,39 +172,73 @@ class SengledCloudRescue:
             data = request.get_json()
             log_request("sessionTimeout", data)
             
-            # Never timeout
-            response = {
-                "info": "OK",
-                "timeout": False
-            }
-            
-            return jsonify(response)
+            return SESSION_TIMEOUT_RESPONSE.response()
         
         @app.route('/life2/device/list.json', methods=['POST'])
         def device_list():
-            """Device list endpoint"""
+            """Device list endpoint.
+            
+            Pass the version/stateVersion of a previous response as
+            since/stateSince to get only the devices that changed (plus the
+            removed UUIDs), or cursor/limit to page through the full list.
+            since needs stateSince (400 otherwise); if stateSince is too old,
+            the full list comes back without "removed".
+            """
             data = request.get_json()
             log_request("deviceList", data)
             
-            # Return list of rescued bulbs
+            params = dict(request.args)
+            if isinstance(data, dict):
+                params.update(data)
+            try:
+                since, cursor, limit = parse_listing_args(params)
+                state_since = params.get('stateSince')
+                state_since = int(state_since) if state_since not in (None, "") else None
+                if since is not None and state_since is None:
+                    # Registry changes alone would miss bulbs whose attributes changed
+                    raise ValueError("since requires stateSince (the stateVersion of the previous response)")
+            except (TypeError, ValueError) as e:
+                return jsonify({"info": "ERROR", "message": str(e)}), 400
+            
+            snapshot = active_bulbs.snapshot()
+            state_version = device_states.version
+            refresh_stale_states(snapshot)
+            
+            page = snapshot.select(since, cursor, limit)
+            if page.delta:
+                # Registry changes plus bulbs whose attributes changed
+                state_changed = device_states.changed_since(state_since) if state_since is not None else None
+                if state_changed is None:
+                    page = snapshot.select(cursor=cursor, limit=limit)
+                else:
+                    listed = {record.device_uuid for record in page.records}
+                    page.records.extend(snapshot[uuid] for uuid in state_changed
+                                        if uuid not in listed and uuid in snapshot)
+            
+            # Return rescued bulbs with their last-known attributes; the app only
+            # understands "online", so missing state is flagged separately
             devices = []
-            for uuid, info in active_bulbs.items():
+            for record in page.records:
+                state = device_states.get(record.device_uuid)
                 devices.append({
-                    "deviceUuid": uuid,
+                    "deviceUuid": record.device_uuid,
                     "productCode": "wifielement",
                     "typeCode": "W31-N11",
                     "status": "online",
-                    "attributes": {
-                        "switch": 1,
-                        "brightness": 100,
-                        "colorTemperature": 4000
-                    }
+                    "stateKnown": state is not None,
+                    "attributes": dict(state.attributes) if state else {}
                 })
             
             response = {
                 "info": "OK",
-                "deviceList": devices
+                "deviceList": devices,
+                "version": page.version,
+                "stateVersion": state_version
             }
+            if page.delta:
+                response["removed"] = page.removed
+            elif page.next_cursor is not None:
+                response["nextCursor"] = page.next_cursor
             
             return jsonify(response)
         
@@ -166,14 +249,45 @@ class SengledCloudRescue:
                 "service": "Sengled Cloud Rescue",
                 "status": "active",
                 "rescued_bulbs": len(active_bulbs),
-                "uptime": time.time(),
+                "uptime": round(uptime(), 1),
                 "intercepted_requests": len(intercepted_requests)
             })
         
+        @app.route('/api/metrics', methods=['GET'])
+        def metrics():
+            """Prometheus text exposition of every counter and histogram"""
+            return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+        
+        @app.route('/api/requests', methods=['GET'])
+        def query_requests():
+            """Query intercepted requests by endpoint, IP, device and time range"""
+            try:
+                since = parse_time_arg(request.args.get('since'))
+                until = parse_time_arg(request.args.get('until'))
+                limit = min(int(request.args.get('limit', 100)), intercepted_requests.capacity)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            
+            entries = intercepted_requests.query(
+                endpoint=request.args.get('endpoint'),
+                ip=request.args.get('ip'),
+                device_uuid=request.args.get('device_uuid'),
+                since=since,
+                until=until,
+                limit=limit
+            )
+            return jsonify({"count": len(entries), "requests": entries})
+        
         @app.route('/api/bulbs', methods=['GET'])
         def list_bulbs():
-            """List all rescued bulbs"""
-            return jsonify(active_bulbs)
+            """List rescued bulbs (since=<version> for changes, cursor/limit to page)"""
+            try:
+                since, cursor, limit = parse_listing_args(request.args)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            if since is None and cursor is None and limit is None:
+                return jsonify(active_bulbs.to_dict())
+            return jsonify(active_bulbs.snapshot().select(since, cursor, limit).to_dict("bulbs"))
         
         @app.route('/', methods=['GET', 'POST'])
         def catch_all():
@@ -186,6 +300,9 @@ class SengledCloudRescue:
 
 def log_request(endpoint, data, path=None):
     """Log all requests for analysis"""
+    if data is not None and not isinstance(data, (dict, list)):
+        data = data.to_dict() if hasattr(data, 'to_dict') else str(data)
+    
     entry = {
         "timestamp": datetime.now().isoformat(),
         "endpoint": endpoint,
@@ -198,19 +315,38 @@ def log_request(endpoint, data, path=None):
     
     intercepted_requests.append(entry)
     
-    print(f"📡 [{datetime.now().strftime('%H:%M:%S')}] {endpoint}: {request.remote_addr}")
-    if data:
-        print(f"    Data: {json.dumps(data, indent=2)}")
+    log_event("request", f"📡 {endpoint}: {request.remote_addr}",
+              payload=data or None, endpoint=endpoint, ip=request.remote_addr,
+              path=entry["path"], method=request.method)
 
-def get_local_ip():
-    """Get the local IP address"""
+def parse_time_arg(value):
+    """Accept epoch seconds or an ISO-8601 timestamp from a query string"""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
     try:
-        # Connect to a dummy address to find local IP
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            s.connect(("8.8.8.8", 80))
-            return s.getsockname()[0]
-    except:
-        return "192.168.1.79"  # sooke-srv
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"Invalid time: {value}")
+    return parsed.timestamp()
+
+def refresh_stale_states(snapshot):
+    """Refresh stale bulb states in the background, at most every STATE_SWEEP_INTERVAL"""
+    global _last_state_sweep
+    now = time.monotonic()
+    if now - _last_state_sweep < STATE_SWEEP_INTERVAL:
+        return
+    _last_state_sweep = now
+    for uuid, record in snapshot.items():
+        if not device_states.is_fresh(device_states.get(uuid)):
+            device_states.refresh_in_background(get_transport(), uuid, record.ip)
+
+def get_local_ip():
+    """Get the local IP address (cached; set SENGLED_SERVER_IP to override)"""
+    return get_network_context().server_ip
 
 def start_udp_test_server():
     """Background UDP server to test bulb responses"""
@@ -245,12 +381,20 @@ def start_udp_test_server():
     thread = threading.Thread(target=udp_server, daemon=True)
     thread.start()
 
+def start_mqtt_broker():
+    """Embedded MQTT broker at the address bimqtt hands out to bulbs"""
+    broker = get_broker().start()
+    broker.add_status_listener(device_states.merge)
+    for host, port in broker.addresses:
+        print(f"📡 MQTT broker listening on {host}:{port}")
+    return broker
+
 def test_rescued_bulbs():
     """Test UDP control on rescued bulbs"""
     print("\n🧪 Testing rescued bulbs with UDP commands...")
     
-    for device_uuid, info in active_bulbs.items():
-        bulb_ip = info['ip']
+    for device_uuid, record in active_bulbs.snapshot().items():
+        bulb_ip = record.ip
         print(f"\nTesting {device_uuid} at {bulb_ip}...")
         
         commands = [
@@ -261,20 +405,17 @@ def test_rescued_bulbs():
         
         for command in commands:
             try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                sock.settimeout(3)
-                
                 message = json.dumps(command).encode('utf-8')
-                sock.sendto(message, (bulb_ip, 9080))
-                
-                response, addr = sock.recvfrom(1024)
+                response = get_transport().request_sync(bulb_ip, message)
                 result = response.decode('utf-8')
                 print(f"  ✅ {command['func']}: {result}")
+                try:
+                    device_states.update(device_uuid, command, json.loads(result))
+                except ValueError:
+                    pass
                 
             except Exception as e:
                 print(f"  ❌ {command['func']}: {e}")
-            finally:
-                sock.close()
 
 def main():
     print("🚨 SENGLED CLOUD RESCUE SERVICE")
@@ -284,8 +425,9 @@ def main():
     print()
     
     local_ip = get_local_ip()
+    port = http_port()
     print(f"🌐 Local IP: {local_ip}")
-    print(f"🔧 Cloud rescue server will run on: http://{local_ip}")
+    print(f"🔧 Cloud rescue server will run on: http://{local_ip}:{port}")
     print()
     print("📋 SETUP INSTRUCTIONS:")
     print("1. Configure your router/DNS to redirect Sengled domains to this IP:")
@@ -300,21 +442,23 @@ def main():
     
     # Start background services
     start_udp_test_server()
+    if os.environ.get("SENGLED_MQTT_BROKER", "0").lower() in ("1", "true", "yes"):
+        start_mqtt_broker()
     
     # Run the Flask app
     rescue = SengledCloudRescue()
     
     try:
-        print(f"🚀 Starting rescue service on {local_ip}:8080...")
-        app.run(host='0.0.0.0', port=80, debug=False)
+        print(f"🚀 Starting rescue service on {local_ip}:{port}...")
+        serve(app, host='0.0.0.0', port=port)
     except KeyboardInterrupt:
         print("\n🛑 Rescue service stopped")
         
         if active_bulbs:
             print(f"\n📊 RESCUE SUMMARY:")
             print(f"Rescued {len(active_bulbs)} bulbs:")
-            for uuid, info in active_bulbs.items():
-                print(f"  • {uuid} at {info['ip']}")
+            for uuid, record in active_bulbs.snapshot().items():
+                print(f"  • {uuid} at {record.ip}")
             
             test_rescued_bulbs()
 
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Sengled Command Queue
+=====================
+Per-bulb command queue with latest-value-wins coalescing and a rate cap.
+
+A brightness slider or automation loop can fire dozens of commands per
+second at one bulb. Each bulb gets a queue keyed by command func: a new
+set_device_brightness replaces the one still waiting, and every caller
+whose command was superseded gets the result of the value actually sent.
+Commands to one bulb go out one at a time and at most `rate` per second,
+so the bulb's small network stack is not flooded with stale values.
+
+The queues run on the shared transport loop; no extra threads are used.
+Scenes and group commands go through send_many, so they share the pacing,
+coalescing and MQTT push of single commands. A command may carry a
+prepared (ip, payload bytes) pair, e.g. from a compiled scene, which the
+sender uses instead of looking up and encoding it again.
+"""
+
+import asyncio
+import socket
+import time
+from collections import OrderedDict
+
+# Commands per second per bulb
+DEFAULT_RATE = 10
+
+
+class _BulbQueue:
+    __slots__ = ("pending", "worker", "next_send")
+
+    def __init__(self):
+        # coalescing key -> [latest command, future shared by every caller, prepared]
+        self.pending = OrderedDict()
+        self.worker = None
+        self.next_send = 0.0
+
+
+class CommandQueue:
+    def __init__(self, transport, send, rate=DEFAULT_RATE):
+        """send is an async callable(device_uuid, command, prepared=None) -> result"""
+        self.transport = transport
+        self._send = send
+        self.interval = 1.0 / rate if rate else 0.0
+        self._queues = {}
+
+        # Stats
+        self.submitted = 0
+        self.coalesced = 0
+        self.sent = 0
+
+    @staticmethod
+    def coalescing_key(command):
+        """Commands with the same key replace each other while queued"""
+        func = command.get("func") if isinstance(command, dict) else None
+        return func if func else object()
+
+    async def _enqueue(self, device_uuid, command, prepared=None):
+        queue = self._queues.get(device_uuid)
+        if queue is None:
+            queue = self._queues[device_uuid] = _BulbQueue()
+
+        self.submitted += 1
+        key = self.coalescing_key(command)
+        entry = queue.pending.get(key)
+        if entry is not None:
+            entry[0] = command
+            entry[2] = prepared
+            self.coalesced += 1
+            future = entry[1]
+        else:
+            future = asyncio.get_running_loop().create_future()
+            queue.pending[key] = [command, future, prepared]
+
+        if queue.worker is None:
+            queue.worker = asyncio.ensure_future(self._drain(device_uuid, queue))
+        # Shielded: one caller giving up must not cancel the send for the others
+        return await asyncio.shield(future)
+
+    async def _drain(self, device_uuid, queue):
+        loop = asyncio.get_running_loop()
+        try:
+            while queue.pending:
+                delay = queue.next_send - loop.time()
+                if delay > 0:
+                    # Newer values arriving meanwhile replace the queued ones
+                    await asyncio.sleep(delay)
+                _, (command, future, prepared) = queue.pending.popitem(last=False)
+                queue.next_send = loop.time() + self.interval
+                try:
+                    result = await self._send(device_uuid, command, prepared)
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+                self.sent += 1
+        finally:
+            queue.worker = None
+            if not queue.pending and self._queues.get(device_uuid) is queue:
+                if loop.time() >= queue.next_send:
+                    del self._queues[device_uuid]
+                else:
+                    # Keep the pacing state until the bulb's next slot opens
+                    loop.call_at(queue.next_send, self._expire, device_uuid, queue)
+
+    def _expire(self, device_uuid, queue):
+        if not queue.pending and queue.worker is None and self._queues.get(device_uuid) is queue:
+            del self._queues[device_uuid]
+
+    async def send(self, device_uuid, command):
+        """Queue a command and wait for the result of the value actually sent"""
+        return await asyncio.wrap_future(self.transport.submit(self._enqueue(device_uuid, command)))
+
+    def send_sync(self, device_uuid, command, timeout=None):
+        """Blocking send()"""
+        return self.transport.run(self._enqueue(device_uuid, command), timeout)
+
+    async def _send_many(self, items, timeout):
+        async def one(device_uuid, command, prepared=None):
+            started = time.perf_counter()
+            try:
+                result = await asyncio.wait_for(self._enqueue(device_uuid, command, prepared), timeout)
+            except asyncio.TimeoutError:
+                # Same exception as a transport timeout (they differ before Python 3.11)
+                result = socket.timeout("timed out")
+            except Exception as e:
+                # A timeout leaves the command queued; its outcome is still logged
+                result = e
+            return device_uuid, result, time.perf_counter() - started
+
+        outcomes = await asyncio.gather(*(one(*item) for item in items))
+        return {device_uuid: (result, latency) for device_uuid, result, latency in outcomes}
+
+    def send_many_sync(self, items, timeout):
+        """Queue (device_uuid, command) or (device_uuid, command, prepared) items all at once.
+
+        Returns {device_uuid: (result_or_exception, latency_seconds)}; bulbs
+        that miss timeout get socket.timeout, like the transport raises.
+        """
+        return self.transport.run(self._send_many(list(items), timeout))
+
+    def pending(self, device_uuid=None):
+        """Number of queued (not yet sent) commands"""
+        if device_uuid is not None:
+            queue = self._queues.get(device_uuid)
+            return len(queue.pending) if queue else 0
+        return sum(len(queue.pending) for queue in list(self._queues.values()))
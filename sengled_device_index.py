@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+Sengled Device Address Index
+============================
+Persistent UUID <-> MAC <-> IP index for bulbs.
+
+The index lives in the devices collection and in a local JSON mirror, so a
+restart recovers every known bulb address straight from disk. The kernel
+ARP table and DHCP lease files tell us when a known MAC shows up at a new
+IP, so only that bulb needs to be re-verified instead of rescanning.
+
+Given a write-behind writer, address updates reach MongoDB through its
+queue (and journal), so recording an address never waits on the database.
+"""
+
+import json
+import os
+import re
+import threading
+import time
+from datetime import datetime, timezone
+
+from sengled_discovery import normalize_mac
+
+DEFAULT_MIRROR_PATH = "sengled_device_index.json"
+ARP_TABLE = "/proc/net/arp"
+DHCP_LEASE_FILES = (
+    "/var/lib/misc/dnsmasq.leases",
+    "/var/lib/dnsmasq/dnsmasq.leases",
+    "/tmp/dhcp.leases",
+    "/var/lib/dhcp/dhcpd.leases",
+)
+
+
+class AddressEntry:
+    __slots__ = ("uuid", "mac", "ip", "last_verified")
+
+    def __init__(self, uuid, mac=None, ip=None, last_verified=None):
+        self.uuid = uuid
+        self.mac = mac
+        self.ip = ip
+        self.last_verified = last_verified
+
+    def to_dict(self):
+        return {"device_uuid": self.uuid, "mac_address": self.mac,
+                "ip_address": self.ip, "last_verified": self.last_verified}
+
+
+def read_arp_table(path=ARP_TABLE):
+    """{ip: mac} for every complete entry in the kernel neighbour table"""
+    neighbours = {}
+    try:
+        with open(path) as f:
+            next(f, None)  # header
+            for line in f:
+                fields = line.split()
+                if len(fields) < 4 or fields[2] == "0x0":
+                    continue
+                mac = normalize_mac(fields[3])
+                if mac and mac != "00:00:00:00:00:00":
+                    neighbours[fields[0]] = mac
+    except OSError:
+        pass
+    return neighbours
+
+
+def read_dhcp_leases(paths=DHCP_LEASE_FILES):
+    """{ip: mac} from dnsmasq/OpenWrt and ISC dhcpd lease files"""
+    leases = {}
+    for path in paths:
+        try:
+            with open(path) as f:
+                content = f.read()
+        except OSError:
+            continue
+
+        if "lease " in content and "hardware ethernet" in content:
+            # ISC dhcpd: later blocks for the same IP supersede earlier ones
+            for ip, body in re.findall(r"lease (\S+) \{(.*?)\}", content, re.S):
+                match = re.search(r"hardware ethernet ([0-9A-Fa-f:]+);", body)
+                mac = normalize_mac(match.group(1)) if match else None
+                if mac:
+                    leases[ip] = mac
+        else:
+            # dnsmasq: "<expiry> <mac> <ip> <hostname> <client-id>"
+            for line in content.splitlines():
+                fields = line.split()
+                if len(fields) >= 3:
+                    mac = normalize_mac(fields[1])
+                    if mac:
+                        leases[fields[2]] = mac
+    return leases
+
+
+def read_neighbours():
+    """Best current view of ip -> mac; live ARP entries win over leases"""
+    neighbours = read_dhcp_leases()
+    neighbours.update(read_arp_table())
+    return neighbours
+
+
+class DeviceAddressIndex:
+    def __init__(self, devices=None, mirror_path=DEFAULT_MIRROR_PATH, writer=None):
+        self.devices = devices
+        self.mirror_path = mirror_path
+        # MongoWriteBehind for the devices collection; None writes inline
+        self.writer = writer
+
+        self._by_uuid = {}
+        self._by_mac = {}
+        self._by_ip = {}
+        self._lock = threading.Lock()
+
+    # ------------------------------------------------------------------
+    # Loading and persistence
+    # ------------------------------------------------------------------
+
+    def load(self, merge=True):
+        """Load the local mirror, then (with merge) anything newer from MongoDB"""
+        try:
+            with open(self.mirror_path) as f:
+                for doc in json.load(f):
+                    self._apply(doc)
+        except (OSError, ValueError):
+            pass
+
+        if merge and self.devices is not None:
+            try:
+                projection = {"_id": 0, "device_uuid": 1, "mac_address": 1,
+                              "ip_address": 1, "last_verified": 1}
+                for doc in self.devices.find({"ip_address": {"$exists": True}}, projection):
+                    verified = doc.get("last_verified")
+                    doc["last_verified"] = verified.timestamp() if isinstance(verified, datetime) else None
+                    current = self._by_uuid.get(doc["device_uuid"])
+                    if current is None or (doc["last_verified"] or 0) > (current.last_verified or 0):
+                        self._apply(doc)
+            except Exception as e:
+                print(f"Device index load error: {e}")
+        return self
+
+    def _apply(self, doc):
+        self._set(doc["device_uuid"], doc.get("ip_address"),
+                  normalize_mac(doc.get("mac_address")), doc.get("last_verified"))
+
+    def _save_mirror(self):
+        tmp_path = f"{self.mirror_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump([entry.to_dict() for entry in self._by_uuid.values()], f)
+        os.replace(tmp_path, self.mirror_path)
+
+    # ------------------------------------------------------------------
+    # Lookups
+    # ------------------------------------------------------------------
+
+    def get(self, device_uuid):
+        return self._by_uuid.get(device_uuid)
+
+    def by_mac(self, mac):
+        return self._by_mac.get(normalize_mac(mac))
+
+    def by_ip(self, ip):
+        return self._by_ip.get(ip)
+
+    def entries(self):
+        return list(self._by_uuid.values())
+
+    def moved(self, neighbours):
+        """Entries whose MAC now appears at a different IP: [(entry, new_ip)]"""
+        moves = []
+        for ip, mac in neighbours.items():
+            entry = self._by_mac.get(mac)
+            if entry is not None and entry.ip != ip:
+                moves.append((entry, ip))
+        return moves
+
+    # ------------------------------------------------------------------
+    # Updates
+    # ------------------------------------------------------------------
+
+    def _set(self, uuid, ip, mac, verified):
+        entry = self._by_uuid.get(uuid)
+        if entry is None:
+            entry = self._by_uuid[uuid] = AddressEntry(uuid)
+
+        if entry.ip and self._by_ip.get(entry.ip) is entry:
+            del self._by_ip[entry.ip]
+        if entry.mac and self._by_mac.get(entry.mac) is entry:
+            del self._by_mac[entry.mac]
+
+        entry.ip = ip or entry.ip
+        entry.mac = mac or entry.mac
+        entry.last_verified = verified or entry.last_verified
+
+        if entry.ip:
+            # An address belongs to one bulb at a time
+            previous = self._by_ip.get(entry.ip)
+            if previous is not None and previous is not entry:
+                previous.ip = None
+            self._by_ip[entry.ip] = entry
+        if entry.mac:
+            self._by_mac[entry.mac] = entry
+        return entry
+
+    def record(self, device_uuid, ip, mac=None):
+        """Record a verified address for a bulb and persist it"""
+        now = time.time()
+        with self._lock:
+            entry = self._set(device_uuid, ip, normalize_mac(mac), now)
+            self._save_mirror()
+
+        if self.writer is not None or self.devices is not None:
+            fields = {"ip_address": entry.ip,
+                      "last_verified": datetime.fromtimestamp(now, timezone.utc)}
+            if entry.mac:
+                fields["mac_address"] = entry.mac
+            if self.writer is not None:
+                self.writer.upsert_device(device_uuid, fields)
+            else:
+                self.devices.update_one({"device_uuid": device_uuid}, {"$set": fields}, upsert=True)
+        return entry
+
+    def __len__(self):
+        return len(self._by_uuid)
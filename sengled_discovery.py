@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Sengled Subnet Discovery
+========================
+Find every bulb on one or more subnets in a single sweep.
+
+Instead of probing one address at a time per missing UUID, a sweep sends
+get_device_info to every host of each CIDR (or to the subnet broadcast
+address) in one paced burst over the shared UDP transport, then collects
+all replies inside a single timeout window. Replies are matched to device
+UUIDs and MACs from their payload.
+"""
+
+import asyncio
+import ipaddress
+import json
+import re
+import time
+
+from sengled_udp_transport import BULB_PORT, encode_command, get_transport
+from sengled_network import get_network_context
+from sengled_metrics import DISCOVERY_BULBS, DISCOVERY_SWEEP
+
+DISCOVERY_TIMEOUT = 2
+DISCOVERY_RATE = 2000  # datagrams per second
+
+GET_DEVICE_INFO = encode_command({"func": "get_device_info", "param": {}})
+
+UUID_KEYS = ("deviceUuid", "device_uuid", "uuid", "dn")
+MAC_KEYS = ("mac", "mac_address", "macAddress")
+MAC_PATTERN = re.compile(r"^[0-9A-Fa-f]{2}([:-]?[0-9A-Fa-f]{2}){5}$")
+
+
+class DiscoveredBulb:
+    __slots__ = ("ip", "uuid", "mac", "info", "rtt")
+
+    def __init__(self, ip, uuid, mac, info, rtt):
+        self.ip = ip
+        self.uuid = uuid
+        self.mac = mac
+        self.info = info
+        self.rtt = rtt
+
+    def __repr__(self):
+        return f"DiscoveredBulb(ip={self.ip!r}, uuid={self.uuid!r}, mac={self.mac!r})"
+
+
+def normalize_mac(value):
+    """AA:BB:CC:DD:EE:FF form, or None if value is not a MAC"""
+    if not isinstance(value, str) or not MAC_PATTERN.match(value):
+        return None
+    digits = re.sub(r"[:-]", "", value).upper()
+    return ":".join(digits[i:i + 2] for i in range(0, 12, 2))
+
+
+def _find_key(data, keys):
+    """Depth-first search of a reply payload for the first matching key"""
+    if isinstance(data, dict):
+        for key in keys:
+            if isinstance(data.get(key), str):
+                return data[key]
+        for value in data.values():
+            found = _find_key(value, keys)
+            if found:
+                return found
+    elif isinstance(data, list):
+        for value in data:
+            found = _find_key(value, keys)
+            if found:
+                return found
+    return None
+
+
+def identify_reply(payload):
+    """Extract (uuid, mac, info) from a get_device_info reply"""
+    try:
+        info = json.loads(payload.decode('utf-8'))
+    except ValueError:
+        return None, None, None
+
+    mac = normalize_mac(_find_key(info, MAC_KEYS))
+    uuid = _find_key(info, UUID_KEYS)
+    if uuid is None and mac is not None:
+        # Sengled WiFi bulbs use their MAC as the device UUID
+        uuid = mac
+    return uuid, mac, info
+
+
+def local_subnets():
+    """Subnets to scan and our own addresses, from the shared network context"""
+    ctx = get_network_context()
+    return ctx.subnets, set(ctx.local_addresses)
+
+
+def _targets(cidrs, broadcast, exclude):
+    for cidr in cidrs:
+        network = ipaddress.ip_network(cidr, strict=False)
+        if broadcast and network.num_addresses > 2:
+            yield str(network.broadcast_address)
+            continue
+        for host in network.hosts():
+            ip = str(host)
+            if ip not in exclude:
+                yield ip
+
+
+async def sweep(transport, cidrs, timeout=DISCOVERY_TIMEOUT, rate=DISCOVERY_RATE,
+                broadcast=False, exclude=(), port=BULB_PORT):
+    """Probe every host in cidrs at once; runs on the transport loop.
+
+    Each host is probed as a transport request, so a bulb that is busy with
+    a command is probed right after it instead of being missed. Broadcast
+    sweeps collect replies from addresses nothing else is talking to.
+
+    Returns {ip: DiscoveredBulb} for every address that replied.
+    """
+    found = {}
+    loop = asyncio.get_running_loop()
+    exclude = set(exclude)
+
+    def record(ip, data, rtt):
+        if ip in found or ip in exclude:
+            return
+        uuid, mac, info = identify_reply(data)
+        if info is not None:
+            found[ip] = DiscoveredBulb(ip, uuid, mac, info, rtt)
+
+    def on_datagram(data, addr):
+        if addr[1] == port:
+            record(addr[0], data, loop.time() - start)
+
+    async def probe(ip):
+        sent = loop.time()
+        try:
+            data = await transport.request(ip, GET_DEVICE_INFO, port, timeout, probe=True)
+        except (OSError, asyncio.CancelledError):
+            return
+        record(ip, data, loop.time() - sent)
+
+    start = loop.time()
+    probes = []
+    if broadcast:
+        transport.add_listener(on_datagram)
+    try:
+        burst = max(1, rate // 100)
+        for index, ip in enumerate(_targets(cidrs, broadcast, exclude)):
+            if broadcast:
+                transport.sendto(GET_DEVICE_INFO, ip, port)
+            else:
+                probes.append(asyncio.ensure_future(probe(ip)))
+            # Pace the burst in 10 ms slices so switches and bulbs keep up
+            if (index + 1) % burst == 0:
+                await asyncio.sleep(0.01)
+        if probes:
+            await asyncio.gather(*probes)
+        else:
+            await asyncio.sleep(timeout)
+    finally:
+        if broadcast:
+            transport.remove_listener(on_datagram)
+        for task in probes:
+            task.cancel()
+
+    DISCOVERY_SWEEP.observe(loop.time() - start)
+    DISCOVERY_BULBS.set(len(found))
+    return found
+
+
+def discover(cidrs=None, timeout=DISCOVERY_TIMEOUT, rate=DISCOVERY_RATE,
+             broadcast=False, transport=None):
+    """Blocking sweep of cidrs (default: the network context's subnets)"""
+    transport = transport or get_transport()
+    subnets, own = local_subnets()
+    if cidrs is None:
+        cidrs = subnets
+
+    started = time.monotonic()
+    found = transport.run(sweep(transport, cidrs, timeout, rate, broadcast, exclude=own))
+    print(f"🔍 Discovery swept {', '.join(cidrs) or 'nothing'} in "
+          f"{time.monotonic() - started:.1f}s: {len(found)} bulb(s)")
+    return found
+
+
+if __name__ == "__main__":
+    import sys
+
+    for bulb in discover(sys.argv[1:] or None).values():
+        print(f"  • {bulb.ip}  uuid={bulb.uuid}  mac={bulb.mac}  rtt={bulb.rtt * 1000:.1f}ms")
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Sengled HTTP Serving
+====================
+Run the rescue server and emulator Flask apps under a production WSGI server.
+
+Flask's development server falls over when power comes back and every bulb
+in the building calls accessCloud.json and bimqtt within a few seconds.
+serve() runs the same app, with its routes unchanged, on waitress (a
+multi-threaded production WSGI server) when it is installed, and falls back
+to Flask's threaded server otherwise.
+
+Configured from the environment (or serve() arguments):
+
+- SENGLED_HTTP_SERVER: auto (default), waitress or flask
+- SENGLED_HTTP_PORT: listen port (default 80)
+- SENGLED_HTTP_THREADS: worker threads (default 32)
+- SENGLED_HTTP_BACKLOG: listen backlog for reconnect storms (default 2048)
+
+Install the production server with: pip install waitress
+
+The static cloud endpoints answer with precompiled ResponseTemplates: the
+payload is serialized to bytes once at startup and only the per-request
+fields (timestamps, session IDs, echoed device fields) are patched in.
+orjson is used for encoding when it is installed.
+"""
+
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from flask import Response
+except ImportError:
+    Response = None
+
+SERVERS = ("auto", "waitress", "flask")
+DEFAULT_PORT = 80
+DEFAULT_THREADS = 32
+DEFAULT_BACKLOG = 2048
+
+
+def http_port(default=DEFAULT_PORT):
+    return int(os.environ.get("SENGLED_HTTP_PORT", default))
+
+
+def serve(app, host="0.0.0.0", port=None, server=None, threads=None, backlog=None):
+    """Serve a Flask app until interrupted"""
+    server = server or os.environ.get("SENGLED_HTTP_SERVER", "auto")
+    if server not in SERVERS:
+        raise ValueError(f"HTTP server must be one of {SERVERS}")
+    port = port or http_port()
+    threads = threads or int(os.environ.get("SENGLED_HTTP_THREADS", DEFAULT_THREADS))
+    backlog = backlog or int(os.environ.get("SENGLED_HTTP_BACKLOG", DEFAULT_BACKLOG))
+
+    if server in ("auto", "waitress"):
+        try:
+            from waitress import serve as waitress_serve
+        except ImportError:
+            if server == "waitress":
+                raise
+            print("⚠️  waitress not installed - falling back to Flask's development server")
+            print("   Install it for reconnect storms: pip install waitress")
+        else:
+            print(f"🚀 Serving with waitress on {host}:{port} ({threads} threads, backlog {backlog})")
+            waitress_serve(
+                app,
+                host=host,
+                port=port,
+                threads=threads,
+                backlog=backlog,
+                connection_limit=max(backlog, 1000),
+                channel_timeout=30,
+                ident="Sengled",
+            )
+            return
+
+    print(f"🚀 Serving with Flask's threaded server on {host}:{port}")
+    app.run(host=host, port=port, debug=False, threaded=True)
+
+
+# ----------------------------------------------------------------------
+# Precompiled JSON responses
+# ----------------------------------------------------------------------
+
+if orjson is not None:
+    def dumps(value):
+        """Encode a value to JSON bytes with the fastest available codec"""
+        return orjson.dumps(value)
+else:
+    def dumps(value):
+        """Encode a value to JSON bytes with the fastest available codec"""
+        return json.dumps(value, separators=(",", ":")).encode('utf-8')
+
+
+class Field:
+    """Placeholder for a per-request value inside a ResponseTemplate"""
+
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+
+
+class ResponseTemplate:
+    """A JSON payload serialized once, with Field slots patched per request"""
+
+    def __init__(self, template):
+        markers = {}
+
+        def substitute(value):
+            if isinstance(value, Field):
+                marker = f"__sengled_field_{len(markers)}__"
+                markers[marker] = value.name
+                return marker
+            if isinstance(value, dict):
+                return {key: substitute(item) for key, item in value.items()}
+            if isinstance(value, list):
+                return [substitute(item) for item in value]
+            return value
+
+        encoded = dumps(substitute(template))
+
+        # Split the encoded bytes around each quoted marker
+        self._segments = []
+        self._fields = []
+        for marker, name in markers.items():
+            quoted = dumps(marker)
+            head, encoded = encoded.split(quoted, 1)
+            self._segments.append(head)
+            self._fields.append(name)
+        self._segments.append(encoded)
+        self._static = encoded if not markers else None
+
+    @property
+    def fields(self):
+        return tuple(self._fields)
+
+    def render(self, **values):
+        """JSON bytes with every Field replaced by its value"""
+        if self._static is not None:
+            return self._static
+        parts = [self._segments[0]]
+        for name, segment in zip(self._fields, self._segments[1:]):
+            value = values[name]
+            parts.append(str(value).encode('ascii') if type(value) is int else dumps(value))
+            parts.append(segment)
+        return b"".join(parts)
+
+    def response(self, **values):
+        """Flask response carrying the rendered JSON"""
+        return Response(self.render(**values), mimetype="application/json")
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Sengled MongoDB Indexes
+=======================
+Index provisioning and retention for the SengledMongoDBSystem collections.
+
+ensure_indexes() runs at startup and is idempotent:
+
+- devices.device_uuid, scenes.name, groups.name and schedules.name are
+  unique, so every find_one/update_one by those keys is a point lookup
+- commands has (device_uuid, timestamp, _id), which answers "latest N
+  commands for a bulb" and every later page straight from the index
+- commands.timestamp carries a TTL so the log stops growing once it
+  reaches the retention window (None keeps everything)
+
+A unique index cannot be built while duplicates exist; in that case a
+plain index is created instead and a warning is printed, so startup never
+fails on old data. An existing index on a lookup key (that fallback, or
+one made by hand) is left as it is and reported; drop it once the
+duplicates are gone and the next start builds the unique one.
+"""
+
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+
+# Default retention for the commands log, in days (None = keep forever)
+COMMAND_RETENTION_DAYS = 90
+
+DEFAULT_HISTORY_LIMIT = 50
+MAX_HISTORY_LIMIT = 1000
+
+# Server error codes
+DUPLICATE_KEY = 11000
+INDEX_OPTIONS_CONFLICT = 85
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+COMMAND_HISTORY_INDEX = [("device_uuid", ASCENDING), ("timestamp", ASCENDING), ("_id", ASCENDING)]
+
+UNIQUE_KEYS = (
+    ("devices", "device_uuid"),
+    ("scenes", "name"),
+    ("groups", "name"),
+    ("schedules", "name"),
+)
+
+
+def _existing_index(collection, field):
+    """(name, unique) of an index on exactly this field, or None"""
+    for name, info in collection.index_information().items():
+        if info["key"] == [(field, ASCENDING)]:
+            return name, bool(info.get("unique"))
+    return None
+
+
+def _ensure_unique(collection, field):
+    existing = _existing_index(collection, field)
+    if existing is not None:
+        name, unique = existing
+        if not unique:
+            # Rebuilding it under another spec would fail (IndexOptionsConflict)
+            print(f"⚠️  {collection.name}.{field} has the non-unique index {name}; "
+                  f"drop it to get a unique one once duplicates are removed")
+        return "unique" if unique else "non-unique"
+    try:
+        collection.create_index(field, unique=True)
+        return "unique"
+    except OperationFailure as e:
+        if e.code != DUPLICATE_KEY:
+            raise
+        print(f"⚠️  Duplicate {collection.name}.{field} values; using a non-unique index until they are removed")
+        collection.create_index(field, name=f"{field}_lookup")
+        return "non-unique"
+
+
+def ensure_ttl(collection, field, seconds):
+    """Create, retune or drop the TTL index on a date field"""
+    existing = None
+    for name, info in collection.index_information().items():
+        if info["key"] == [(field, ASCENDING)] and "expireAfterSeconds" in info:
+            existing = (name, info["expireAfterSeconds"])
+            break
+
+    if seconds is None:
+        if existing:
+            collection.drop_index(existing[0])
+        return None
+
+    seconds = int(seconds)
+    if existing is None:
+        try:
+            collection.create_index(field, expireAfterSeconds=seconds)
+        except OperationFailure as e:
+            if e.code != INDEX_OPTIONS_CONFLICT:
+                raise
+            # A plain index on the same key exists; make it a TTL index
+            collection.database.command("collMod", collection.name,
+                                        index={"keyPattern": {field: ASCENDING}, "expireAfterSeconds": seconds})
+    elif existing[1] != seconds:
+        collection.database.command("collMod", collection.name,
+                                    index={"name": existing[0], "expireAfterSeconds": seconds})
+    return seconds
+
+
+def ensure_indexes(db, command_retention_days=COMMAND_RETENTION_DAYS):
+    """Provision every index the system relies on; returns a summary"""
+    summary = {}
+    for collection_name, field in UNIQUE_KEYS:
+        summary[f"{collection_name}.{field}"] = _ensure_unique(db[collection_name], field)
+
+    db.commands.create_index(COMMAND_HISTORY_INDEX, name="device_history")
+    summary["commands.device_history"] = "compound"
+
+    seconds = command_retention_days * 86400 if command_retention_days else None
+    summary["commands.timestamp"] = ensure_ttl(db.commands, "timestamp", seconds)
+    return summary
+
+
+# ----------------------------------------------------------------------
+# Command history
+# ----------------------------------------------------------------------
+
+def encode_history_cursor(doc):
+    """Opaque keyset cursor: the (timestamp, _id) of the last row returned"""
+    when = doc["timestamp"]
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return f"{(when - EPOCH) // timedelta(milliseconds=1)}-{doc['_id']}"
+
+
+def decode_history_cursor(cursor):
+    try:
+        millis, object_id = cursor.split("-", 1)
+        return EPOCH + timedelta(milliseconds=int(millis)), ObjectId(object_id)
+    except Exception:
+        raise ValueError(f"Invalid history cursor: {cursor!r}")
+
+
+def command_history(commands, device_uuid, cursor=None, limit=DEFAULT_HISTORY_LIMIT, since=None, until=None):
+    """One page of a bulb's command log, newest first.
+
+    Keyset pagination on (timestamp, _id): every page is an index seek on
+    device_history followed by limit rows, however deep into the log it is.
+    Returns {"commands": [...], "next_cursor": str or None}.
+    """
+    limit = max(1, min(int(limit), MAX_HISTORY_LIMIT))
+    query = {"device_uuid": device_uuid}
+    timestamp = {}
+    if since is not None:
+        timestamp["$gte"] = since
+    if until is not None:
+        timestamp["$lt"] = until
+
+    if cursor:
+        last_time, last_id = decode_history_cursor(cursor)
+        timestamp["$lte"] = last_time
+        # Rows strictly before the last one returned, in (timestamp, _id) order
+        query["$or"] = [{"timestamp": {"$lt": last_time}},
+                        {"timestamp": last_time, "_id": {"$lt": last_id}}]
+    if timestamp:
+        query["timestamp"] = timestamp
+
+    docs = list(commands.find(query)
+                .sort([("timestamp", DESCENDING), ("_id", DESCENDING)])
+                .limit(limit + 1)
+                .hint(COMMAND_HISTORY_INDEX))
+
+    next_cursor = encode_history_cursor(docs[limit - 1]) if len(docs) > limit else None
+    docs = docs[:limit]
+    for doc in docs:
+        doc["id"] = str(doc.pop("_id"))
+    return {"commands": docs, "next_cursor": next_cursor}
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Sengled Write Journal
+=====================
+Append-only local journal for MongoDB writes that could not be made.
+
+When a write-behind flush fails (MongoDB or Atlas slow, unreachable, or
+failing over), the batch is appended here instead of being dropped, and
+later batches follow it into the journal so the original order is kept.
+A replay thread retries with backoff and, once the database answers,
+applies the journal to MongoDB in order and deletes it.
+
+Records are BSON documents written back to back, so datetimes and
+ObjectIds survive unchanged. Each appended batch costs one fsync. A record
+cut short by a crash is truncated away when the journal is reopened, so new
+records never land behind it; a journal that still cannot be read is moved
+aside (*.corrupt-<time>) after its readable part is replayed, instead of
+blocking every later write.
+
+Replay is idempotent: command documents carry their _id from the moment
+they are logged (a duplicate insert is skipped), last_seen updates use
+$max and scene, group and schedule edits are upserts and deletes by name, so a batch applied twice, or a journal replayed after a crash
+half-way through, leaves the same data behind.
+
+Configured from the environment (or WriteJournal(path=...)):
+
+- SENGLED_JOURNAL_PATH: journal file (default sengled_journal.bson)
+"""
+
+import os
+import threading
+import time
+
+import bson
+from bson.codec_options import CodecOptions
+
+DEFAULT_JOURNAL_PATH = "sengled_journal.bson"
+
+RETRY_INTERVAL = 5
+MAX_RETRY_INTERVAL = 60
+REPLAY_BATCH = 500
+
+CODEC_OPTIONS = CodecOptions(tz_aware=True)
+
+
+def _records(f):
+    """Yield (end offset, item) of each intact record; stops at the first torn or corrupt one"""
+    offset = 0
+    while True:
+        header = f.read(4)
+        if len(header) < 4:
+            return
+        length = int.from_bytes(header, "little")
+        if length < 5:
+            return
+        body = f.read(length - 4)
+        if len(body) < length - 4:
+            # Torn write at the tail (crash mid-append)
+            return
+        try:
+            item = tuple(bson.decode(header + body, CODEC_OPTIONS)["item"])
+        except Exception:
+            return
+        offset += length
+        yield offset, item
+
+
+def read_journal(path):
+    """Yield the items stored in a journal file, oldest first"""
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return
+    with f:
+        for _, item in _records(f):
+            yield item
+
+
+def truncate_torn_tail(path):
+    """Cut a journal back to its last intact record; returns the bytes removed"""
+    try:
+        f = open(path, "r+b")
+    except FileNotFoundError:
+        return 0
+    with f:
+        end = 0
+        for end, _ in _records(f):
+            pass
+        size = os.fstat(f.fileno()).st_size
+        if end < size:
+            f.truncate(end)
+            f.flush()
+            os.fsync(f.fileno())
+        return size - end
+
+
+class WriteJournal:
+    def __init__(self, apply, path=None, retry_interval=RETRY_INTERVAL,
+                 max_retry_interval=MAX_RETRY_INTERVAL, batch_size=REPLAY_BATCH):
+        """apply(items) writes a batch to MongoDB and raises if it cannot"""
+        if path is None:
+            path = os.environ.get("SENGLED_JOURNAL_PATH", DEFAULT_JOURNAL_PATH)
+        self.path = path
+        self.replay_path = path + ".replay"
+        self.apply = apply
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.batch_size = batch_size
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        removed = truncate_torn_tail(self.path)
+        if removed:
+            print(f"⚠️  Journal {self.path}: dropped {removed} bytes of a record torn by a crash")
+        self._file = open(self.path, "ab")
+        self._pending = self._file.tell() > 0 or os.path.exists(self.replay_path)
+        # Items of the replay file already applied by this process
+        self._replayed_offset = 0
+
+        # Stats
+        self.journaled = 0
+        self.replayed = 0
+
+        self._thread = threading.Thread(target=self._run, name="sengled-journal", daemon=True)
+        self._thread.start()
+        if self._pending:
+            self._wake.set()
+
+    @property
+    def pending(self):
+        """True while writes are waiting in the journal"""
+        return self._pending
+
+    # ------------------------------------------------------------------
+    # Appending
+    # ------------------------------------------------------------------
+
+    def append(self, items):
+        """Journal a batch that could not be written"""
+        with self._lock:
+            self._write(items)
+            self._pending = True
+        self._wake.set()
+
+    def append_if_pending(self, items):
+        """Journal a batch if older writes are still waiting (keeps the order)"""
+        with self._lock:
+            if not self._pending:
+                return False
+            self._write(items)
+        return True
+
+    def _write(self, items):
+        """Append and fsync once for the whole batch (caller holds the lock)"""
+        self._file.write(b"".join(bson.encode({"item": list(item)}) for item in items))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.journaled += len(items)
+
+    # ------------------------------------------------------------------
+    # Replay
+    # ------------------------------------------------------------------
+
+    def _run(self):
+        delay = self.retry_interval
+        while not self._stopped.is_set():
+            if not self._pending:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+            # Give the database a moment before the first attempt
+            if self._stopped.wait(delay):
+                return
+            try:
+                self.replay()
+                delay = self.retry_interval
+            except Exception as e:
+                delay = min(delay * 2, self.max_retry_interval)
+                print(f"Journal replay failed ({e}); retrying in {delay}s")
+
+    def replay(self):
+        """Apply everything journaled so far, in order; raises if MongoDB is still down"""
+        while True:
+            with self._lock:
+                if not os.path.exists(self.replay_path):
+                    if self._file.tell() == 0:
+                        self._pending = False
+                        return
+                    # New appends go to a fresh file while this one is replayed
+                    self._file.close()
+                    os.replace(self.path, self.replay_path)
+                    self._file = open(self.path, "ab")
+                    self._replayed_offset = 0
+
+            batch = []
+            applied = 0
+            end = 0
+            with open(self.replay_path, "rb") as f:
+                for end, item in _records(f):
+                    applied += 1
+                    if applied <= self._replayed_offset:
+                        continue
+                    batch.append(item)
+                    if len(batch) >= self.batch_size:
+                        self._apply(batch, applied)
+                        batch = []
+                size = os.fstat(f.fileno()).st_size
+            if batch:
+                self._apply(batch, applied)
+            if end < size:
+                # Unreadable past this point: keep the bytes for inspection, unblock writes
+                corrupt_path = f"{self.replay_path}.corrupt-{int(time.time())}"
+                os.replace(self.replay_path, corrupt_path)
+                print(f"⚠️  Journal unreadable after byte {end}; {size - end} bytes moved to {corrupt_path}")
+            else:
+                os.remove(self.replay_path)
+            self._replayed_offset = 0
+            print(f"📒 Journal replayed into MongoDB ({self.replayed} writes so far)")
+
+    def _apply(self, batch, offset):
+        self.apply(batch)
+        self._replayed_offset = offset
+        self.replayed += len(batch)
+
+    def close(self, timeout=5):
+        self._stopped.set()
+        self._wake.set()
+        self._thread.join(timeout)
+        with self._lock:
+            self._file.close()
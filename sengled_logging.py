@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Sengled Structured Logging
+==========================
+Off-thread logging for the cloud request path.
+
+Request handlers only push compact records (an event name, a few fields and
+an optional raw payload) onto a queue. A background listener thread does the
+formatting, level filtering and output to the console, a file, or both, so
+a burst of re-registering bulbs never waits on stdout.
+
+Configured from the environment (or configure_logging()):
+
+- SENGLED_LOG_OUTPUT: console (default), file or both
+- SENGLED_LOG_LEVEL: DEBUG, INFO (default), WARNING, ...
+- SENGLED_LOG_FILE: JSON-lines log file (default sengled.log)
+- SENGLED_LOG_PAYLOADS: 1 (default) to include request/response payload
+  dumps, 0 to turn them off completely in production
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+from datetime import datetime
+
+LOGGER_NAME = "sengled"
+OUTPUTS = ("console", "file", "both")
+
+_logger = logging.getLogger(LOGGER_NAME)
+_listener = None
+_payloads_enabled = True
+_configure_lock = threading.Lock()
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queue the record as-is; formatting happens on the listener thread"""
+
+    def prepare(self, record):
+        return record
+
+
+class ConsoleFormatter(logging.Formatter):
+    """Human-readable lines, with payloads pretty-printed underneath"""
+
+    def format(self, record):
+        stamp = datetime.fromtimestamp(record.created).strftime('%H:%M:%S')
+        line = f"[{stamp}] {record.getMessage()}"
+        payload = getattr(record, "payload", None)
+        if payload is not None:
+            label = getattr(record, "payload_label", "Data")
+            line += f"\n    {label}: {json.dumps(payload, indent=2, default=str)}"
+        return line
+
+
+class JSONLineFormatter(logging.Formatter):
+    """One compact JSON object per record"""
+
+    def format(self, record):
+        doc = {
+            "ts": record.created,
+            "level": record.levelname,
+            "event": getattr(record, "event", None),
+            "msg": record.getMessage(),
+        }
+        doc.update(getattr(record, "fields", None) or {})
+        payload = getattr(record, "payload", None)
+        if payload is not None:
+            doc["payload"] = payload
+        return json.dumps(doc, default=str, separators=(",", ":"))
+
+
+def configure_logging(output=None, level=None, log_file=None, payloads=None):
+    """(Re)start the background log listener"""
+    global _listener, _payloads_enabled
+
+    output = output or os.environ.get("SENGLED_LOG_OUTPUT", "console")
+    if output not in OUTPUTS:
+        raise ValueError(f"log output must be one of {OUTPUTS}")
+    level = level or os.environ.get("SENGLED_LOG_LEVEL", "INFO")
+    log_file = log_file or os.environ.get("SENGLED_LOG_FILE", "sengled.log")
+    if payloads is None:
+        payloads = os.environ.get("SENGLED_LOG_PAYLOADS", "1") not in ("0", "false", "no")
+
+    shutdown_logging()
+
+    handlers = []
+    if output in ("console", "both"):
+        console = logging.StreamHandler()
+        console.setFormatter(ConsoleFormatter())
+        handlers.append(console)
+    if output in ("file", "both"):
+        file_handler = logging.FileHandler(log_file, encoding="utf-8")
+        file_handler.setFormatter(JSONLineFormatter())
+        handlers.append(file_handler)
+    for handler in handlers:
+        handler.setLevel(level)
+
+    log_queue = queue.SimpleQueue()
+    _logger.handlers[:] = [_DeferredQueueHandler(log_queue)]
+    _logger.setLevel(level)
+    _logger.propagate = False
+    _payloads_enabled = payloads
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    return _logger
+
+
+def shutdown_logging():
+    """Drain the queue and stop the listener thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+def payloads_enabled():
+    return _payloads_enabled
+
+
+def log_event(event, message, level=logging.INFO, payload=None, payload_label="Data", **fields):
+    """Queue a structured record; cheap enough for the request path"""
+    if _listener is None:
+        with _configure_lock:
+            if _listener is None:
+                configure_logging()
+    if not _logger.isEnabledFor(level):
+        return
+    extra = {"event": event, "fields": fields}
+    if payload is not None and _payloads_enabled:
+        extra["payload"] = payload
+        extra["payload_label"] = payload_label
+    _logger.log(level, message, extra=extra)
+
+
+atexit.register(shutdown_logging)
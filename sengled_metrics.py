@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+Sengled Metrics
+===============
+In-process counters, gauges and latency histograms in Prometheus text format.
+
+Every metric the stack records is declared here, so the catalogue is in one
+place and each module just imports the objects it updates:
+
+- UDP round trips and timeouts (shared transport)
+- bulb command latency per func, errors per bulb and reason, retries
+- write-behind flushes to MongoDB and what happened to each queued write
+- discovery sweep duration and bulbs found
+- Flask request latency and response codes per route (instrument_app)
+
+Recording is a dict lookup for the label values plus a short locked update
+(well under a microsecond), cheap enough for the hot paths. render() produces
+the text exposition format; the rescue server serves it on /api/metrics and
+SengledMongoDBSystem can run a small listener (start_metrics_server).
+
+No third-party dependency: prometheus_client is not needed.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds; from sub-millisecond LAN replies up to the 5 s command timeout
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Series per labelled metric; label values beyond it are recorded as "other"
+MAX_SERIES = 1000
+OVERFLOW_LABEL = "other"
+
+PROCESS_START = time.time()
+
+
+def uptime():
+    """Seconds since this process started"""
+    return time.time() - PROCESS_START
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _CounterChild:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class _GaugeChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum", "_lock")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # One slot per bucket plus +Inf; made cumulative when rendered
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None, max_series=MAX_SERIES):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.max_series = max_series
+        self._overflow = (OVERFLOW_LABEL,) * len(self.labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self.labels()
+        (registry or REGISTRY).register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """The child for these label values (created on first use)"""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            with self._lock:
+                if self.max_series is not None and len(self._children) >= self.max_series:
+                    # Unbounded label values (addresses, UUIDs) must not grow memory forever
+                    values = self._overflow
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def clear(self):
+        with self._lock:
+            self._children = {} if self.labelnames else {(): self._default}
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), registry=None, max_series=MAX_SERIES, function=None):
+        """function() supplies the value at render time (unlabelled gauges only)"""
+        self.function = function
+        super().__init__(name, documentation, labelnames, registry, max_series)
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._default.set(value)
+
+    def samples(self):
+        if self.function is not None:
+            yield f"{self.name} {_format_value(self.function())}"
+            return
+        for values, child in list(self._children.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), registry=None, max_series=MAX_SERIES,
+                 buckets=LATENCY_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry, max_series)
+
+    def _new_child(self):
+        return _HistogramChild(self.bounds)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            with child._lock:
+                counts = list(child.counts)
+                total = child.sum
+            cumulative = 0
+            for bound, count in zip(self.bounds + (float("inf"),), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, values, f'le="{_format_value(float(bound))}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, values)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+
+# ----------------------------------------------------------------------
+# Catalogue
+# ----------------------------------------------------------------------
+
+UDP_ROUNDTRIP = Histogram("sengled_udp_roundtrip_seconds", "UDP request/reply round trips on the shared transport")
+UDP_TIMEOUTS = Counter("sengled_udp_timeouts_total", "UDP requests that got no reply in time", ("ip",))
+
+COMMAND_LATENCY = Histogram("sengled_command_seconds", "Bulb command latency by func", ("func",), max_series=64)
+COMMAND_ERRORS = Counter("sengled_command_errors_total", "Failed bulb commands by bulb and reason (timeout, error, rejected)",
+                         ("device", "reason"))
+COMMAND_RETRIES = Counter("sengled_command_retries_total", "Bulb command retransmissions by bulb address", ("ip",))
+
+MONGO_FLUSH = Histogram("sengled_mongo_flush_seconds", "Write-behind batch flushes to MongoDB")
+MONGO_WRITES = Counter("sengled_mongo_writes_total", "Queued MongoDB writes by outcome (written, journaled, lost, dropped)",
+                       ("outcome",))
+
+DISCOVERY_SWEEP = Histogram("sengled_discovery_sweep_seconds", "Discovery sweep duration",
+                            buckets=(0.5, 1.0, 2.0, 3.0, 5.0, 10.0, 30.0))
+DISCOVERY_BULBS = Gauge("sengled_discovery_bulbs", "Bulbs that answered the last discovery sweep")
+
+HTTP_LATENCY = Histogram("sengled_http_request_seconds", "HTTP request latency by route", ("route",))
+HTTP_RESPONSES = Counter("sengled_http_responses_total", "HTTP responses by route and status code", ("route", "code"))
+
+UPTIME = Gauge("sengled_uptime_seconds", "Seconds since the process started", function=uptime)
+
+
+# ----------------------------------------------------------------------
+# Exposition
+# ----------------------------------------------------------------------
+
+def instrument_app(app):
+    """Record latency and status codes of every Flask route"""
+    from flask import g, request
+
+    @app.before_request
+    def _start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def _record(response):
+        started = g.pop("metrics_started", None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+            HTTP_LATENCY.labels(route).observe(time.perf_counter() - started)
+            HTTP_RESPONSES.labels(route, str(response.status_code)).inc()
+        return response
+
+    return app
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/metrics", "/api/metrics"):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, host="0.0.0.0"):
+    """Serve /metrics from a background thread; call shutdown() on the result to stop"""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="sengled-metrics", daemon=True)
+    thread.start()
+    return server
@@ -1,42 +1,207 @@
 
 from pymongo import MongoClient
+from pymongo.errors import PyMongoError
 from datetime import datetime, timezone
-import threading
+import ipaddress
 import socket
+import threading
 import json
 import time
-from sengled_cloud_emulator import registered_devices
+from sengled_registry import get_registry
+from sengled_udp_transport import get_transport
+from sengled_write_behind import MongoWriteBehind
+from sengled_state_cache import DeviceStateCache, GET_DEVICE_INFO
+from sengled_discovery import discover, identify_reply, normalize_mac
+from sengled_device_index import DeviceAddressIndex, DEFAULT_MIRROR_PATH, read_neighbours
+from sengled_mqtt_broker import updates_from_command
+from sengled_command_queue import CommandQueue, DEFAULT_RATE
+from sengled_network import get_network_context
+from sengled_indexes import ensure_indexes, command_history, COMMAND_RETENTION_DAYS, DEFAULT_HISTORY_LIMIT
+from sengled_scene_cache import SceneCache, compile_group
+from sengled_scheduler import Scheduler, build_spec
+from sengled_telemetry import TelemetryCollector, TelemetryStore, RAW_RETENTION
+from sengled_metrics import COMMAND_ERRORS, COMMAND_LATENCY, start_metrics_server
+
+# Whole-scene deadline: every action in a scene shares this budget
+SCENE_DEADLINE = 2
+
+SERVER_SELECTION_TIMEOUT_MS = 5000
+# Startup asks once, briefly, whether MongoDB is there at all
+STARTUP_PING_TIMEOUT_MS = 500
+# How often deferred provisioning checks whether MongoDB is back
+PROVISION_RETRY_INTERVAL = 30
 
 class SengledMongoDBSystem:
-    def __init__(self, mongodb_uri: str, database_name: str = "sengled_home"):
-        self.client = MongoClient(mongodb_uri)
+    def __init__(self, mongodb_uri: str, database_name: str = "sengled_home",
+                 state_ttl: float = 30, discovery_subnets: list = None,
+                 index_path: str = DEFAULT_MIRROR_PATH, mqtt_broker=None,
+                 command_rate: float = DEFAULT_RATE, run_scheduler: bool = True,
+                 telemetry_interval: float = None,
+                 command_retention_days: float = COMMAND_RETENTION_DAYS,
+                 telemetry_retention_days: float = RAW_RETENTION / 86400,
+                 journal: bool = True, metrics_port: int = None):
+        # Fail fast when the server is unreachable; the journal keeps the writes
+        self.client = MongoClient(mongodb_uri, serverSelectionTimeoutMS=SERVER_SELECTION_TIMEOUT_MS)
         self.db = self.client[database_name]
+        self._closed = threading.Event()
+        
+        # With MongoDB down, skip the startup reads instead of waiting out the
+        # server selection timeout in each of them; caches and the scheduler
+        # load in the background and provisioning waits for the database
+        self.mongodb_available = self._ping(mongodb_uri)
         
         # Collections
         self.devices = self.db.devices
         self.commands = self.db.commands
         self.telemetry = self.db.telemetry
         self.scenes = self.db.scenes
+        self.groups = self.db.groups
         self.schedules = self.db.schedules
         
         # Active bulb connections
         self.active_bulbs = {}
         
+        # CIDRs to sweep for bulbs (None = subnets from the shared network context)
+        self.discovery_subnets = discovery_subnets
+        
+        # Command logs, last_seen, device upserts and scene, group and schedule
+        # edits are written in the background, and journaled to disk while
+        # MongoDB is unavailable
+        self.writer = MongoWriteBehind(self.commands, self.devices, journal=journal)
+        
+        # Known bulb addresses survive restarts via MongoDB and a local mirror
+        self.address_index = DeviceAddressIndex(self.devices, index_path, writer=self.writer).load(
+            merge=self.mongodb_available)
+        for entry in self.address_index.entries():
+            if entry.ip:
+                self.active_bulbs[entry.uuid] = {
+                    "ip": entry.ip,
+                    "last_command": None,
+                    "last_response": None
+                }
+        
+        # Bulbs registered with the emulator or rescue server (any process)
+        self.registry = get_registry()
+        
+        # Shared UDP socket for all bulb traffic
+        self.transport = get_transport()
+        
+        # Per-bulb queue: coalesces repeated commands and caps the send rate
+        self.command_queue = CommandQueue(self.transport, self._send_now, rate=command_rate)
+        
+        # Last-known bulb attributes, updated from every command reply
+        self.state_cache = DeviceStateCache(ttl=state_ttl)
+        
+        # Optional local MQTT broker: push commands to connected bulbs and
+        # take their state reports instead of polling over UDP
+        self.mqtt = mqtt_broker
+        if self.mqtt is not None:
+            self.mqtt.start()
+            self.mqtt.add_status_listener(self.state_cache.merge)
+        
+        # Scenes compiled to ready-to-send plans; kept current via change streams
+        self.scene_cache = SceneCache(self.scenes, self._bulb_ip).start(warm=self.mongodb_available)
+        # Group memberships, the same way: no MongoDB read per group command
+        self.group_cache = SceneCache(self.groups, self._bulb_ip, compile=compile_group).start(
+            warm=self.mongodb_available)
+        
         # Start background discovery
         self.discovery_thread = threading.Thread(target=self._discover_bulbs, daemon=True)
         self.discovery_thread.start()
+        
+        # Fire documents in the schedules collection in-process
+        self.scheduler = None
+        if run_scheduler:
+            self.scheduler = Scheduler(self.schedules, self._run_schedule_action).start(
+                load=self.mongodb_available)
+        
+        # Indexes and retention TTLs, plus the telemetry store: now, or once
+        # MongoDB is reachable
+        self.indexes = None
+        self.telemetry_store = None
+        self.telemetry_collector = None
+        provisioning = (command_retention_days, telemetry_retention_days, telemetry_interval)
+        if self.mongodb_available:
+            self._provision(*provisioning)
+        else:
+            threading.Thread(target=self._provision_when_available, args=provisioning,
+                             name="sengled-provision", daemon=True).start()
+        
+        # Optional Prometheus listener for /metrics (the rescue server has /api/metrics)
+        self.metrics_server = None
+        if metrics_port is not None:
+            self.metrics_server = start_metrics_server(metrics_port)
+            print(f"📈 Metrics on http://0.0.0.0:{metrics_port}/metrics")
+    
+    @staticmethod
+    def _ping(mongodb_uri):
+        """One short check that MongoDB answers at all"""
+        client = MongoClient(mongodb_uri, serverSelectionTimeoutMS=STARTUP_PING_TIMEOUT_MS)
+        try:
+            client.admin.command("ping")
+            return True
+        except PyMongoError as e:
+            print(f"⚠️  MongoDB unavailable, deferring startup reads: {e}")
+            return False
+        finally:
+            client.close()
+    
+    def _provision(self, command_retention_days, telemetry_retention_days, telemetry_interval):
+        """Create indexes and the telemetry store; False if MongoDB is unavailable"""
+        # Unique lookup keys, the command history index and retention TTLs
+        try:
+            self.indexes = ensure_indexes(self.db, command_retention_days)
+        except PyMongoError as e:
+            print(f"Index provisioning skipped (MongoDB unavailable): {e}")
+            return False
+        
+        # Periodic state samples in a time-series collection, rolled up hourly/daily;
+        # polling is opt-in (telemetry_interval), the store always answers history
+        try:
+            self.telemetry_store = TelemetryStore(
+                self.db, self.telemetry.name,
+                raw_retention=int(telemetry_retention_days * 86400) if telemetry_retention_days else None
+            )
+        except PyMongoError as e:
+            print(f"Telemetry disabled (MongoDB unavailable): {e}")
+            return False
+        if telemetry_interval:
+            self.telemetry_collector = TelemetryCollector(
+                self.telemetry_store, self.transport,
+                lambda: {uuid: bulb["ip"] for uuid, bulb in list(self.active_bulbs.items())},
+                interval=telemetry_interval,
+                on_reply=lambda device_uuid, reply: self.state_cache.update(device_uuid, GET_DEVICE_INFO, reply)
+            ).start()
+        return True
+    
+    def _provision_when_available(self, *provisioning):
+        """Background thread: provision once MongoDB comes back"""
+        while not self._closed.wait(PROVISION_RETRY_INTERVAL):
+            try:
+                self.client.admin.command("ping")
+            except PyMongoError:
+                continue
+            if self._provision(*provisioning):
+                self.mongodb_available = True
+                print("✅ MongoDB reachable again; indexes and telemetry provisioned")
+                return
     
     def _discover_bulbs(self):
         """Background thread to discover and register bulbs"""
         while True:
             try:
-                # Check for newly registered devices from cloud emulator
-                for device_uuid, device_info in registered_devices.items():
-                    if device_uuid not in self.active_bulbs:
-                        # Try to find the bulb on the network
-                        bulb_ip = self._find_bulb_ip(device_uuid)
-                        if bulb_ip:
-                            self._register_discovered_bulb(device_uuid, bulb_ip, device_info)
+                neighbours = read_neighbours()
+                
+                # Re-verify only the bulbs whose MAC moved to a new IP
+                self._reverify_moved_bulbs(neighbours)
+                
+                # Check for newly registered devices from the cloud emulator/rescue server
+                self.registry.sync()
+                pending = {device_uuid: record.to_document()
+                           for device_uuid, record in self.registry.snapshot().items()
+                           if device_uuid not in self.active_bulbs}
+                if pending:
+                    self._resolve_bulbs(pending, neighbours)
                 
                 time.sleep(30)  # Check every 30 seconds
                 
@@ -44,61 +209,71 @@ class SengledMongoDBSystem:
                 print(f"Discovery error: {e}")
                 time.sleep(60)
     
-    def _find_bulb_ip(self, device_uuid):
-        """Scan local network for bulb with specific UUID"""
-        # Network scanning logic here
-        # This is a simplified version - in practice you'd scan the subnet
+    def _reverify_moved_bulbs(self, neighbours):
+        """Follow bulbs that DHCP moved to a new address"""
+        for entry, new_ip in self.address_index.moved(neighbours):
+            if self._test_bulb_connection(new_ip, entry.uuid):
+                print(f"🔀 Bulb {entry.uuid} moved {entry.ip} -> {new_ip}")
+                self.address_index.record(entry.uuid, new_ip, entry.mac)
+                self.active_bulbs.setdefault(entry.uuid, {
+                    "last_command": None,
+                    "last_response": None
+                })["ip"] = new_ip
+                self.scene_cache.invalidate_device(entry.uuid)
+    
+    def _resolve_bulbs(self, pending, neighbours):
+        """Find pending UUIDs from the neighbour table, else one subnet sweep"""
+        mac_to_ip = {mac: ip for ip, mac in neighbours.items()}
+        for device_uuid, device_info in list(pending.items()):
+            ip = mac_to_ip.get(normalize_mac(device_uuid))
+            if ip and self._test_bulb_connection(ip, device_uuid):
+                self._register_discovered_bulb(device_uuid, ip, device_info, mac=normalize_mac(device_uuid))
+                del pending[device_uuid]
+        if not pending:
+            return
         
-        import subprocess
-        import re
+        found = discover(self.discovery_subnets, transport=self.transport)
         
-        try:
-            # Get network range
-            result = subprocess.run(['ip', 'route'], capture_output=True, text=True)
-            for line in result.stdout.split('\n'):
-                if 'src' in line and '192.168' in line:
-                    # Extract network range
-                    network = re.search(r'192\.168\.\d+\.0/24', line)
-                    if network:
-                        # Scan for bulbs on port 9080
-                        for i in range(2, 255):
-                            ip = f"192.168.1.{i}"  # Adjust for your network
-                            if self._test_bulb_connection(ip, device_uuid):
-                                return ip
-        except Exception as e:
-            print(f"Network scan error: {e}")
+        by_uuid = {}
+        for bulb in found.values():
+            if bulb.uuid:
+                by_uuid[bulb.uuid] = bulb
+            if bulb.mac:
+                by_uuid.setdefault(bulb.mac, bulb)
         
-        return None
+        for device_uuid, device_info in pending.items():
+            bulb = by_uuid.get(device_uuid) or by_uuid.get(normalize_mac(device_uuid))
+            if bulb is None:
+                # Fall back to the address the bulb registered with the cloud from,
+                # unless whatever answers there is some other device
+                bulb = found.get(device_info.get('ip'))
+                if bulb is not None and (bulb.uuid or bulb.mac):
+                    bulb = None
+            if bulb:
+                self._register_discovered_bulb(device_uuid, bulb.ip, device_info,
+                                               mac=bulb.mac or neighbours.get(bulb.ip))
     
     def _test_bulb_connection(self, ip, expected_uuid):
-        """Test if IP has a Sengled bulb with expected UUID"""
+        """Test if IP has a Sengled bulb with expected UUID (or MAC)"""
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.settimeout(2)
+            message = json.dumps(GET_DEVICE_INFO).encode('utf-8')
+            # Neighbour-table hosts are often not bulbs: probe without recording them
+            response = self.transport.request_sync(ip, message, probe=True)
+            uuid, mac, info = identify_reply(response)
             
-            command = {"func": "get_device_info", "param": {}}
-            message = json.dumps(command).encode('utf-8')
-            sock.sendto(message, (ip, 9080))
-            
-            response, addr = sock.recvfrom(1024)
-            data = json.loads(response.decode('utf-8'))
-            
-            # Check if this is our bulb (you'd need to match UUID somehow)
-            # This is simplified - real implementation would need MAC mapping
-            return True
+            # Anything answering on 9080 without naming the expected bulb is not it
+            return (uuid is not None and uuid == expected_uuid) or \
+                (mac is not None and mac in (expected_uuid, normalize_mac(expected_uuid)))
             
         except:
             return False
-        finally:
-            sock.close()
     
-    def _register_discovered_bulb(self, device_uuid, ip, cloud_info):
+    def _register_discovered_bulb(self, device_uuid, ip, cloud_info, mac=None):
         """Register a discovered bulb in MongoDB"""
         
         bulb_doc = {
             "device_uuid": device_uuid,
             "ip_address": ip,
-            "mac_address": device_uuid,  # Often the same for Sengled
             "discovered_at": datetime.now(timezone.utc),
             "last_seen": datetime.now(timezone.utc),
             "cloud_registration": cloud_info,
@@ -111,108 +286,363 @@ class SengledMongoDBSystem:
             }
         }
         
-        self.devices.update_one(
-            {"device_uuid": device_uuid},
-            {"$set": bulb_doc},
-            upsert=True
-        )
+        # Queued, so discovery never waits on MongoDB
+        self.writer.upsert_device(device_uuid, bulb_doc)
+        
+        # mac_address and last_verified are maintained by the address index
+        self.address_index.record(device_uuid, ip, mac)
         
         self.active_bulbs[device_uuid] = {
             "ip": ip,
             "last_command": None,
             "last_response": None
         }
+        self.scene_cache.invalidate_device(device_uuid)
         
         print(f"✅ Registered bulb {device_uuid} at {ip}")
     
     def send_command_to_bulb(self, device_uuid, command):
-        """Send UDP command to specific bulb and log to MongoDB"""
+        """Send command to specific bulb (MQTT push if connected, else UDP) and log to MongoDB.
         
-        if device_uuid not in self.active_bulbs:
-            return {"error": "Bulb not found"}
+        Commands go through the bulb's command queue: a newer command with the
+        same func replaces one still waiting, and superseded callers get the
+        result of the command that was actually sent.
+        """
+        return self.command_queue.send_sync(device_uuid, command)
+    
+    async def _send_now(self, device_uuid, command, prepared=None):
+        """Deliver one command right away (runs on the transport loop).
         
-        bulb_info = self.active_bulbs[device_uuid]
+        prepared is an (ip, payload bytes) pair resolved and encoded ahead of
+        time (compiled scenes); otherwise the address is looked up and the
+        command encoded here.
+        """
+        if self.mqtt is not None:
+            result = await self._push_command(device_uuid, command)
+            if result is not None:
+                return result
         
+        if prepared is not None:
+            ip, payload = prepared
+        elif device_uuid in self.active_bulbs:
+            ip, payload = self.active_bulbs[device_uuid]["ip"], command
+        else:
+            return {"error": "Bulb not found"}
+        
+        started = time.monotonic()
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.settimeout(5)
-            
-            message = json.dumps(command).encode('utf-8')
-            sock.sendto(message, (bulb_info["ip"], 9080))
-            
-            response, addr = sock.recvfrom(1024)
-            result = json.loads(response.decode('utf-8'))
-            
-            # Log to MongoDB
-            command_doc = {
-                "device_uuid": device_uuid,
-                "timestamp": datetime.now(timezone.utc),
-                "command": command,
-                "response": result,
-                "success": "error" not in result,
-                "ip_address": bulb_info["ip"]
-            }
-            
-            self.commands.insert_one(command_doc)
-            
-            # Update device last_seen
-            self.devices.update_one(
-                {"device_uuid": device_uuid},
-                {"$set": {"last_seen": datetime.now(timezone.utc)}}
-            )
-            
+            # send_command passes pre-encoded bytes through untouched
+            result = await self.transport.send_command(ip, payload)
+            self._log_command(device_uuid, ip, command, result, time.monotonic() - started)
+            self.state_cache.update(device_uuid, command, result)
             return result
             
         except Exception as e:
-            error_doc = {
-                "device_uuid": device_uuid,
-                "timestamp": datetime.now(timezone.utc),
-                "command": command,
-                "error": str(e),
-                "success": False,
-                "ip_address": bulb_info["ip"]
-            }
-            self.commands.insert_one(error_doc)
+            self._log_command(device_uuid, ip, command, e, time.monotonic() - started)
             return {"error": str(e)}
-        finally:
-            sock.close()
     
-    def execute_scene(self, scene_name):
-        """Execute a scene from MongoDB"""
-        scene = self.scenes.find_one({"name": scene_name})
-        if not scene:
+    async def _push_command(self, device_uuid, command):
+        """Push a set_device_* command over MQTT; None if it has to go over UDP"""
+        attributes = updates_from_command(command)
+        if attributes is None or not self.mqtt.is_connected(device_uuid):
+            return None
+        
+        started = time.monotonic()
+        if not await self.mqtt.send_updates_async(device_uuid, attributes):
+            return None
+        result = {"result": {"ret": 0}, "via": "mqtt"}
+        
+        ip = self.active_bulbs.get(device_uuid, {}).get("ip")
+        self._log_command(device_uuid, ip, command, result, time.monotonic() - started)
+        self.state_cache.update(device_uuid, command, result)
+        return result
+    
+    def _log_command(self, device_uuid, ip, command, result, latency=None):
+        """Queue a command outcome (bulb reply or exception) for MongoDB"""
+        command_doc = {
+            "device_uuid": device_uuid,
+            "timestamp": datetime.now(timezone.utc),
+            "command": command,
+            "ip_address": ip
+        }
+        if latency is not None:
+            command_doc["latency_ms"] = round(latency * 1000, 2)
+            COMMAND_LATENCY.labels(command.get("func", "unknown")).observe(latency)
+        
+        if isinstance(result, Exception):
+            command_doc["error"] = str(result)
+            command_doc["success"] = False
+            reason = "timeout" if isinstance(result, socket.timeout) else "error"
+            COMMAND_ERRORS.labels(device_uuid, reason).inc()
+            self.writer.log_command(command_doc)
+            return
+        
+        command_doc["response"] = result
+        command_doc["success"] = not (isinstance(result, dict) and "error" in result)
+        if not command_doc["success"]:
+            COMMAND_ERRORS.labels(device_uuid, "rejected").inc()
+        self.writer.log_command(command_doc)
+        
+        # Update device last_seen
+        self.writer.touch_device(device_uuid, command_doc["timestamp"])
+    
+    def execute_scene(self, scene_name, deadline=SCENE_DEADLINE):
+        """Execute a scene from MongoDB.
+        
+        All actions are queued at once and share one deadline, so the whole room
+        switches within a single round-trip. They go through each bulb's command
+        queue like single commands (pacing, coalescing, MQTT push), carrying the
+        address and bytes prepared when the scene was compiled. Each per-device
+        result carries its own latency_ms so slow bulbs are easy to spot.
+        """
+        try:
+            plan = self.scene_cache.get(scene_name)
+        except PyMongoError as e:
+            return {"error": f"Scenes unavailable: {e}"}
+        if plan is None:
             return {"error": f"Scene '{scene_name}' not found"}
         
-        results = {}
-        for action in scene.get("actions", []):
-            device_uuid = action["device_uuid"]
-            command = action["command"]
-            
-            result = self.send_command_to_bulb(device_uuid, command)
-            results[device_uuid] = result
+        results = {device_uuid: {"error": "Bulb not found", "latency_ms": 0.0} for device_uuid in plan.missing}
+        
+        # Logging and the state cache are handled by _send_now
+        items = []
+        for key, ip, payload in plan.targets:
+            device_uuid, command = plan.actions[key]
+            items.append((device_uuid, command, (ip, payload)))
+        outcomes = self.command_queue.send_many_sync(items, timeout=deadline)
+        
+        for device_uuid, (result, latency) in outcomes.items():
+            results[device_uuid] = self._result_entry(result, latency)
         
         return results
     
-    def get_device_status(self, device_uuid):
-        """Get current status of a device"""
-        command = {"func": "get_device_info", "param": {}}
-        return self.send_command_to_bulb(device_uuid, command)
+    @staticmethod
+    def _result_entry(result, latency):
+        """A per-bulb result with its latency_ms (bulbs may reply with non-objects)"""
+        if isinstance(result, Exception):
+            result = {"error": str(result) or type(result).__name__}
+        elif not isinstance(result, dict):
+            result = {"response": result}
+        return dict(result, latency_ms=round(latency * 1000, 2))
+    
+    def create_group(self, group_name, device_uuids):
+        """Create or replace a named group of bulbs in MongoDB"""
+        now = datetime.now(timezone.utc)
+        group_doc = {"name": group_name, "members": list(dict.fromkeys(device_uuids)), "updated_at": now}
+        # Written behind (and journaled while MongoDB is down); the cache serves it now
+        self.writer.upsert(
+            self.groups.name,
+            {"name": group_name},
+            {"$set": group_doc,
+             "$setOnInsert": {"created_at": now}}
+        )
+        self.group_cache.put(group_doc)
+        
+        return {"success": True}
+    
+    def delete_group(self, group_name):
+        # Through the writer too, so it cannot overtake a journaled create_group
+        self.writer.delete(self.groups.name, {"name": group_name})
+        return {"success": self.group_cache.discard(group_name)}
+    
+    def list_groups(self):
+        return list(self.groups.find({}, {"_id": 0}))
+    
+    def execute_group_command(self, group_name, command, deadline=SCENE_DEADLINE, broadcast=False):
+        """Send one command to every bulb in a MongoDB group"""
+        try:
+            group = self.group_cache.get(group_name)
+        except PyMongoError as e:
+            return {"error": f"Groups unavailable: {e}"}
+        if group is None:
+            return {"error": f"Group '{group_name}' not found"}
+        
+        result = self.send_group_command(group.members, command, deadline, broadcast)
+        result["group"] = group_name
+        return result
+    
+    def send_group_command(self, device_uuids, command, deadline=SCENE_DEADLINE, broadcast=False):
+        """Send one command to many bulbs at once and aggregate the replies.
+        
+        Every member's command goes through its command queue like a single
+        command (pacing, coalescing, MQTT push), all in flight together.
+        broadcast=True sends one subnet broadcast instead when every member
+        sits on one local segment, the group holds every known bulb there (so
+        nothing else switches) and none of them is on MQTT; that bypasses the
+        queues. Bulbs that miss the deadline are listed as stragglers.
+        """
+        started = time.perf_counter()
+        device_uuids = list(dict.fromkeys(device_uuids))
+        results = {}
+        stragglers = []
+        
+        address = self._group_broadcast_address(device_uuids) if broadcast else None
+        if address is not None:
+            mode = "broadcast"
+            members = {device_uuid: self.active_bulbs[device_uuid]["ip"] for device_uuid in device_uuids}
+            by_ip = self.transport.broadcast_sync(command, address, set(members.values()), timeout=deadline)
+            outcomes = {}
+            for device_uuid, ip in members.items():
+                result, latency = outcomes[device_uuid] = by_ip[ip]
+                self._log_command(device_uuid, ip, command, result, latency)
+                if not isinstance(result, Exception):
+                    self.state_cache.update(device_uuid, command, result)
+        else:
+            mode = "unicast"
+            # Logging and the state cache are handled by _send_now
+            outcomes = self.command_queue.send_many_sync(
+                [(device_uuid, command) for device_uuid in device_uuids], timeout=deadline)
+        
+        for device_uuid, (result, latency) in outcomes.items():
+            if isinstance(result, socket.timeout):
+                stragglers.append(device_uuid)
+            results[device_uuid] = self._result_entry(result, latency)
+        
+        succeeded = sum(1 for result in results.values() if "error" not in result)
+        return {
+            "mode": mode,
+            "total": len(results),
+            "succeeded": succeeded,
+            "failed": len(results) - succeeded,
+            "stragglers": stragglers,
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 2),
+            "results": results
+        }
+    
+    def _group_broadcast_address(self, device_uuids):
+        """Broadcast address that reaches exactly these bulbs, or None"""
+        if len(device_uuids) < 2 or any(uuid not in self.active_bulbs for uuid in device_uuids):
+            return None
+        if self.mqtt is not None and any(self.mqtt.is_connected(uuid) for uuid in device_uuids):
+            # Those take commands over MQTT, through their queues
+            return None
+        members = {uuid: self.active_bulbs[uuid]["ip"] for uuid in device_uuids}
+        addresses = [ipaddress.ip_address(ip) for ip in members.values()]
+        for iface in get_network_context().snapshot.interfaces:
+            network = iface.network
+            if network.prefixlen >= 31 or not all(address in network for address in addresses):
+                continue
+            # Every known bulb on the segment must be in the group
+            others = [uuid for uuid, bulb in list(self.active_bulbs.items())
+                      if uuid not in members and ipaddress.ip_address(bulb["ip"]) in network]
+            return None if others else str(network.broadcast_address)
+        return None
+    
+    def get_device_status(self, device_uuid, max_age=None, force_refresh=False):
+        """Get current status of a device.
+        
+        Served from the state cache when the entry is younger than max_age
+        (default: the cache TTL). Stale entries are returned as-is while a
+        background refresh goes out; force_refresh always asks the bulb.
+        """
+        if device_uuid not in self.active_bulbs:
+            return {"error": "Bulb not found"}
+        
+        if not force_refresh:
+            state = self.state_cache.get(device_uuid)
+            if state is not None:
+                if not self.state_cache.is_fresh(state, max_age):
+                    self._refresh_state(device_uuid)
+                return {
+                    "result": dict(state.attributes, ret=0),
+                    "cached": True,
+                    "age": round(state.age, 3)
+                }
+        
+        return self.send_command_to_bulb(device_uuid, GET_DEVICE_INFO)
+    
+    def _bulb_ip(self, device_uuid):
+        bulb = self.active_bulbs.get(device_uuid)
+        return bulb["ip"] if bulb else None
+    
+    def _refresh_state(self, device_uuid):
+        """Refresh a device's cached state without blocking the caller"""
+        ip = self.active_bulbs[device_uuid]["ip"]
+        self.state_cache.refresh_in_background(
+            self.transport, device_uuid, ip,
+            callback=lambda result: self._log_command(device_uuid, ip, GET_DEVICE_INFO, result)
+        )
     
     def create_scene(self, scene_name, actions):
         """Create a new scene in MongoDB"""
+        now = datetime.now(timezone.utc)
         scene_doc = {
             "name": scene_name,
             "actions": actions,
-            "created_at": datetime.now(timezone.utc)
+            "created_at": now,
+            "updated_at": now
         }
         
-        self.scenes.update_one(
-            {"name": scene_name},
-            {"$set": scene_doc},
-            upsert=True
+        # Written behind (and journaled while MongoDB is down); the cache serves it now
+        self.writer.upsert(self.scenes.name, {"name": scene_name}, {"$set": scene_doc})
+        self.scene_cache.put(scene_doc)
+        
+        return {"success": True}
+    
+    def command_history(self, device_uuid, cursor=None, limit=DEFAULT_HISTORY_LIMIT, since=None, until=None):
+        """A page of a bulb's command log, newest first; pass next_cursor back for the next page"""
+        return command_history(self.commands, device_uuid, cursor, limit, since, until)
+    
+    def telemetry_history(self, device_uuid, start, end=None, resolution="auto"):
+        """State history of a bulb: raw samples, or hourly/daily rollups for long ranges"""
+        if self.telemetry_store is None:
+            return {"error": "Telemetry is unavailable"}
+        return self.telemetry_store.history(device_uuid, start, end, resolution)
+    
+    def create_schedule(self, schedule_name, action, **timing):
+        """Create or replace a schedule in MongoDB.
+        
+        timing holds cron (with optional tz), sun (with latitude, longitude and
+        offset_minutes) or at, plus optional missed and misfire_grace. The
+        running scheduler picks the change up on its own.
+        """
+        schedule_doc = dict(timing, name=schedule_name, action=action)
+        schedule_doc.setdefault("enabled", True)
+        try:
+            build_spec(schedule_doc)
+        except (ValueError, KeyError) as e:
+            return {"error": f"Invalid schedule: {e}"}
+        
+        now = datetime.now(timezone.utc)
+        schedule_doc["updated_at"] = now
+        # Written behind (and journaled while MongoDB is down); the scheduler
+        # picks it up from MongoDB once written
+        self.writer.upsert(
+            self.schedules.name,
+            {"name": schedule_name},
+            {"$set": schedule_doc, "$setOnInsert": {"created_at": now}}
         )
         
         return {"success": True}
+    
+    def delete_schedule(self, schedule_name):
+        """Delete a schedule; queued behind any earlier create_schedule"""
+        self.writer.delete(self.schedules.name, {"name": schedule_name})
+        return {"success": True}
+    
+    def _run_schedule_action(self, action):
+        """Run the action of a fired schedule"""
+        if action.get("scene"):
+            return self.execute_scene(action["scene"])
+        if action.get("group") and action.get("command"):
+            return self.execute_group_command(action["group"], action["command"])
+        if action.get("device_uuid") and action.get("command"):
+            return self.send_command_to_bulb(action["device_uuid"], action["command"])
+        return {"error": f"Unknown schedule action: {action}"}
+    
+    def close(self):
+        """Flush pending MongoDB writes and disconnect"""
+        self._closed.set()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        if self.telemetry_collector is not None:
+            self.telemetry_collector.stop()
+        self.scene_cache.stop()
+        self.group_cache.stop()
+        self.writer.close()
+        self.client.close()
 
 # Example usage
 if __name__ == "__main__":
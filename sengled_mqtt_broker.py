@@ -0,0 +1,946 @@
+#!/usr/bin/env python3
+"""
+Sengled Local MQTT Broker
+=========================
+Embedded stand-in for the MQTT service the bimqtt balancer points bulbs at.
+
+Both cloud servers tell bulbs to connect to port 1883 and ws://<ip>:9001/mqtt.
+This broker listens there (MQTT 3.1.1 over TCP and over WebSocket), holds
+the bulbs' persistent connections, and lets the control layer push commands
+to a bulb and receive its state changes instead of polling it over UDP.
+
+Sengled Wi-Fi bulbs use the MAC address as client ID and device UUID:
+
+- commands:  wifielement/<mac>/update  [{"dn": mac, "type": "switch", "value": "1", "time": ms}]
+- state:     wifielement/<mac>/status  (same list format)
+
+Memory per connection is bounded: packets and WebSocket frames larger than
+max_packet_size (64 KiB unless configured, plenty for Sengled payloads)
+close the connection, WebSocket frames are only read as fast as the MQTT
+parser consumes them, a subscriber whose unsent output passes max_buffer
+has further messages dropped until it catches up, and QoS 1 deliveries
+nobody acknowledges are forgotten after ACK_TIMEOUT. At most
+MAX_RETAINED topics keep a retained message.
+
+Usage:
+    python3 sengled_mqtt_broker.py serve                 # broker only
+    python3 sengled_mqtt_broker.py simulate --bulbs 50   # simulated bulbs against a broker
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+
+from sengled_state_cache import PARAM_ATTRIBUTES
+
+MQTT_PORT = 1883
+WS_PORT = 9001
+WS_PATH = "/mqtt"
+DEFAULT_TIMEOUT = 2
+# Unacknowledged QoS 1 deliveries are given up after this many seconds
+ACK_TIMEOUT = DEFAULT_TIMEOUT * 5
+
+# Default packet size limit; Sengled status and command payloads are far smaller
+MAX_PACKET_SIZE = 64 * 1024
+# Largest remaining length MQTT can encode (max_packet_size=PROTOCOL_MAX_PACKET_SIZE)
+PROTOCOL_MAX_PACKET_SIZE = 268435455
+# Topics holding a retained message; retains to further topics are not kept
+MAX_RETAINED = 10000
+# Unsent bytes per subscriber before messages to it are dropped
+MAX_SESSION_BUFFER = 1024 * 1024
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+MAX_HANDSHAKE = 16 * 1024
+
+# Control packet types
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+PUBREC, PUBREL, PUBCOMP = 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+
+# ----------------------------------------------------------------------
+# Sengled topics and payloads
+# ----------------------------------------------------------------------
+
+def command_topic(mac):
+    return f"wifielement/{mac}/update"
+
+
+def status_topic(mac):
+    return f"wifielement/{mac}/status"
+
+
+def encode_updates(mac, attributes):
+    """Sengled update/status payload for a {type: value} dict"""
+    now_ms = int(time.time() * 1000)
+    return json.dumps([{"dn": mac, "type": key, "value": str(value), "time": now_ms}
+                       for key, value in attributes.items()]).encode('utf-8')
+
+
+def parse_updates(payload):
+    """{type: value} from a Sengled update/status payload (numbers as ints)"""
+    try:
+        items = json.loads(payload)
+    except ValueError:
+        return {}
+    if isinstance(items, dict):
+        items = [items]
+    attributes = {}
+    for item in items if isinstance(items, list) else ():
+        if isinstance(item, dict) and "type" in item:
+            value = item.get("value")
+            if isinstance(value, str) and value.lstrip("-").isdigit():
+                value = int(value)
+            attributes[item["type"]] = value
+    return attributes
+
+
+def updates_from_command(command):
+    """Attributes a set_device_* UDP command sets, or None if it cannot be pushed"""
+    func = command.get("func", "") if isinstance(command, dict) else ""
+    if not func.startswith("set_device_"):
+        return None
+    params = command.get("param") or {}
+    return {PARAM_ATTRIBUTES.get(key, key): value for key, value in params.items()} or None
+
+
+def topic_matches(topic_filter, topic):
+    """MQTT topic filter match with + and # wildcards"""
+    filter_parts = topic_filter.split("/")
+    topic_parts = topic.split("/")
+    for index, part in enumerate(filter_parts):
+        if part == "#":
+            return True
+        if index >= len(topic_parts) or (part != "+" and part != topic_parts[index]):
+            return False
+    return len(filter_parts) == len(topic_parts)
+
+
+# ----------------------------------------------------------------------
+# Packet codec
+# ----------------------------------------------------------------------
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def encode_string(value):
+    data = value.encode('utf-8') if isinstance(value, str) else value
+    return struct.pack("!H", len(data)) + data
+
+
+def decode_string(body, offset):
+    (length,) = struct.unpack_from("!H", body, offset)
+    start = offset + 2
+    return body[start:start + length].decode('utf-8'), start + length
+
+
+def packet(packet_type, body=b"", flags=0):
+    return bytes([packet_type << 4 | flags]) + encode_length(len(body)) + body
+
+
+def publish_packet(topic, payload, qos=0, retain=False, packet_id=None, dup=False):
+    flags = (0x8 if dup else 0) | (qos << 1) | (1 if retain else 0)
+    body = encode_string(topic)
+    if qos:
+        body += struct.pack("!H", packet_id)
+    return packet(PUBLISH, body + payload, flags)
+
+
+async def read_packet(reader, max_size=MAX_PACKET_SIZE):
+    """(type, flags, body) of the next control packet"""
+    first = (await reader.readexactly(1))[0]
+    length, multiplier = 0, 1
+    for _ in range(4):
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 0x7F) * multiplier
+        if not byte & 0x80:
+            break
+        multiplier *= 128
+    else:
+        raise ValueError("Malformed remaining length")
+    if length > max_size:
+        raise ValueError(f"Packet of {length} bytes exceeds {max_size}")
+    body = await reader.readexactly(length) if length else b""
+    return first >> 4, first & 0x0F, body
+
+
+def parse_publish(flags, body):
+    """(topic, payload, qos, retain, packet_id) of a PUBLISH body"""
+    qos = (flags >> 1) & 0x3
+    topic, offset = decode_string(body, 0)
+    packet_id = None
+    if qos:
+        (packet_id,) = struct.unpack_from("!H", body, offset)
+        offset += 2
+    return topic, body[offset:], qos, bool(flags & 0x1), packet_id
+
+
+# ----------------------------------------------------------------------
+# MQTT over WebSocket
+# ----------------------------------------------------------------------
+
+def encode_frame(opcode, payload, mask=False):
+    header = bytearray([0x80 | opcode])
+    mask_bit = 0x80 if mask else 0
+    length = len(payload)
+    if length < 126:
+        header.append(mask_bit | length)
+    elif length < 65536:
+        header.append(mask_bit | 126)
+        header += struct.pack("!H", length)
+    else:
+        header.append(mask_bit | 127)
+        header += struct.pack("!Q", length)
+    if mask:
+        key = os.urandom(4)
+        return bytes(header) + key + _apply_mask(payload, key)
+    return bytes(header) + payload
+
+
+def _apply_mask(data, key):
+    if not data:
+        return data
+    repeated = (key * (len(data) // 4 + 1))[:len(data)]
+    return (int.from_bytes(data, "big") ^ int.from_bytes(repeated, "big")).to_bytes(len(data), "big")
+
+
+async def read_frame(reader, max_size=MAX_PACKET_SIZE + 5):
+    """(opcode, payload) of the next WebSocket frame"""
+    first, second = await reader.readexactly(2)
+    length = second & 0x7F
+    if length == 126:
+        (length,) = struct.unpack("!H", await reader.readexactly(2))
+    elif length == 127:
+        (length,) = struct.unpack("!Q", await reader.readexactly(8))
+    if length > max_size:
+        raise ValueError(f"Frame of {length} bytes exceeds {max_size}")
+    key = await reader.readexactly(4) if second & 0x80 else None
+    payload = await reader.readexactly(length) if length else b""
+    if key is not None:
+        payload = _apply_mask(payload, key)
+    return first & 0x0F, payload
+
+
+class WebSocketStream:
+    """StreamReader/StreamWriter look-alike that wraps MQTT bytes in binary frames.
+
+    readexactly() unwraps frames on demand, so the MQTT code reads and writes
+    a WebSocket connection exactly like a TCP one. A frame is only read when
+    the parser needs more bytes: a client that floods frames fills the
+    socket buffer and gets TCP backpressure instead of growing our memory.
+    """
+
+    def __init__(self, reader, writer, mask=False, max_size=MAX_PACKET_SIZE):
+        self._reader = reader
+        self._writer = writer
+        self._mask = mask
+        # One MQTT packet per frame: remaining length plus at most 5 header bytes
+        self._max_frame = max_size + 5
+        self._buffer = bytearray()
+        self._eof = False
+        self.reader = self
+
+    async def readexactly(self, n):
+        while len(self._buffer) < n:
+            if self._eof:
+                partial = bytes(self._buffer)
+                self._buffer.clear()
+                raise asyncio.IncompleteReadError(partial, n)
+            await self._read_frame()
+        data = bytes(self._buffer[:n])
+        del self._buffer[:n]
+        return data
+
+    async def _read_frame(self):
+        try:
+            opcode, payload = await read_frame(self._reader, self._max_frame)
+        except ValueError:
+            # Oversized frame: drop the connection rather than buffer it
+            self._eof = True
+            self._writer.close()
+            return
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self._eof = True
+            return
+        if opcode in (0x0, 0x1, 0x2):
+            self._buffer += payload
+        elif opcode == 0x9:
+            self._writer.write(encode_frame(0xA, payload, self._mask))
+        elif opcode == 0x8:
+            if not self._writer.is_closing():
+                self._writer.write(encode_frame(0x8, payload[:2], self._mask))
+            self._eof = True
+
+    def write(self, data):
+        self._writer.write(encode_frame(0x2, data, self._mask))
+
+    async def drain(self):
+        await self._writer.drain()
+
+    def is_closing(self):
+        return self._writer.is_closing()
+
+    @property
+    def transport(self):
+        return self._writer.transport
+
+    def close(self):
+        if not self._writer.is_closing():
+            self._writer.write(encode_frame(0x8, struct.pack("!H", 1000), self._mask))
+        self._writer.close()
+
+    def get_extra_info(self, name, default=None):
+        return self._writer.get_extra_info(name, default)
+
+
+def _parse_http_head(head):
+    lines = head.decode('latin-1').split("\r\n")
+    request_line = lines[0].split()
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    return request_line, headers
+
+
+def websocket_accept(key):
+    return base64.b64encode(hashlib.sha1((key + WS_GUID).encode('ascii')).digest()).decode('ascii')
+
+
+# ----------------------------------------------------------------------
+# Broker
+# ----------------------------------------------------------------------
+
+class _Session:
+    __slots__ = ("client_id", "writer", "address", "subscriptions", "will",
+                 "next_packet_id", "inflight", "connected_at", "dropped")
+
+    def __init__(self, client_id, writer, address):
+        self.client_id = client_id
+        self.writer = writer
+        self.address = address
+        self.subscriptions = {}
+        self.will = None
+        self.next_packet_id = 0
+        self.inflight = {}
+        self.connected_at = time.time()
+        # Messages not sent because the client was not reading
+        self.dropped = 0
+
+    def packet_id(self):
+        self.next_packet_id = self.next_packet_id % 65535 + 1
+        return self.next_packet_id
+
+
+class MQTTBroker:
+    def __init__(self, host="0.0.0.0", port=MQTT_PORT, ws_port=WS_PORT, ws_path=WS_PATH,
+                 max_packet_size=MAX_PACKET_SIZE, max_buffer=MAX_SESSION_BUFFER):
+        self.host = host
+        self.port = port
+        self.ws_port = ws_port
+        self.ws_path = ws_path
+        self.max_packet_size = max_packet_size
+        self.max_buffer = max_buffer
+
+        self._loop = None
+        self._thread = None
+        self._servers = []
+        self._started = threading.Event()
+        self._start_lock = threading.Lock()
+        self._error = None
+
+        # client_id -> _Session
+        self._sessions = {}
+        # Exact topic -> {session: qos}; wildcard filters are scanned
+        self._exact = {}
+        self._wildcards = {}
+        self._retained = {}
+        # Callbacks for every message a client publishes
+        self._listeners = []
+
+        # Stats
+        self.dropped = 0
+        self.retained_dropped = 0
+
+    # ------------------------------------------------------------------
+    # Lifecycle
+    # ------------------------------------------------------------------
+
+    def start(self):
+        """Start the event loop thread and open the listeners"""
+        with self._start_lock:
+            if self._started.is_set():
+                return self
+            self._thread = threading.Thread(target=self._run_loop, name="sengled-mqtt", daemon=True)
+            self._thread.start()
+            self._started.wait()
+            if self._error is not None:
+                raise OSError(f"Could not start MQTT broker: {self._error}")
+        return self
+
+    def _run_loop(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._servers.append(self._loop.run_until_complete(
+                asyncio.start_server(self._handle_tcp, self.host, self.port)))
+            if self.ws_port is not None:
+                self._servers.append(self._loop.run_until_complete(
+                    asyncio.start_server(self._handle_websocket, self.host, self.ws_port)))
+        except Exception as e:
+            self._error = e
+            self._started.set()
+            return
+
+        self._started.set()
+        self._loop.run_forever()
+
+    def close(self):
+        """Disconnect every client and stop the event loop"""
+        if not self._started.is_set() or self._loop is None:
+            return
+        self._loop.call_soon_threadsafe(self._shutdown)
+        self._thread.join(timeout=5)
+        self._started.clear()
+
+    def _shutdown(self):
+        for server in self._servers:
+            server.close()
+        for session in list(self._sessions.values()):
+            session.writer.close()
+        self._loop.stop()
+
+    @property
+    def addresses(self):
+        """[(host, port)] of the TCP listener and, if enabled, the WebSocket one"""
+        self.start()
+        return [server.sockets[0].getsockname()[:2] for server in self._servers]
+
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the broker loop and block for its result"""
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result(timeout)
+
+    # ------------------------------------------------------------------
+    # Connections
+    # ------------------------------------------------------------------
+
+    async def _handle_tcp(self, reader, writer):
+        await self._serve(reader, writer)
+
+    async def _handle_websocket(self, reader, writer):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+        request_line, headers = _parse_http_head(head[:MAX_HANDSHAKE])
+        key = headers.get("sec-websocket-key")
+        path = request_line[1].split("?", 1)[0] if len(request_line) > 1 else ""
+        if path != self.ws_path or not key or headers.get("upgrade", "").lower() != "websocket":
+            writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            writer.close()
+            return
+
+        response = ("HTTP/1.1 101 Switching Protocols\r\n"
+                    "Upgrade: websocket\r\n"
+                    "Connection: Upgrade\r\n"
+                    f"Sec-WebSocket-Accept: {websocket_accept(key)}\r\n")
+        offered = [p.strip() for p in headers.get("sec-websocket-protocol", "").split(",") if p.strip()]
+        for protocol in ("mqtt", "mqttv3.1"):
+            if protocol in offered:
+                response += f"Sec-WebSocket-Protocol: {protocol}\r\n"
+                break
+        writer.write((response + "\r\n").encode('ascii'))
+
+        stream = WebSocketStream(reader, writer, max_size=self.max_packet_size)
+        await self._serve(stream.reader, stream)
+
+    async def _serve(self, reader, writer):
+        address = writer.get_extra_info("peername")
+        session = None
+        clean_exit = False
+        try:
+            packet_type, _, body = await asyncio.wait_for(read_packet(reader, self.max_packet_size), DEFAULT_TIMEOUT * 5)
+            if packet_type != CONNECT:
+                return
+            session, keepalive = self._connect(body, writer, address)
+            if session is None:
+                return
+            idle_timeout = keepalive * 1.5 if keepalive else None
+
+            while True:
+                packet_type, flags, body = await asyncio.wait_for(read_packet(reader, self.max_packet_size), idle_timeout)
+                if packet_type == PUBLISH:
+                    self._on_publish(session, flags, body)
+                elif packet_type == PUBACK:
+                    (packet_id,) = struct.unpack("!H", body[:2])
+                    future = session.inflight.pop(packet_id, None)
+                    if future is not None and not future.done():
+                        future.set_result(True)
+                elif packet_type == PUBREL:
+                    writer.write(packet(PUBCOMP, body[:2]))
+                elif packet_type == SUBSCRIBE:
+                    self._on_subscribe(session, body)
+                elif packet_type == UNSUBSCRIBE:
+                    self._on_unsubscribe(session, body)
+                elif packet_type == PINGREQ:
+                    writer.write(packet(PINGRESP))
+                elif packet_type == DISCONNECT:
+                    clean_exit = True
+                    return
+                # Stop reading from a client that does not read its own acks
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ValueError, struct.error):
+            pass
+        finally:
+            if session is not None:
+                self._disconnect(session, clean_exit)
+            writer.close()
+
+    def _connect(self, body, writer, address):
+        protocol, offset = decode_string(body, 0)
+        level, connect_flags, keepalive = struct.unpack_from("!BBH", body, offset)
+        offset += 4
+        if protocol not in ("MQTT", "MQIsdp") or level not in (3, 4):
+            writer.write(packet(CONNACK, b"\x00\x01"))
+            return None, 0
+
+        client_id, offset = decode_string(body, offset)
+        will = None
+        if connect_flags & 0x04:
+            will_topic, offset = decode_string(body, offset)
+            (length,) = struct.unpack_from("!H", body, offset)
+            will_payload = body[offset + 2:offset + 2 + length]
+            will = (will_topic, will_payload, (connect_flags >> 3) & 0x3, bool(connect_flags & 0x20))
+        if not client_id:
+            client_id = f"anon-{address[0]}:{address[1]}" if address else f"anon-{id(writer)}"
+
+        previous = self._sessions.get(client_id)
+        if previous is not None:
+            # Session takeover: the bulb reconnected before we noticed the old socket died
+            self._disconnect(previous, clean=True)
+            previous.writer.close()
+
+        session = _Session(client_id, writer, address)
+        session.will = will
+        self._sessions[client_id] = session
+        writer.write(packet(CONNACK, b"\x00\x00"))
+        return session, keepalive
+
+    def _disconnect(self, session, clean):
+        if self._sessions.get(session.client_id) is not session:
+            return
+        del self._sessions[session.client_id]
+        for topic_filter in list(session.subscriptions):
+            self._drop_subscription(session, topic_filter)
+        for future in session.inflight.values():
+            if not future.done():
+                future.set_result(False)
+        session.inflight.clear()
+        if not clean and session.will is not None:
+            topic, payload, qos, retain = session.will
+            self._route(topic, payload, qos, retain, session.client_id)
+
+    # ------------------------------------------------------------------
+    # Subscriptions
+    # ------------------------------------------------------------------
+
+    def _on_subscribe(self, session, body):
+        (packet_id,) = struct.unpack_from("!H", body, 0)
+        offset = 2
+        granted = bytearray()
+        new_filters = []
+        while offset < len(body):
+            topic_filter, offset = decode_string(body, offset)
+            qos = min(body[offset] & 0x3, 1)
+            offset += 1
+            session.subscriptions[topic_filter] = qos
+            table = self._wildcards if ("+" in topic_filter or "#" in topic_filter) else self._exact
+            table.setdefault(topic_filter, {})[session] = qos
+            granted.append(qos)
+            new_filters.append((topic_filter, qos))
+        session.writer.write(packet(SUBACK, struct.pack("!H", packet_id) + bytes(granted)))
+
+        for topic_filter, qos in new_filters:
+            for topic, (payload, retained_qos) in list(self._retained.items()):
+                if topic_matches(topic_filter, topic):
+                    self._deliver(session, topic, payload, min(qos, retained_qos), retain=True)
+
+    def _on_unsubscribe(self, session, body):
+        (packet_id,) = struct.unpack_from("!H", body, 0)
+        offset = 2
+        while offset < len(body):
+            topic_filter, offset = decode_string(body, offset)
+            self._drop_subscription(session, topic_filter)
+        session.writer.write(packet(UNSUBACK, struct.pack("!H", packet_id)))
+
+    def _drop_subscription(self, session, topic_filter):
+        session.subscriptions.pop(topic_filter, None)
+        for table in (self._exact, self._wildcards):
+            subscribers = table.get(topic_filter)
+            if subscribers is not None:
+                subscribers.pop(session, None)
+                if not subscribers:
+                    del table[topic_filter]
+
+    def _subscribers(self, topic):
+        """{session: qos} of everyone subscribed to topic"""
+        matched = dict(self._exact.get(topic, ()))
+        for topic_filter, subscribers in self._wildcards.items():
+            if topic_matches(topic_filter, topic):
+                for session, qos in subscribers.items():
+                    matched[session] = max(qos, matched.get(session, 0))
+        return matched
+
+    # ------------------------------------------------------------------
+    # Publishing
+    # ------------------------------------------------------------------
+
+    def _on_publish(self, session, flags, body):
+        topic, payload, qos, retain, packet_id = parse_publish(flags, body)
+        if qos == 1:
+            session.writer.write(packet(PUBACK, struct.pack("!H", packet_id)))
+        elif qos == 2:
+            session.writer.write(packet(PUBREC, struct.pack("!H", packet_id)))
+        self._route(topic, payload, min(qos, 1), retain, session.client_id)
+
+    def _route(self, topic, payload, qos, retain, sender):
+        """Deliver to subscribers and listeners; returns [ack futures] for QoS 1"""
+        if retain:
+            if payload:
+                if topic in self._retained or len(self._retained) < MAX_RETAINED:
+                    self._retained[topic] = (payload, qos)
+                else:
+                    # Every distinct topic would otherwise be kept forever
+                    self.retained_dropped += 1
+            else:
+                self._retained.pop(topic, None)
+
+        acks = []
+        for session, granted in self._subscribers(topic).items():
+            ack = self._deliver(session, topic, payload, min(qos, granted))
+            if ack is not None:
+                acks.append(ack)
+
+        for listener in list(self._listeners):
+            try:
+                listener(topic, payload, sender)
+            except Exception as e:
+                print(f"MQTT listener error: {e}")
+        return acks
+
+    def _deliver(self, session, topic, payload, qos, retain=False):
+        if session.writer.is_closing():
+            return None
+        if session.writer.transport.get_write_buffer_size() >= self.max_buffer:
+            # Slow subscriber: drop rather than buffer without bound
+            session.dropped += 1
+            self.dropped += 1
+            return None
+        if qos == 0:
+            session.writer.write(publish_packet(topic, payload, 0, retain))
+            return None
+        packet_id = session.packet_id()
+        future = self._loop.create_future()
+        session.inflight[packet_id] = future
+        expiry = self._loop.call_later(ACK_TIMEOUT, future.cancel)
+
+        def forget(_):
+            expiry.cancel()
+            if session.inflight.get(packet_id) is future:
+                del session.inflight[packet_id]
+
+        future.add_done_callback(forget)
+        session.writer.write(publish_packet(topic, payload, 1, retain, packet_id))
+        return future
+
+    async def publish_async(self, topic, payload, qos=0, retain=False, timeout=DEFAULT_TIMEOUT):
+        """Publish from the broker itself.
+
+        Returns how many subscribers got the message; for QoS 1 only those
+        that acknowledged it within timeout are counted.
+        """
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+
+        async def publish():
+            acks = self._route(topic, payload, qos, retain, None)
+            if qos == 0:
+                return len(self._subscribers(topic))
+            if not acks:
+                return 0
+            done, pending = await asyncio.wait(acks, timeout=timeout)
+            for future in pending:
+                # Frees the packet id; a late PUBACK is ignored
+                future.cancel()
+            return sum(1 for future in done if not future.cancelled() and future.result())
+
+        self.start()
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            return await publish()
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(publish(), self._loop))
+
+    def publish(self, topic, payload, qos=0, retain=False, timeout=DEFAULT_TIMEOUT):
+        """Blocking publish_async()"""
+        return self.run(self.publish_async(topic, payload, qos, retain, timeout))
+
+    # ------------------------------------------------------------------
+    # Sengled control
+    # ------------------------------------------------------------------
+
+    def is_connected(self, mac):
+        """Whether a bulb is connected and listening for commands"""
+        return bool(self._exact.get(command_topic(mac)))
+
+    def clients(self):
+        return list(self._sessions)
+
+    async def send_updates_async(self, mac, attributes, timeout=DEFAULT_TIMEOUT):
+        """Push attribute changes to a bulb; True once the bulb acknowledged them"""
+        return await self.publish_async(command_topic(mac), encode_updates(mac, attributes),
+                                        qos=1, timeout=timeout) > 0
+
+    def send_updates(self, mac, attributes, timeout=DEFAULT_TIMEOUT):
+        """Blocking send_updates_async()"""
+        return self.run(self.send_updates_async(mac, attributes, timeout))
+
+    def add_listener(self, callback):
+        """callback(topic, payload, client_id) for every published message (runs on the broker loop)"""
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        try:
+            self._listeners.remove(callback)
+        except ValueError:
+            pass
+
+    def add_status_listener(self, callback):
+        """callback(mac, attributes) whenever a bulb reports its state"""
+        def listener(topic, payload, client_id):
+            parts = topic.split("/")
+            if len(parts) == 3 and parts[0] == "wifielement" and parts[2] == "status":
+                attributes = parse_updates(payload)
+                if attributes:
+                    callback(parts[1], attributes)
+
+        self.add_listener(listener)
+        return listener
+
+
+_shared_broker = None
+_shared_lock = threading.Lock()
+
+
+def get_broker():
+    """Return the process-wide broker (ports from SENGLED_MQTT_PORT/SENGLED_MQTT_WS_PORT,
+    packet size limit from SENGLED_MQTT_MAX_PACKET)"""
+    global _shared_broker
+    with _shared_lock:
+        if _shared_broker is None:
+            _shared_broker = MQTTBroker(
+                port=int(os.environ.get("SENGLED_MQTT_PORT", MQTT_PORT)),
+                ws_port=int(os.environ.get("SENGLED_MQTT_WS_PORT", WS_PORT)),
+                max_packet_size=int(os.environ.get("SENGLED_MQTT_MAX_PACKET", MAX_PACKET_SIZE)),
+            )
+        return _shared_broker
+
+
+# ----------------------------------------------------------------------
+# Client (simulated bulbs and tests)
+# ----------------------------------------------------------------------
+
+class MQTTClient:
+    """Minimal asyncio MQTT 3.1.1 client, over TCP or WebSocket"""
+
+    def __init__(self, client_id, host="127.0.0.1", port=MQTT_PORT, keepalive=60,
+                 websocket_path=None, will=None):
+        self.client_id = client_id
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.websocket_path = websocket_path
+        self.will = will
+        self.messages = asyncio.Queue()
+
+        self._writer = None
+        self._tasks = []
+        self._acks = {}
+        self._next_packet_id = 0
+
+    def _packet_id(self):
+        self._next_packet_id = self._next_packet_id % 65535 + 1
+        return self._next_packet_id
+
+    async def connect(self, timeout=DEFAULT_TIMEOUT * 5):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        if self.websocket_path:
+            key = base64.b64encode(os.urandom(16)).decode('ascii')
+            writer.write((f"GET {self.websocket_path} HTTP/1.1\r\n"
+                          f"Host: {self.host}:{self.port}\r\n"
+                          "Upgrade: websocket\r\n"
+                          "Connection: Upgrade\r\n"
+                          f"Sec-WebSocket-Key: {key}\r\n"
+                          "Sec-WebSocket-Version: 13\r\n"
+                          "Sec-WebSocket-Protocol: mqtt\r\n\r\n").encode('ascii'))
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+            request_line, headers = _parse_http_head(head)
+            if request_line[1:2] != ["101"] or headers.get("sec-websocket-accept") != websocket_accept(key):
+                writer.close()
+                raise ConnectionError(f"WebSocket handshake failed: {' '.join(request_line)}")
+            stream = WebSocketStream(reader, writer, mask=True)
+            reader, writer = stream.reader, stream
+
+        flags = 0x02
+        payload = encode_string(self.client_id)
+        if self.will is not None:
+            topic, message = self.will
+            flags |= 0x04
+            payload += encode_string(topic) + encode_string(message)
+        body = encode_string("MQTT") + struct.pack("!BBH", 4, flags, self.keepalive) + payload
+        writer.write(packet(CONNECT, body))
+
+        packet_type, _, body = await asyncio.wait_for(read_packet(reader), timeout)
+        if packet_type != CONNACK or body[1] != 0:
+            writer.close()
+            raise ConnectionError(f"MQTT connection refused (code {body[1] if len(body) > 1 else '?'})")
+
+        self._writer = writer
+        self._tasks.append(asyncio.ensure_future(self._read_loop(reader)))
+        if self.keepalive:
+            self._tasks.append(asyncio.ensure_future(self._ping_loop()))
+        return self
+
+    async def _read_loop(self, reader):
+        try:
+            while True:
+                packet_type, flags, body = await read_packet(reader)
+                if packet_type == PUBLISH:
+                    topic, payload, qos, retain, packet_id = parse_publish(flags, body)
+                    if qos == 1:
+                        self._writer.write(packet(PUBACK, struct.pack("!H", packet_id)))
+                    await self.messages.put((topic, payload))
+                elif packet_type in (PUBACK, SUBACK, UNSUBACK, PUBREC):
+                    (packet_id,) = struct.unpack_from("!H", body, 0)
+                    future = self._acks.pop(packet_id, None)
+                    if future is not None and not future.done():
+                        future.set_result(body[2:])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            await self.messages.put(None)
+
+    async def _ping_loop(self):
+        while True:
+            await asyncio.sleep(self.keepalive / 2)
+            self._writer.write(packet(PINGREQ))
+
+    async def _request(self, packet_id, data, timeout):
+        future = asyncio.get_running_loop().create_future()
+        self._acks[packet_id] = future
+        self._writer.write(data)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._acks.pop(packet_id, None)
+
+    async def subscribe(self, topic_filter, qos=0, timeout=DEFAULT_TIMEOUT):
+        packet_id = self._packet_id()
+        body = struct.pack("!H", packet_id) + encode_string(topic_filter) + bytes([qos])
+        return await self._request(packet_id, packet(SUBSCRIBE, body, 0x2), timeout)
+
+    async def publish(self, topic, payload, qos=0, retain=False, timeout=DEFAULT_TIMEOUT):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        if qos == 0:
+            self._writer.write(publish_packet(topic, payload, 0, retain))
+            return None
+        packet_id = self._packet_id()
+        return await self._request(packet_id, publish_packet(topic, payload, 1, retain, packet_id), timeout)
+
+    async def disconnect(self):
+        if self._writer is not None and not self._writer.is_closing():
+            self._writer.write(packet(DISCONNECT))
+            self._writer.close()
+        for task in self._tasks:
+            task.cancel()
+
+
+async def simulate_bulb(mac, host="127.0.0.1", port=MQTT_PORT, websocket_path=None, stop=None):
+    """A bulb that applies pushed updates and reports its state back"""
+    state = {"switch": 0, "brightness": 100, "colorTemperature": 50}
+    client = MQTTClient(mac, host, port, websocket_path=websocket_path,
+                        will=(status_topic(mac), encode_updates(mac, {"online": 0})))
+    await client.connect()
+    await client.subscribe(command_topic(mac), qos=1)
+    await client.publish(status_topic(mac), encode_updates(mac, dict(state, online=1)))
+
+    try:
+        while stop is None or not stop.is_set():
+            message = await client.messages.get()
+            if message is None:
+                break
+            updates = parse_updates(message[1])
+            state.update(updates)
+            await client.publish(status_topic(mac), encode_updates(mac, updates))
+    finally:
+        await client.disconnect()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local MQTT broker for rescued Sengled bulbs")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve = commands.add_parser("serve", help="run the broker")
+    serve.add_argument("--port", type=int, default=MQTT_PORT)
+    serve.add_argument("--ws-port", type=int, default=WS_PORT)
+
+    simulate = commands.add_parser("simulate", help="connect simulated bulbs to a broker")
+    simulate.add_argument("--host", default="127.0.0.1")
+    simulate.add_argument("--port", type=int, default=MQTT_PORT)
+    simulate.add_argument("--websocket", action="store_true", help=f"connect over ws://host:port{WS_PATH}")
+    simulate.add_argument("--bulbs", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        broker = MQTTBroker(port=args.port, ws_port=args.ws_port).start()
+        print(f"📡 MQTT broker listening on {', '.join(f'{h}:{p}' for h, p in broker.addresses)}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            broker.close()
+        return
+
+    async def run_bulbs():
+        macs = [f"E8:DB:84:{i >> 16 & 0xFF:02X}:{i >> 8 & 0xFF:02X}:{i & 0xFF:02X}" for i in range(args.bulbs)]
+        path = WS_PATH if args.websocket else None
+        print(f"💡 Connecting {len(macs)} simulated bulbs to {args.host}:{args.port}")
+        await asyncio.gather(*(simulate_bulb(mac, args.host, args.port, path) for mac in macs))
+
+    try:
+        asyncio.run(run_bulbs())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
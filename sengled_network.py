@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Sengled Network Context
+=======================
+Resolve this host's interfaces, addresses and subnets once and share them.
+
+The rescue server, emulator, MongoDB system and debug tool all need to know
+"what is my LAN address" and "which subnets should I scan". Instead of a
+socket connect to 8.8.8.8 per request or an `ip route` subprocess per scan,
+a single NetworkContext reads the kernel tables once, caches an immutable
+snapshot, and refreshes it when netlink reports an address/route change or
+on a timer. Reading the snapshot on the hot path costs no syscalls.
+
+Interface networks larger than /22 (a docker bridge /16, a corporate /8)
+are clamped to this host's own /24 so discovery never sweeps millions of
+addresses; configure bigger ranges explicitly. If no LAN address can be
+found, server_ip raises instead of advertising loopback to bulbs.
+
+Overrides (environment or constructor):
+
+- SENGLED_SERVER_IP: address to advertise to bulbs
+- SENGLED_SUBNETS: comma-separated CIDRs to scan for bulbs (used as given)
+"""
+
+import ipaddress
+import os
+import socket
+import struct
+import threading
+
+REFRESH_INTERVAL = 300
+# Detected networks with a shorter prefix are clamped to CLAMP_PREFIX around our address
+MIN_AUTO_PREFIX = 22
+CLAMP_PREFIX = 24
+
+SIOCGIFADDR = 0x8915
+SIOCGIFNETMASK = 0x891b
+
+# rtnetlink multicast groups: link, IPv4 address and IPv4 route changes
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+
+
+class InterfaceInfo:
+    __slots__ = ("name", "address", "network")
+
+    def __init__(self, name, address, network):
+        self.name = name
+        self.address = address
+        self.network = network
+
+    def __repr__(self):
+        return f"InterfaceInfo({self.name!r}, {self.address!r}, {str(self.network)!r})"
+
+
+class NetworkSnapshot:
+    """Immutable view of the host's network configuration"""
+
+    __slots__ = ("interfaces", "default_interface", "server_ip", "subnets", "local_addresses")
+
+    def __init__(self, interfaces, default_interface, server_ip, subnets):
+        self.interfaces = tuple(interfaces)
+        self.default_interface = default_interface
+        self.server_ip = server_ip
+        self.subnets = tuple(subnets)
+        self.local_addresses = frozenset(iface.address for iface in interfaces) | ({server_ip} if server_ip else set())
+
+
+def _ioctl_address(sock, name, request):
+    import fcntl
+    packed = struct.pack('256s', name[:15].encode('utf-8'))
+    return socket.inet_ntoa(fcntl.ioctl(sock.fileno(), request, packed)[20:24])
+
+
+def read_interfaces():
+    """IPv4 address and network of every non-loopback interface (Linux)"""
+    interfaces = []
+    try:
+        names = [name for _, name in socket.if_nameindex()]
+    except (AttributeError, OSError):
+        return interfaces
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for name in names:
+            try:
+                address = _ioctl_address(sock, name, SIOCGIFADDR)
+                netmask = _ioctl_address(sock, name, SIOCGIFNETMASK)
+            except (ImportError, OSError):
+                continue
+            network = ipaddress.ip_network(f"{address}/{netmask}", strict=False)
+            if not network.is_loopback:
+                interfaces.append(InterfaceInfo(name, address, network))
+    return interfaces
+
+
+def read_default_interface(path="/proc/net/route"):
+    """Name of the interface holding the IPv4 default route"""
+    try:
+        with open(path) as f:
+            next(f, None)
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 8 and fields[1] == "00000000" and fields[7] == "00000000":
+                    return fields[0]
+    except OSError:
+        pass
+    return None
+
+
+def _probe_route_address():
+    """Portable fallback: let the kernel pick a source address (no packets sent)"""
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(("8.8.8.8", 80))
+            return s.getsockname()[0]
+    except OSError:
+        return None
+
+
+def _clamp(network, address):
+    """network, or our own /24 of it when it is too large to sweep"""
+    if network.prefixlen >= MIN_AUTO_PREFIX:
+        return network
+    return ipaddress.ip_network(f"{address}/{CLAMP_PREFIX}", strict=False)
+
+
+class NetworkContext:
+    def __init__(self, server_ip=None, subnets=None, refresh_interval=REFRESH_INTERVAL):
+        self.server_ip_override = server_ip or os.environ.get("SENGLED_SERVER_IP")
+        env_subnets = os.environ.get("SENGLED_SUBNETS")
+        if subnets is None and env_subnets:
+            subnets = [cidr.strip() for cidr in env_subnets.split(",") if cidr.strip()]
+        self.subnets_override = subnets
+        self.refresh_interval = refresh_interval
+
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._watcher = None
+        self.refresh()
+
+    # ------------------------------------------------------------------
+    # Hot-path accessors (no syscalls)
+    # ------------------------------------------------------------------
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    @property
+    def server_ip(self):
+        server_ip = self._snapshot.server_ip
+        if server_ip is None:
+            raise RuntimeError("No LAN address found to advertise to bulbs; set SENGLED_SERVER_IP")
+        return server_ip
+
+    @property
+    def subnets(self):
+        return list(self._snapshot.subnets)
+
+    @property
+    def local_addresses(self):
+        return self._snapshot.local_addresses
+
+    # ------------------------------------------------------------------
+    # Resolution
+    # ------------------------------------------------------------------
+
+    def refresh(self):
+        """Re-read the kernel tables and swap in a new snapshot"""
+        with self._lock:
+            interfaces = read_interfaces()
+            default_name = read_default_interface()
+            default = next((iface for iface in interfaces if iface.name == default_name),
+                           interfaces[0] if interfaces else None)
+
+            server_ip = self.server_ip_override
+            if server_ip is None:
+                server_ip = default.address if default else _probe_route_address()
+                if server_ip is None:
+                    print("⚠️  No LAN address found; set SENGLED_SERVER_IP before bulbs connect")
+
+            if self.subnets_override is not None:
+                subnets = list(self.subnets_override)
+            elif interfaces:
+                subnets = [str(_clamp(iface.network, iface.address)) for iface in interfaces]
+            elif server_ip is not None:
+                subnets = [str(ipaddress.ip_network(f"{server_ip}/{CLAMP_PREFIX}", strict=False))]
+            else:
+                subnets = []
+
+            self._snapshot = NetworkSnapshot(interfaces, default.name if default else None,
+                                             server_ip, subnets)
+            return self._snapshot
+
+    def watch(self):
+        """Refresh on netlink address/route changes, or every refresh_interval"""
+        if self._watcher is not None:
+            return self
+        self._watcher = threading.Thread(target=self._watch_loop, name="sengled-netctx", daemon=True)
+        self._watcher.start()
+        return self
+
+    def _watch_loop(self):
+        sock = None
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE))
+            sock.settimeout(self.refresh_interval)
+        except (AttributeError, OSError):
+            sock = None
+
+        event = threading.Event()
+        while True:
+            try:
+                if sock is not None:
+                    try:
+                        sock.recv(65536)
+                        # Coalesce the burst of messages one change produces
+                        event.wait(0.5)
+                        sock.setblocking(False)
+                        try:
+                            while sock.recv(65536):
+                                pass
+                        except (BlockingIOError, OSError):
+                            pass
+                        sock.settimeout(self.refresh_interval)
+                    except socket.timeout:
+                        pass
+                else:
+                    event.wait(self.refresh_interval)
+
+                previous = self._snapshot
+                current = self.refresh()
+                if (previous.server_ip, previous.subnets) != (current.server_ip, current.subnets):
+                    print(f"🌐 Network changed: {current.server_ip} on {', '.join(current.subnets)}")
+            except Exception as e:
+                print(f"Network context error: {e}")
+                event.wait(self.refresh_interval)
+
+
+_shared_context = None
+_shared_lock = threading.Lock()
+
+
+def get_network_context():
+    """Return the process-wide network context, resolving it on first use"""
+    global _shared_context
+    with _shared_lock:
+        if _shared_context is None:
+            _shared_context = NetworkContext().watch()
+        return _shared_context
+
+
+if __name__ == "__main__":
+    ctx = get_network_context()
+    print(f"Server IP: {ctx.server_ip}")
+    print(f"Subnets:   {', '.join(ctx.subnets) or 'none'}")
+    for iface in ctx.snapshot.interfaces:
+        print(f"  • {iface.name}: {iface.address} ({iface.network})")
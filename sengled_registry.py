@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+"""
+Sengled Device Registry
+=======================
+One registry of cloud-registered bulbs for the emulator, the rescue server
+and the MongoDB system.
+
+Records are compact __slots__ objects. Writers build a new snapshot under a
+lock and swap it in, so readers (device lists, status pages, the discovery
+loop) just grab the current snapshot and never block a registering bulb.
+Snapshots are split into shards and a write only copies the shard it
+touches, so a reconnect storm of 10k+ bulbs stays cheap.
+
+The registry is persisted to SQLite (WAL mode, memory-mapped reads) so the
+emulator, the rescue server and the MongoDB system see each other's
+registrations, and a restart starts from the bulbs that were already known
+instead of waiting for every one of them to call accessCloud.json again.
+
+Configured from the environment (or DeviceRegistry()):
+
+- SENGLED_REGISTRY_PATH: SQLite file (default sengled_registry.db); set it
+  to an empty string for an in-memory registry
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections.abc import Mapping
+from datetime import datetime, timezone
+
+DEFAULT_REGISTRY_PATH = "sengled_registry.db"
+MMAP_SIZE = 64 * 1024 * 1024
+SHARDS = 64
+
+# Recent (version, device_uuid) changes kept for delta queries; clients that
+# fall further behind get the full listing instead
+CHANGE_LOG_SIZE = 100000
+DEFAULT_PAGE_SIZE = 500
+
+FIELDS = ("ip", "user_id", "jsession_id", "user_agent", "registration_time", "last_seen")
+
+# Fields delta pollers care about; changing any other field (a heartbeat's
+# last_seen, a fresh session ID) updates the record without a new version
+VERSIONED_FIELDS = ("ip", "user_id", "user_agent")
+TIMESTAMP_FIELDS = ("registration_time", "last_seen")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices (
+    device_uuid TEXT PRIMARY KEY,
+    ip TEXT,
+    user_id TEXT,
+    jsession_id TEXT,
+    user_agent TEXT,
+    registration_time REAL,
+    last_seen REAL,
+    version INTEGER NOT NULL DEFAULT 0,
+    removed INTEGER NOT NULL DEFAULT 0
+)
+"""
+
+
+class DeviceRecord:
+    """One registered bulb; replaced, never mutated, once published"""
+
+    __slots__ = ("device_uuid",) + FIELDS + ("version",)
+
+    def __init__(self, device_uuid, ip=None, user_id=None, jsession_id=None,
+                 user_agent=None, registration_time=None, last_seen=None, version=0):
+        self.device_uuid = device_uuid
+        self.ip = ip
+        self.user_id = user_id
+        self.jsession_id = jsession_id
+        self.user_agent = user_agent
+        self.registration_time = registration_time
+        self.last_seen = last_seen
+        self.version = version
+
+    def replace(self, **changes):
+        values = {name: getattr(self, name) for name in FIELDS}
+        values.update(changes)
+        return DeviceRecord(self.device_uuid, **values)
+
+    def to_row(self):
+        return (self.device_uuid,) + tuple(getattr(self, name) for name in FIELDS) + (self.version,)
+
+    def same_version(self, other):
+        """True if other differs from this record only in unversioned fields"""
+        return all(getattr(self, name) == getattr(other, name) for name in VERSIONED_FIELDS)
+
+    def to_document(self):
+        """BSON-friendly view; timestamps become UTC datetimes"""
+        doc = {}
+        for name in FIELDS:
+            value = getattr(self, name)
+            if value is None:
+                continue
+            if name in TIMESTAMP_FIELDS:
+                value = datetime.fromtimestamp(value, timezone.utc)
+            doc[name] = value
+        doc["version"] = self.version
+        return doc
+
+    def to_dict(self):
+        """JSON-friendly view; timestamps become ISO 8601 UTC strings"""
+        doc = self.to_document()
+        for name in TIMESTAMP_FIELDS:
+            if name in doc:
+                doc[name] = doc[name].isoformat()
+        return doc
+
+    def __repr__(self):
+        return f"DeviceRecord({self.device_uuid!r}, ip={self.ip!r}, version={self.version})"
+
+
+class RegistryPage:
+    """Result of RegistrySnapshot.select()"""
+
+    __slots__ = ("version", "records", "removed", "next_cursor", "delta")
+
+    def __init__(self, version, records, removed=(), next_cursor=None, delta=False):
+        self.version = version
+        self.records = records
+        self.removed = list(removed)
+        self.next_cursor = next_cursor
+        self.delta = delta
+
+    def to_dict(self, key="devices"):
+        """JSON envelope used by the /api listing endpoints"""
+        doc = {
+            "version": self.version,
+            key: {record.device_uuid: record.to_dict() for record in self.records},
+        }
+        if self.delta:
+            doc["removed"] = self.removed
+        else:
+            doc["next_cursor"] = self.next_cursor
+        return doc
+
+
+class RegistrySnapshot(Mapping):
+    """Immutable point-in-time view of the registry at one version"""
+
+    __slots__ = ("_shards", "_size", "version", "_log", "_log_end", "_sorted_keys")
+
+    def __init__(self, shards, version=0, log=None):
+        self._shards = shards
+        self._size = sum(len(shard) for shard in shards)
+        self.version = version
+        self._log = log if log is not None else []
+        self._log_end = len(self._log)
+        self._sorted_keys = None
+
+    def _shard(self, device_uuid):
+        return self._shards[hash(device_uuid) % SHARDS]
+
+    def __getitem__(self, device_uuid):
+        return self._shard(device_uuid)[device_uuid]
+
+    def get(self, device_uuid, default=None):
+        return self._shard(device_uuid).get(device_uuid, default)
+
+    def __contains__(self, device_uuid):
+        return device_uuid in self._shard(device_uuid)
+
+    def __iter__(self):
+        for shard in self._shards:
+            yield from shard
+
+    def items(self):
+        for shard in self._shards:
+            yield from shard.items()
+
+    def __len__(self):
+        return self._size
+
+    def with_changes(self, records=(), removed=(), version=None, log=None):
+        """New snapshot; only the shards that change are copied"""
+        shards = list(self._shards)
+        copied = set()
+
+        def writable(device_uuid):
+            index = hash(device_uuid) % SHARDS
+            if index not in copied:
+                shards[index] = dict(shards[index])
+                copied.add(index)
+            return shards[index]
+
+        for record in records:
+            writable(record.device_uuid)[record.device_uuid] = record
+        for device_uuid in removed:
+            writable(device_uuid).pop(device_uuid, None)
+        return RegistrySnapshot(tuple(shards),
+                                self.version if version is None else version,
+                                self._log if log is None else log)
+
+    # ------------------------------------------------------------------
+    # Incremental listings
+    # ------------------------------------------------------------------
+
+    def sorted_keys(self):
+        """Device UUIDs in cursor order (computed once per snapshot)"""
+        if self._sorted_keys is None:
+            self._sorted_keys = sorted(self)
+        return self._sorted_keys
+
+    def changes_since(self, since):
+        """(changed records, removed UUIDs) after a version, or None if unknown"""
+        if since == self.version:
+            return [], []
+        log, end = self._log, self._log_end
+        floor = log[0][0] - 1 if end else self.version
+        if since < floor or since > self.version:
+            return None
+
+        # (since + 1,) sorts before every (since + 1, uuid) entry
+        start = bisect_left(log, (since + 1,), 0, end)
+        changed, removed = [], []
+        for device_uuid in dict.fromkeys(device_uuid for _, device_uuid in log[start:end]):
+            record = self.get(device_uuid)
+            if record is not None:
+                changed.append(record)
+            else:
+                removed.append(device_uuid)
+        return changed, removed
+
+    def page(self, cursor=None, limit=DEFAULT_PAGE_SIZE):
+        """(records, next_cursor) for the page after cursor, in UUID order"""
+        keys = self.sorted_keys()
+        start = bisect_right(keys, cursor) if cursor is not None else 0
+        chunk = keys[start:start + limit]
+        next_cursor = chunk[-1] if start + limit < len(keys) else None
+        return [self[device_uuid] for device_uuid in chunk], next_cursor
+
+    def select(self, since=None, cursor=None, limit=None):
+        """Delta since a version when possible, otherwise a page of the full listing"""
+        if since is not None:
+            changes = self.changes_since(since)
+            if changes is not None:
+                return RegistryPage(self.version, changes[0], changes[1], delta=True)
+        if cursor is None and limit is None:
+            return RegistryPage(self.version, list(self.values()))
+        records, next_cursor = self.page(cursor, limit or DEFAULT_PAGE_SIZE)
+        return RegistryPage(self.version, records, next_cursor=next_cursor)
+
+
+EMPTY_SNAPSHOT = RegistrySnapshot(tuple({} for _ in range(SHARDS)))
+
+
+def parse_listing_args(args):
+    """(since, cursor, limit) from query-string or JSON body parameters"""
+    since = args.get("since")
+    limit = args.get("limit")
+    try:
+        since = int(since) if since not in (None, "") else None
+        limit = int(limit) if limit not in (None, "") else None
+    except (TypeError, ValueError):
+        raise ValueError("since and limit must be integers")
+    if limit is not None and limit <= 0:
+        raise ValueError("limit must be positive")
+    return since, args.get("cursor") or None, limit
+
+
+class DeviceRegistry(Mapping):
+    """Thread-safe {device_uuid: DeviceRecord} with copy-on-write snapshots.
+
+    Every change to a versioned field (or a removal) gets the next registry
+    version. With SQLite persistence the version sequence is shared by every
+    process using the same file. Heartbeats that only refresh last_seen are
+    written in place: other processes see them with the next versioned change.
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.environ.get("SENGLED_REGISTRY_PATH", DEFAULT_REGISTRY_PATH)
+        self.path = path or None
+
+        self._lock = threading.Lock()
+        self._snapshot = EMPTY_SNAPSHOT
+        self._log = []
+        self._db = None
+
+        if self.path:
+            self._db = sqlite3.connect(self.path, timeout=5, check_same_thread=False,
+                                       isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+            self._db.execute(SCHEMA)
+            self._migrate()
+            self._db.execute("CREATE INDEX IF NOT EXISTS devices_version ON devices (version)")
+            self.sync()
+
+    def _migrate(self):
+        """Add the version/tombstone columns to registries written before them"""
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(devices)")}
+        if "version" not in columns:
+            self._db.execute("ALTER TABLE devices ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+            self._db.execute("ALTER TABLE devices ADD COLUMN removed INTEGER NOT NULL DEFAULT 0")
+            self._db.execute("UPDATE devices SET version = rowid")
+
+    # ------------------------------------------------------------------
+    # Readers (lock-free)
+    # ------------------------------------------------------------------
+
+    def snapshot(self):
+        """Current read-only {device_uuid: DeviceRecord}"""
+        return self._snapshot
+
+    @property
+    def version(self):
+        return self._snapshot.version
+
+    def __getitem__(self, device_uuid):
+        return self._snapshot[device_uuid]
+
+    def __iter__(self):
+        return iter(self._snapshot)
+
+    def __len__(self):
+        return len(self._snapshot)
+
+    def __contains__(self, device_uuid):
+        return device_uuid in self._snapshot
+
+    def to_dict(self):
+        return {device_uuid: record.to_dict() for device_uuid, record in self._snapshot.items()}
+
+    # ------------------------------------------------------------------
+    # Writers
+    # ------------------------------------------------------------------
+
+    def _publish(self, records, removed, changes):
+        """Swap in a snapshot with records replaced and UUIDs removed.
+
+        changes lists the (version, device_uuid) pairs involved, in order.
+        """
+        self._log.extend(changes)
+        if len(self._log) > 2 * CHANGE_LOG_SIZE:
+            # Rebind rather than trim in place: older snapshots keep their view
+            self._log = self._log[-CHANGE_LOG_SIZE:]
+        self._snapshot = self._snapshot.with_changes(records, removed, changes[-1][0], self._log)
+
+    def _write(self, device_uuid, build):
+        """Apply build(existing) as the next version; build returns a record,
+        _REMOVE, or None for no change"""
+        with self._lock:
+            if self._db is None:
+                return self._apply(device_uuid, build)
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                # Catch up with other processes first so versions stay gap-free
+                self._pull()
+                result = self._apply(device_uuid, build)
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+            return result
+
+    def _apply(self, device_uuid, build):
+        existing = self._snapshot.get(device_uuid)
+        record = build(existing)
+        if record is None:
+            return existing
+        if existing is not None and record is not _REMOVE and record.same_version(existing):
+            # Nothing delta pollers care about changed: no version, no log entry
+            record.version = existing.version
+            if self._db is not None:
+                unversioned = [name for name in FIELDS if name not in VERSIONED_FIELDS]
+                self._db.execute(
+                    f"UPDATE devices SET {', '.join(f'{name} = ?' for name in unversioned)} "
+                    f"WHERE device_uuid = ?",
+                    tuple(getattr(record, name) for name in unversioned) + (device_uuid,)
+                )
+            self._snapshot = self._snapshot.with_changes((record,))
+            return record
+        version = self._snapshot.version + 1
+        if record is _REMOVE:
+            if self._db is not None:
+                self._db.execute("UPDATE devices SET removed = 1, version = ? WHERE device_uuid = ?",
+                                 (version, device_uuid))
+            self._publish((), (device_uuid,), [(version, device_uuid)])
+            return None
+        record.version = version
+        if self._db is not None:
+            self._db.execute(
+                f"INSERT OR REPLACE INTO devices (device_uuid, {', '.join(FIELDS)}, version, removed) "
+                f"VALUES ({', '.join('?' * (len(FIELDS) + 2))}, 0)",
+                record.to_row()
+            )
+        self._publish((record,), (), [(version, device_uuid)])
+        return record
+
+    def register(self, device_uuid, ip, **fields):
+        """Record a bulb that (re-)registered with the cloud"""
+        now = time.time()
+        fields.setdefault("registration_time", now)
+        fields.setdefault("last_seen", now)
+
+        def build(existing):
+            if existing is not None:
+                return existing.replace(ip=ip, **fields)
+            return DeviceRecord(device_uuid, ip=ip, **fields)
+
+        return self._write(device_uuid, build)
+
+    def touch(self, device_uuid, ip=None):
+        """Refresh last_seen (and the address, if it changed)"""
+        def build(existing):
+            if existing is None:
+                return None
+            return existing.replace(ip=ip or existing.ip, last_seen=time.time())
+
+        return self._write(device_uuid, build)
+
+    def remove(self, device_uuid):
+        """Forget a bulb; delta listings report it as removed"""
+        removed = []
+
+        def build(existing):
+            if existing is None:
+                return None
+            removed.append(device_uuid)
+            return _REMOVE
+
+        self._write(device_uuid, build)
+        return bool(removed)
+
+    # ------------------------------------------------------------------
+    # Persistence
+    # ------------------------------------------------------------------
+
+    def _pull(self):
+        """Publish rows other processes wrote after our version (lock held)"""
+        rows = self._db.execute(
+            f"SELECT device_uuid, {', '.join(FIELDS)}, version, removed FROM devices "
+            f"WHERE version > ? ORDER BY version",
+            (self._snapshot.version,)
+        ).fetchall()
+        if not rows:
+            return 0
+        records = [DeviceRecord(*row[:-1]) for row in rows if not row[-1]]
+        removed = [row[0] for row in rows if row[-1]]
+        self._publish(records, removed, [(row[-2], row[0]) for row in rows])
+        return len(rows)
+
+    def sync(self):
+        """Pick up changes written by other processes since the last sync"""
+        if self._db is None:
+            return 0
+        with self._lock:
+            return self._pull()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+_REMOVE = object()
+
+
+_shared_registry = None
+_shared_lock = threading.Lock()
+
+
+def get_registry():
+    """Return the process-wide device registry, opening it on first use"""
+    global _shared_registry
+    with _shared_lock:
+        if _shared_registry is None:
+            _shared_registry = DeviceRegistry()
+        return _shared_registry
+
+
+if __name__ == "__main__":
+    registry = get_registry()
+    print(f"{len(registry)} registered bulbs in {registry.path or 'memory'}")
+    for device_uuid, record in sorted(registry.items()):
+        print(f"  • {device_uuid} at {record.ip}")
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+Sengled Request Log
+===================
+Fixed-size memory for intercepted cloud requests.
+
+The newest requests live in a ring buffer with per-endpoint, per-IP and
+per-device indexes for fast queries; every request is also appended to a
+size-rotated NDJSON spool on disk. Memory stays flat no matter how long the
+rescue server runs.
+
+Entries are stamped ("ts") under the lock and never go backwards, so time
+filters can bisect the ring. Only string and integer values are indexed;
+anything else a client sends as deviceUuid is kept but not searchable.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import deque
+
+DEFAULT_CAPACITY = 10000
+DEFAULT_SPOOL_PATH = "sengled_requests.ndjson"
+DEFAULT_SPOOL_BYTES = 10 * 1024 * 1024
+DEFAULT_SPOOL_BACKUPS = 5
+
+INDEXED_FIELDS = ("endpoint", "ip", "device_uuid")
+
+
+def _indexable(value):
+    return isinstance(value, (str, int)) and not isinstance(value, bool)
+
+
+class RequestLog:
+    def __init__(self, capacity=DEFAULT_CAPACITY, spool_path=DEFAULT_SPOOL_PATH,
+                 max_bytes=DEFAULT_SPOOL_BYTES, backups=DEFAULT_SPOOL_BACKUPS):
+        self.capacity = capacity
+        self.spool_path = spool_path
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+        self._ring = [None] * capacity
+        self._next_seq = 0
+        self._last_ts = 0.0
+        self._indexes = {field: {} for field in INDEXED_FIELDS}
+        self._lock = threading.Lock()
+
+        self._spool = None
+        self._spool_size = 0
+        if spool_path:
+            self._open_spool()
+
+    # ------------------------------------------------------------------
+    # Writing
+    # ------------------------------------------------------------------
+
+    def append(self, entry):
+        """Store a request entry; the oldest one falls out when full"""
+        data = entry.get("data")
+        if "device_uuid" not in entry and isinstance(data, dict):
+            entry["device_uuid"] = data.get("deviceUuid")
+
+        with self._lock:
+            # Stamped in sequence order (and clamped against clock steps) for bisect
+            self._last_ts = entry["ts"] = max(entry.get("ts", time.time()), self._last_ts)
+            seq = self._next_seq
+            self._next_seq += 1
+
+            slot = seq % self.capacity
+            evicted = self._ring[slot]
+            if evicted is not None:
+                self._unindex(seq - self.capacity, evicted)
+            self._ring[slot] = entry
+
+            for field in INDEXED_FIELDS:
+                value = entry.get(field)
+                if _indexable(value):
+                    self._indexes[field].setdefault(value, deque()).append(seq)
+
+            if self._spool is not None:
+                self._write_spool(entry)
+
+    def _unindex(self, seq, entry):
+        for field in INDEXED_FIELDS:
+            value = entry.get(field)
+            if not _indexable(value):
+                continue
+            seqs = self._indexes[field].get(value)
+            # Sequences are appended in order, so the evicted one is always first
+            if seqs and seqs[0] == seq:
+                seqs.popleft()
+                if not seqs:
+                    del self._indexes[field][value]
+
+    # ------------------------------------------------------------------
+    # Spool
+    # ------------------------------------------------------------------
+
+    def _open_spool(self):
+        self._spool = open(self.spool_path, "a", encoding="utf-8")
+        self._spool_size = self._spool.tell()
+
+    def _write_spool(self, entry):
+        line = json.dumps(entry, default=str, separators=(",", ":")) + "\n"
+        self._spool.write(line)
+        self._spool_size += len(line)
+        if self._spool_size >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        self._spool.close()
+        for index in range(self.backups - 1, 0, -1):
+            older = f"{self.spool_path}.{index}"
+            if os.path.exists(older):
+                os.replace(older, f"{self.spool_path}.{index + 1}")
+        if self.backups:
+            os.replace(self.spool_path, f"{self.spool_path}.1")
+        else:
+            os.remove(self.spool_path)
+        self._open_spool()
+
+    def flush(self):
+        with self._lock:
+            if self._spool is not None:
+                self._spool.flush()
+
+    def close(self):
+        with self._lock:
+            if self._spool is not None:
+                self._spool.close()
+                self._spool = None
+
+    # ------------------------------------------------------------------
+    # Querying
+    # ------------------------------------------------------------------
+
+    def _oldest_seq(self):
+        return max(0, self._next_seq - self.capacity)
+
+    def _ts(self, seq):
+        return self._ring[seq % self.capacity]["ts"]
+
+    def _bisect(self, seqs, ts, right=False):
+        """Position of ts among the time-ordered seqs, like bisect_left/right
+        (whose key= argument needs Python 3.10)"""
+        lo, hi = 0, len(seqs)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry_ts = self._ts(seqs[mid])
+            if entry_ts < ts or (right and entry_ts == ts):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def query(self, endpoint=None, ip=None, device_uuid=None, since=None, until=None, limit=100):
+        """Newest-first entries matching every given filter"""
+        filters = {"endpoint": endpoint, "ip": ip, "device_uuid": device_uuid}
+        with self._lock:
+            candidates = None
+            for field, value in filters.items():
+                if value is None:
+                    continue
+                seqs = self._indexes[field].get(value)
+                if not seqs:
+                    return []
+                if candidates is None or len(seqs) < len(candidates):
+                    candidates = seqs
+
+            if candidates is None:
+                candidates = range(self._oldest_seq(), self._next_seq)
+
+            # Entries are time-ordered, so the time range is a slice of the candidates
+            lo = 0 if since is None else self._bisect(candidates, since)
+            hi = len(candidates) if until is None else self._bisect(candidates, until, right=True)
+
+            results = []
+            for position in range(hi - 1, lo - 1, -1):
+                entry = self._ring[candidates[position] % self.capacity]
+                if all(value is None or entry.get(field) == value for field, value in filters.items()):
+                    results.append(entry)
+                    if len(results) >= limit:
+                        break
+            return results
+
+    def __len__(self):
+        return min(self._next_seq, self.capacity)
+
+    @property
+    def total(self):
+        """Requests seen since start, including ones no longer in memory"""
+        return self._next_seq
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Sengled RTT Estimation
+======================
+Per-bulb round-trip time estimates that drive UDP retransmission.
+
+Each bulb address gets an RFC 6298 estimator: a smoothed RTT and RTT
+variance updated from every unambiguous reply, giving a retransmission
+timeout of SRTT + 4 * RTTVAR. A bulb on a quiet LAN answers in a few
+milliseconds, so a lost datagram is resent after tens of milliseconds
+rather than waiting out a fixed multi-second timeout.
+
+- every retransmission doubles the timeout (exponential backoff), up to
+  MAX_RTO; the backed-off value sticks until a fresh sample arrives
+- Karn's rule: replies to a request that was retransmitted are never
+  sampled, since it is unknown which transmission they answer
+- after DEAD_AFTER requests in a row fail, the bulb counts as dead: it is
+  probed once with a short timeout instead of retried, so callers fail
+  fast; any datagram from it brings it back
+
+Timeouts below MIN_RTO are not used (RFC 6298 says 1 s for the Internet;
+bulbs are one Wi-Fi hop away).
+"""
+
+# RFC 6298 gains
+ALPHA = 1 / 8
+BETA = 1 / 4
+K = 4
+
+# Seconds
+INITIAL_RTO = 0.5
+MIN_RTO = 0.03
+MAX_RTO = 2.0
+# Event loop timer granularity
+CLOCK_GRANULARITY = 0.001
+
+MAX_RETRIES = 4
+DEAD_AFTER = 2
+DEAD_PROBE_TIMEOUT = INITIAL_RTO
+
+
+class RTTEstimator:
+    __slots__ = ("srtt", "rttvar", "rto", "failures")
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INITIAL_RTO
+        # Requests in a row that got no reply at all
+        self.failures = 0
+
+    def sample(self, rtt):
+        """Fold in the round trip of a reply to a request sent exactly once"""
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - BETA) * self.rttvar + BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - ALPHA) * self.srtt + ALPHA * rtt
+        self.rto = min(max(self.srtt + max(CLOCK_GRANULARITY, K * self.rttvar), MIN_RTO), MAX_RTO)
+        self.failures = 0
+
+    def backoff(self):
+        """A transmission timed out: double the timeout for the next one"""
+        self.rto = min(self.rto * 2, MAX_RTO)
+
+    def alive(self):
+        self.failures = 0
+
+    def failed(self):
+        self.failures += 1
+
+    @property
+    def dead(self):
+        return self.failures >= DEAD_AFTER
+
+    def to_dict(self):
+        return {
+            "srtt_ms": None if self.srtt is None else round(self.srtt * 1000, 2),
+            "rttvar_ms": None if self.rttvar is None else round(self.rttvar * 1000, 2),
+            "rto_ms": round(self.rto * 1000, 2),
+            "failures": self.failures,
+            "dead": self.dead,
+        }
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+Sengled Scene Cache
+===================
+Scenes compiled into ready-to-send plans, kept in memory.
+
+A compiled scene holds, for every action, the bulb's current address and
+the command already encoded to bytes, so triggering a scene is one dict
+lookup and one fan-out: no MongoDB read and no JSON encoding on the hot
+path. The prepared bytes travel through the bulbs' command queues, so
+scenes still get pacing, coalescing and MQTT push. Actions for bulbs that
+are not known yet are resolved at compile time as well, so they fail
+together instead of one by one.
+
+Every scene document is loaded at startup and kept in memory next to its
+plan, so once loaded the cache answers on its own: an unknown name is
+"not found" without a MongoDB round trip, and scenes keep working while
+the database is down. Until the first load succeeds, misses fall back to
+MongoDB and the load is retried in the background. Documents are updated
+when:
+
+- the scene is written through create_scene (same process, via put)
+- a change stream reports an insert, update or delete (other processes);
+  without a replica set, scenes with a newer updated_at are polled instead
+  and deletes are found by a periodic reconcile
+
+A plan is recompiled from its document when a bulb in the scene gets a new
+address or an unknown bulb turns up.
+
+Groups use the same cache with compile_group: membership only, addresses
+are looked up when the group command is sent.
+"""
+
+import threading
+import time
+
+from pymongo.errors import PyMongoError
+
+from sengled_udp_transport import encode_command
+
+POLL_INTERVAL = 5
+RECONCILE_INTERVAL = 60
+
+
+class CompiledScene:
+    __slots__ = ("name", "targets", "actions", "missing")
+
+    def __init__(self, name, targets, actions, missing):
+        self.name = name
+        # [(key, ip, payload bytes)] ready to send
+        self.targets = targets
+        # key -> (device_uuid, command dict) for the queue, logging and the state cache
+        self.actions = actions
+        # UUIDs of actions whose bulb has no known address
+        self.missing = missing
+
+    @property
+    def devices(self):
+        return [device_uuid for device_uuid, _ in self.actions] + self.missing
+
+
+def compile_scene(doc, resolve):
+    """Compile a scene document; resolve(device_uuid) returns an IP or None"""
+    targets = []
+    actions = []
+    missing = []
+    for action in doc.get("actions", []):
+        device_uuid = action["device_uuid"]
+        ip = resolve(device_uuid)
+        if ip is None:
+            missing.append(device_uuid)
+            continue
+        targets.append((len(targets), ip, encode_command(action["command"])))
+        actions.append((device_uuid, action["command"]))
+    return CompiledScene(doc["name"], targets, actions, missing)
+
+
+class CompiledGroup:
+    __slots__ = ("name", "members")
+
+    def __init__(self, name, members):
+        self.name = name
+        self.members = members
+
+    @property
+    def devices(self):
+        # Addresses are resolved per command, so a bulb moving changes nothing here
+        return []
+
+
+def compile_group(doc, resolve):
+    return CompiledGroup(doc["name"], list(doc.get("members", [])))
+
+
+class SceneCache:
+    def __init__(self, collection, resolve, poll_interval=POLL_INTERVAL, compile=compile_scene):
+        """resolve(device_uuid) returns the bulb's current IP, or None"""
+        self.collection = collection
+        self.resolve = resolve
+        self.poll_interval = poll_interval
+        self.compile = compile
+
+        # name -> source document, and _id -> name for change-stream deletes
+        self._docs = {}
+        self._names = {}
+        self._plans = {}
+        # device_uuid -> names of the scenes that use it
+        self._by_device = {}
+        self._lock = threading.Lock()
+        # Bumped by every invalidation so a slow compile cannot store a stale plan
+        self._epoch = 0
+        self._watermark = None
+        # Every document has been loaded: a miss means the name does not exist
+        self._loaded = False
+        self._stopped = threading.Event()
+        self._thread = None
+
+        # Stats
+        self.hits = 0
+        self.misses = 0
+
+    def start(self, warm=True):
+        """Compile every scene and start following changes.
+        
+        With warm=False the first load is left to the watch thread.
+        """
+        if self._thread is None:
+            try:
+                if warm:
+                    self.warm()
+            except PyMongoError as e:
+                # Retried by the watch thread; misses read MongoDB until then
+                print(f"Scene cache warm-up failed: {e}")
+            self._thread = threading.Thread(target=self._watch, name="sengled-scene-watch", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    def warm(self):
+        """Load every document; raises PyMongoError if MongoDB is unavailable"""
+        docs = list(self.collection.find({}))
+        with self._lock:
+            self._epoch += 1
+            self._docs.clear()
+            self._names.clear()
+            self._plans.clear()
+            self._by_device.clear()
+            for doc in docs:
+                self._put(doc)
+            self._watermark = max((doc["updated_at"] for doc in docs if doc.get("updated_at")),
+                                  default=self._watermark)
+            self._loaded = True
+        return len(docs)
+
+    def get(self, name):
+        """The compiled scene; None if it does not exist.
+        
+        Raises PyMongoError only before the first load, when the document has
+        to be read from MongoDB and the database is unavailable.
+        """
+        plan = self._plans.get(name)
+        if plan is not None:
+            self.hits += 1
+            return plan
+
+        self.misses += 1
+        epoch = self._epoch
+        doc = self._docs.get(name)
+        if doc is None:
+            if self._loaded:
+                return None
+            doc = self.collection.find_one({"name": name})
+            if doc is None:
+                return None
+        plan = self.compile(doc, self.resolve)
+        with self._lock:
+            if self._epoch == epoch:
+                self._docs.setdefault(name, doc)
+                self._store(plan)
+        return plan
+
+    def put(self, doc):
+        """Cache a document just written by this process"""
+        with self._lock:
+            self._put(doc)
+
+    def discard(self, name):
+        """Forget a document deleted by this process; True if it was cached"""
+        with self._lock:
+            known = name in self._docs
+            self._forget(name)
+            return known
+
+    def _put(self, doc):
+        """Cache a document and its plan (caller holds the lock)"""
+        self._forget(doc["name"])
+        self._docs[doc["name"]] = doc
+        if "_id" in doc:
+            self._names[doc["_id"]] = doc["name"]
+        self._store(self.compile(doc, self.resolve))
+
+    def _forget(self, name):
+        """Drop a document and its plan (caller holds the lock)"""
+        doc = self._docs.pop(name, None)
+        if doc is not None and "_id" in doc:
+            self._names.pop(doc["_id"], None)
+        self._drop(name)
+
+    def _store(self, plan):
+        """Cache a plan (caller holds the lock)"""
+        self._drop(plan.name)
+        self._plans[plan.name] = plan
+        for device_uuid in plan.devices:
+            self._by_device.setdefault(device_uuid, set()).add(plan.name)
+
+    def _drop(self, name):
+        """Forget a plan (caller holds the lock)"""
+        self._epoch += 1
+        plan = self._plans.pop(name, None)
+        if plan is None:
+            return
+        for device_uuid in plan.devices:
+            names = self._by_device.get(device_uuid)
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del self._by_device[device_uuid]
+
+    def invalidate(self, name=None):
+        """Drop one scene's plan (or all of them); it is recompiled on next use"""
+        with self._lock:
+            if name is None:
+                self._epoch += 1
+                self._plans.clear()
+                self._by_device.clear()
+            else:
+                self._drop(name)
+
+    def invalidate_device(self, device_uuid):
+        """A bulb moved or turned up: drop the plans that mention it"""
+        with self._lock:
+            for name in list(self._by_device.get(device_uuid, ())):
+                self._drop(name)
+
+    def __len__(self):
+        return len(self._plans)
+
+    # ------------------------------------------------------------------
+    # Following changes
+    # ------------------------------------------------------------------
+
+    def _watch(self):
+        """Follow edits: change stream if available, otherwise updated_at polling"""
+        try:
+            with self.collection.watch(full_document="updateLookup") as stream:
+                if not self._loaded:
+                    # Opened after the failed warm-up, so nothing between the two is missed
+                    self.warm()
+                for change in stream:
+                    if self._stopped.is_set():
+                        return
+                    if change["operationType"] in ("drop", "rename", "invalidate"):
+                        self.warm()
+                    elif change.get("fullDocument") is not None:
+                        self.put(change["fullDocument"])
+                    else:
+                        # Deletes only carry the _id
+                        with self._lock:
+                            name = self._names.get(change.get("documentKey", {}).get("_id"))
+                            if name is not None:
+                                self._forget(name)
+        except PyMongoError:
+            pass  # standalone server (no change streams) or MongoDB down
+
+        last_reconcile = time.monotonic()
+        while not self._stopped.wait(self.poll_interval):
+            try:
+                if not self._loaded:
+                    self.warm()
+                    last_reconcile = time.monotonic()
+                    continue
+                query = {"updated_at": {"$gt": self._watermark}} if self._watermark else {"updated_at": {"$exists": True}}
+                for doc in self.collection.find(query):
+                    with self._lock:
+                        self._put(doc)
+                        if self._watermark is None or doc["updated_at"] > self._watermark:
+                            self._watermark = doc["updated_at"]
+                if time.monotonic() - last_reconcile >= RECONCILE_INTERVAL:
+                    # Polling cannot see deletes
+                    names = {doc["name"] for doc in self.collection.find({}, {"name": 1})}
+                    with self._lock:
+                        for name in [name for name in self._docs if name not in names]:
+                            self._forget(name)
+                    last_reconcile = time.monotonic()
+            except PyMongoError as e:
+                print(f"Scene cache poll error: {e}")
@@ -1,9 +1,12 @@
 
-import socket
 import json
 import base64
 from Crypto.Cipher import ARC4
 import time
+from sengled_udp_transport import encode_command, get_transport
+
+# Overall deadline per setup step; a bulb in setup mode answers slowly while scanning
+SETUP_TIMEOUT = 10
 
 class SengledSetupHelper:
     def __init__(self, bulb_ip="192.168.8.1", bulb_port=9080):
@@ -16,19 +19,13 @@ class SengledSetupHelper:
         
     def send_udp_command(self, command):
         """Send UDP command to bulb during setup"""
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(10)
-        
         try:
-            message = json.dumps(command).encode('utf-8')
-            sock.sendto(message, (self.bulb_ip, self.bulb_port))
-            
-            response, addr = sock.recvfrom(4096)
+            # Sent once: setup steps change the bulb's state and must not be repeated
+            response = get_transport().request_sync(self.bulb_ip, encode_command(command), port=self.bulb_port,
+                                                    timeout=SETUP_TIMEOUT, retries=0)
             return json.loads(response.decode('utf-8'))
         except Exception as e:
             return {"error": str(e)}
-        finally:
-            sock.close()
     
     def encrypt_setup_params(self, params):
         """Encrypt setup parameters using RC4"""
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Sengled Device State Cache
+==========================
+Last-known bulb attributes, keyed by device UUID.
+
+Every command reply updates the cache, so reads can be served from memory
+instead of a get_device_info round-trip. Entries older than the TTL are
+still returned (stale-while-revalidate) while a background refresh goes out
+over the shared UDP transport.
+
+Each change to a device's attributes bumps the cache version, so device
+lists can report only the devices whose state changed since a client's
+last poll.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+GET_DEVICE_INFO = {"func": "get_device_info", "param": {}}
+
+# Bulb command parameter -> cloud attribute name used in device lists
+PARAM_ATTRIBUTES = {
+    "color_temp": "colorTemperature",
+}
+
+
+def attributes_from_response(command, response):
+    """Work out which attributes a successful command reply tells us about"""
+    if not isinstance(response, dict) or "error" in response:
+        return None
+    result = response.get("result")
+    if isinstance(result, dict) and result.get("ret", 0) != 0:
+        return None
+
+    func = command.get("func", "") if isinstance(command, dict) else ""
+    if func == "get_device_info":
+        source = result if isinstance(result, dict) else {}
+    elif func.startswith("set_device_"):
+        source = command.get("param") or {}
+    else:
+        return None
+
+    return {PARAM_ATTRIBUTES.get(key, key): value
+            for key, value in source.items() if key != "ret"}
+
+
+class DeviceState:
+    __slots__ = ("attributes", "updated_at", "version")
+
+    def __init__(self, attributes, updated_at, version=0):
+        self.attributes = attributes
+        self.updated_at = updated_at
+        self.version = version
+
+    @property
+    def age(self):
+        return time.monotonic() - self.updated_at
+
+
+class DeviceStateCache:
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self._states = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+        # device_uuid -> version of its last attribute change, oldest first
+        self.version = 0
+        self._changes = OrderedDict()
+
+    def update(self, device_uuid, command, response):
+        """Merge whatever a command reply says about the device"""
+        attributes = attributes_from_response(command, response)
+        if attributes is not None:
+            self.merge(device_uuid, attributes)
+
+    def merge(self, device_uuid, attributes):
+        """Merge attributes a bulb reported itself (e.g. an MQTT status message)"""
+        with self._lock:
+            state = self._states.get(device_uuid)
+            merged = dict(state.attributes) if state else {}
+            merged.update(attributes)
+            if state is not None and merged == state.attributes:
+                # Same attributes: refresh the age without a new version
+                self._states[device_uuid] = DeviceState(merged, time.monotonic(), state.version)
+                return
+            self._record_change(device_uuid)
+            self._states[device_uuid] = DeviceState(merged, time.monotonic(), self.version)
+
+    def _record_change(self, device_uuid):
+        self.version += 1
+        self._changes[device_uuid] = self.version
+        self._changes.move_to_end(device_uuid)
+
+    def changed_since(self, version):
+        """UUIDs whose state changed after version, or None if version is unknown"""
+        if version > self.version:
+            return None
+        changed = []
+        with self._lock:
+            for device_uuid in reversed(self._changes):
+                if self._changes[device_uuid] <= version:
+                    break
+                changed.append(device_uuid)
+        return changed
+
+    def get(self, device_uuid):
+        """Return the cached DeviceState (fresh or stale) or None"""
+        return self._states.get(device_uuid)
+
+    def is_fresh(self, state, max_age=None):
+        return state is not None and state.age <= (self.ttl if max_age is None else max_age)
+
+    def forget(self, device_uuid):
+        with self._lock:
+            if self._states.pop(device_uuid, None) is not None:
+                self._record_change(device_uuid)
+
+    def refresh_in_background(self, transport, device_uuid, ip, callback=None, timeout=5):
+        """Fetch get_device_info without blocking; one refresh per device at a time.
+
+        callback(result_or_exception) runs on the transport loop once the
+        bulb answers or the request fails.
+        """
+        with self._lock:
+            if device_uuid in self._refreshing:
+                return False
+            self._refreshing.add(device_uuid)
+
+        async def refresh():
+            try:
+                result = await transport.send_command(ip, GET_DEVICE_INFO, timeout=timeout)
+                self.update(device_uuid, GET_DEVICE_INFO, result)
+            except Exception as e:
+                result = e
+            finally:
+                with self._lock:
+                    self._refreshing.discard(device_uuid)
+            if callback is not None:
+                callback(result)
+
+        transport.submit(refresh())
+        return True
+
+    def __len__(self):
+        return len(self._states)
@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+"""
+Sengled Telemetry
+=================
+Bulb state history in MongoDB, with bounded storage.
+
+A collector thread polls every known bulb with get_device_info over the
+shared UDP transport, a batch of bulbs at a time, and writes one sample per
+bulb with a single insert_many. Samples record whether the bulb answered,
+its round-trip time and the numeric attributes it reports (switch,
+brightness, color temperature, RSSI, uptime).
+
+Polling is opt-in (SengledMongoDBSystem(telemetry_interval=...)): the polls
+go straight to the transport rather than through the per-bulb command
+queue, so they are extra datagrams on top of the command traffic and are
+not counted against its rate limit.
+
+Raw samples go to a MongoDB time-series collection (MongoDB 5.0+). On older
+servers, or when the collection already exists as a plain collection, they
+are grouped into one bucket document per bulb per hour instead, which keeps
+the document and index count just as low.
+
+A rollup pass folds completed hours into telemetry_hourly and completed days
+into telemetry_daily (sample count, online ratio, avg/min/max per metric).
+Every tier has a TTL, so storage stays bounded; history() reads from the
+coarsest tier that still answers the requested range well, so months of
+data for hundreds of bulbs is a few thousand small documents.
+"""
+
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import CollectionInvalid, OperationFailure, PyMongoError
+
+from sengled_indexes import ensure_ttl
+from sengled_state_cache import GET_DEVICE_INFO, attributes_from_response
+
+POLL_INTERVAL = 60
+BATCH_SIZE = 256
+POLL_TIMEOUT = 2
+ROLLUP_INTERVAL = 300
+
+# Retention per tier, in seconds (None = keep forever)
+RAW_RETENTION = 7 * 86400
+HOURLY_RETENTION = 90 * 86400
+DAILY_RETENTION = 2 * 365 * 86400
+
+# Numeric attributes kept from get_device_info replies
+METRICS = ("switch", "brightness", "colorTemperature", "rssi", "uptime", "rtt_ms")
+
+NUMBER_TYPES = ["int", "long", "double", "decimal"]
+
+HOUR = timedelta(hours=1)
+DAY = timedelta(days=1)
+
+
+def _utc(when):
+    """Naive UTC datetime, comparable with what pymongo returns"""
+    if when.tzinfo is not None:
+        when = when.astimezone(timezone.utc).replace(tzinfo=None)
+    return when
+
+
+def _floor(when, step):
+    """Start of the hour or day containing when (naive UTC, like pymongo)"""
+    when = _utc(when)
+    if step >= DAY:
+        return when.replace(hour=0, minute=0, second=0, microsecond=0)
+    return when.replace(minute=0, second=0, microsecond=0)
+
+
+def make_sample(device_uuid, timestamp, reply, latency):
+    """One telemetry sample from a get_device_info reply (or exception)"""
+    sample = {"timestamp": timestamp, "device_uuid": device_uuid}
+    attributes = None if isinstance(reply, Exception) else attributes_from_response(GET_DEVICE_INFO, reply)
+    sample["online"] = attributes is not None
+    if attributes is None:
+        return sample
+
+    sample["rtt_ms"] = round(latency * 1000, 2)
+    for name in METRICS:
+        value = attributes.get(name)
+        if isinstance(value, bool):
+            value = int(value)
+        elif isinstance(value, str):
+            try:
+                value = float(value)
+            except ValueError:
+                continue
+        if isinstance(value, (int, float)):
+            sample[name] = value
+    return sample
+
+
+class TelemetryStore:
+    def __init__(self, db, collection_name="telemetry",
+                 raw_retention=RAW_RETENTION, hourly_retention=HOURLY_RETENTION,
+                 daily_retention=DAILY_RETENTION):
+        self.db = db
+        self.raw_retention = raw_retention
+        self.hourly_retention = hourly_retention
+        self.daily_retention = daily_retention
+
+        self.raw = db[collection_name]
+        self.hourly = db[f"{collection_name}_hourly"]
+        self.daily = db[f"{collection_name}_daily"]
+        self.timeseries = self._ensure_raw(collection_name)
+        for rollup, retention in ((self.hourly, hourly_retention), (self.daily, daily_retention)):
+            rollup.create_index([("device_uuid", ASCENDING), ("period", ASCENDING)], unique=True)
+            ensure_ttl(rollup, "period", retention)
+
+        self._rolled = {"hourly": self._last_period(self.hourly), "daily": self._last_period(self.daily)}
+
+    def _ensure_raw(self, name):
+        """Use (or create) a time-series collection; fall back to hourly buckets"""
+        existing = list(self.db.list_collections(filter={"name": name}))
+        if existing:
+            options = existing[0].get("options", {})
+            timeseries = "timeseries" in options
+            if timeseries and options.get("expireAfterSeconds") != self.raw_retention:
+                # Retention changed since the collection was created
+                self.db.command("collMod", name,
+                                expireAfterSeconds=self.raw_retention if self.raw_retention else "off")
+        else:
+            try:
+                self.db.create_collection(
+                    name,
+                    timeseries={"timeField": "timestamp", "metaField": "device_uuid", "granularity": "minutes"},
+                    **({"expireAfterSeconds": self.raw_retention} if self.raw_retention else {})
+                )
+                timeseries = True
+            except CollectionInvalid:
+                # Created by another process meanwhile
+                return self._ensure_raw(name)
+            except OperationFailure:
+                # Server older than 5.0
+                timeseries = False
+
+        if timeseries:
+            self.raw.create_index([("device_uuid", ASCENDING), ("timestamp", ASCENDING)])
+        else:
+            self.raw.create_index([("device_uuid", ASCENDING), ("bucket", ASCENDING)], unique=True)
+            ensure_ttl(self.raw, "bucket", self.raw_retention)
+        return timeseries
+
+    @staticmethod
+    def _last_period(collection):
+        latest = collection.find_one({}, {"period": 1}, sort=[("period", -1)])
+        return latest["period"] if latest else None
+
+    # ------------------------------------------------------------------
+    # Writes
+    # ------------------------------------------------------------------
+
+    def insert(self, samples):
+        """Write a batch of samples in one round-trip"""
+        if not samples:
+            return
+        if self.timeseries:
+            self.raw.insert_many(samples, ordered=False)
+            return
+
+        buckets = {}
+        for sample in samples:
+            key = (sample["device_uuid"], _floor(sample["timestamp"], HOUR))
+            buckets.setdefault(key, []).append(sample)
+        self.raw.bulk_write(
+            [UpdateOne({"device_uuid": device_uuid, "bucket": bucket},
+                       {"$push": {"samples": {"$each": batch}},
+                        "$inc": {"count": len(batch)}},
+                       upsert=True)
+             for (device_uuid, bucket), batch in buckets.items()],
+            ordered=False
+        )
+
+    # ------------------------------------------------------------------
+    # Rollups
+    # ------------------------------------------------------------------
+
+    def _samples_pipeline(self, start, end):
+        """Pipeline prefix yielding raw samples with start <= timestamp < end"""
+        if self.timeseries:
+            return [{"$match": {"timestamp": {"$gte": start, "$lt": end}}}]
+        return [
+            {"$match": {"bucket": {"$gte": _floor(start, HOUR), "$lt": end}}},
+            {"$unwind": "$samples"},
+            {"$replaceRoot": {"newRoot": "$samples"}},
+            {"$match": {"timestamp": {"$gte": start, "$lt": end}}},
+        ]
+
+    @staticmethod
+    def _summarise(time_field, step, from_samples):
+        step_ms = int(step.total_seconds() * 1000)
+        timestamp = f"${time_field}"
+        group = {"_id": {
+            "device_uuid": "$device_uuid",
+            "period": {"$subtract": [timestamp, {"$mod": [{"$toLong": timestamp}, step_ms]}]},
+        }}
+        if from_samples:
+            group["samples"] = {"$sum": 1}
+            group["online"] = {"$sum": {"$cond": ["$online", 1, 0]}}
+            for name in METRICS:
+                group[f"{name}_sum"] = {"$sum": f"${name}"}
+                group[f"{name}_n"] = {"$sum": {"$cond": [{"$in": [{"$type": f"${name}"}, NUMBER_TYPES]}, 1, 0]}}
+                group[f"{name}_min"] = {"$min": f"${name}"}
+                group[f"{name}_max"] = {"$max": f"${name}"}
+        else:
+            # Re-aggregate finer rollups: sums and counts combine exactly
+            group["samples"] = {"$sum": "$samples"}
+            group["online"] = {"$sum": "$online"}
+            for name in METRICS:
+                group[f"{name}_sum"] = {"$sum": f"${name}.sum"}
+                group[f"{name}_n"] = {"$sum": f"${name}.n"}
+                group[f"{name}_min"] = {"$min": f"${name}.min"}
+                group[f"{name}_max"] = {"$max": f"${name}.max"}
+
+        project = {
+            "_id": 0,
+            "device_uuid": "$_id.device_uuid",
+            "period": {"$toDate": "$_id.period"},
+            "samples": 1,
+            "online": 1,
+            "online_ratio": {"$divide": ["$online", "$samples"]},
+        }
+        for name in METRICS:
+            project[name] = {"$cond": [
+                {"$gt": [f"${name}_n", 0]},
+                {"sum": f"${name}_sum", "n": f"${name}_n",
+                 "avg": {"$divide": [f"${name}_sum", f"${name}_n"]},
+                 "min": f"${name}_min", "max": f"${name}_max"},
+                "$$REMOVE",
+            ]}
+        return [{"$group": group}, {"$project": project}]
+
+    def _merge(self, pipeline, source, target):
+        pipeline.append({"$merge": {"into": target.name, "on": ["device_uuid", "period"],
+                                    "whenMatched": "replace", "whenNotMatched": "insert"}})
+        list(source.aggregate(pipeline, allowDiskUse=True))
+
+    def rollup(self, now=None):
+        """Fold completed hours and days into the rollup tiers.
+
+        Re-running a period replaces its rollup, so this is safe to call from
+        several processes or after a crash half-way through.
+        """
+        now = _utc(now or datetime.now(timezone.utc))
+        rolled = 0
+
+        hour_end = _floor(now, HOUR)
+        start = self._rolled["hourly"]
+        start = start + HOUR if start else _floor(now - timedelta(seconds=self.raw_retention or RAW_RETENTION), HOUR)
+        if start < hour_end:
+            pipeline = self._samples_pipeline(start, hour_end) + self._summarise("timestamp", HOUR, True)
+            self._merge(pipeline, self.raw, self.hourly)
+            self._rolled["hourly"] = hour_end - HOUR
+            rolled += 1
+
+        day_end = _floor(now, DAY)
+        start = self._rolled["daily"]
+        start = start + DAY if start else _floor(now - timedelta(seconds=self.hourly_retention or HOURLY_RETENTION), DAY)
+        if start < day_end:
+            pipeline = [{"$match": {"period": {"$gte": start, "$lt": day_end}}}] + \
+                self._summarise("period", DAY, False)
+            self._merge(pipeline, self.hourly, self.daily)
+            self._rolled["daily"] = day_end - DAY
+            rolled += 1
+
+        return rolled
+
+    # ------------------------------------------------------------------
+    # Queries
+    # ------------------------------------------------------------------
+
+    def history(self, device_uuid, start, end=None, resolution="auto"):
+        """Samples or rollups for one bulb, oldest first.
+
+        resolution is raw, hourly, daily or auto (raw up to two days, hourly
+        up to sixty, daily beyond).
+        """
+        start = _utc(start)
+        end = _utc(end or datetime.now(timezone.utc))
+        if resolution == "auto":
+            span = end - start
+            resolution = "raw" if span <= 2 * DAY else "hourly" if span <= 60 * DAY else "daily"
+
+        if resolution == "raw":
+            pipeline = self._samples_pipeline(start, end)
+            pipeline[0]["$match"]["device_uuid"] = device_uuid
+            pipeline += [{"$sort": {"timestamp": 1}}, {"$project": {"_id": 0}}]
+            return list(self.raw.aggregate(pipeline))
+        if resolution not in ("hourly", "daily"):
+            raise ValueError(f"Unknown resolution: {resolution!r}")
+
+        collection = self.hourly if resolution == "hourly" else self.daily
+        return list(collection.find(
+            {"device_uuid": device_uuid, "period": {"$gte": _floor(start, HOUR if resolution == "hourly" else DAY),
+                                                    "$lt": end}},
+            {"_id": 0}
+        ).sort("period", ASCENDING))
+
+
+class TelemetryCollector:
+    def __init__(self, store, transport, targets, interval=POLL_INTERVAL,
+                 batch_size=BATCH_SIZE, timeout=POLL_TIMEOUT, rollup_interval=ROLLUP_INTERVAL,
+                 on_reply=None):
+        """targets() returns {device_uuid: ip} of the bulbs to poll.
+
+        on_reply(device_uuid, reply) sees every successful reply, so the
+        caller can feed its state cache from the same round-trip.
+        """
+        self.store = store
+        self.transport = transport
+        self.targets = targets
+        self.interval = interval
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.rollup_interval = rollup_interval
+        self.on_reply = on_reply
+
+        self._stopped = threading.Event()
+        self._thread = None
+
+        # Stats
+        self.polls = 0
+        self.samples = 0
+        self.failed_writes = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="sengled-telemetry", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def poll_once(self):
+        """Poll every target once and store the samples; returns the sample count"""
+        targets = list(self.targets().items())
+        written = 0
+        for offset in range(0, len(targets), self.batch_size):
+            batch = targets[offset:offset + self.batch_size]
+            timestamp = datetime.now(timezone.utc)
+            outcomes = self.transport.fan_out_sync(
+                [(device_uuid, ip, GET_DEVICE_INFO) for device_uuid, ip in batch],
+                timeout=self.timeout
+            )
+
+            samples = []
+            for device_uuid, (reply, latency) in outcomes.items():
+                sample = make_sample(device_uuid, timestamp, reply, latency)
+                samples.append(sample)
+                if sample["online"] and self.on_reply is not None:
+                    self.on_reply(device_uuid, reply)
+
+            try:
+                self.store.insert(samples)
+                written += len(samples)
+            except PyMongoError as e:
+                self.failed_writes += 1
+                print(f"Telemetry write error ({len(samples)} samples lost): {e}")
+
+        self.polls += 1
+        self.samples += written
+        return written
+
+    def _run(self):
+        next_poll = time.monotonic()
+        next_rollup = next_poll
+        while not self._stopped.is_set():
+            now = time.monotonic()
+            if now >= next_poll:
+                try:
+                    self.poll_once()
+                except Exception as e:
+                    print(f"Telemetry poll error: {e}")
+                next_poll = now + self.interval
+            if now >= next_rollup:
+                try:
+                    self.store.rollup()
+                except PyMongoError as e:
+                    print(f"Telemetry rollup error: {e}")
+                next_rollup = now + self.rollup_interval
+            self._stopped.wait(max(0.0, min(next_poll, next_rollup) - time.monotonic()))
@@ -0,0 +1,525 @@
+#!/usr/bin/env python3
+"""
+Sengled UDP Transport
+=====================
+One shared asyncio datagram socket for all port 9080 bulb traffic.
+
+Every command used to open its own socket and block in recvfrom. This
+transport keeps a single socket on a background event loop and lets any
+number of bulbs be commanded at once. It offers both a blocking API (for
+Flask handlers and scripts) and an async API (usable from any event loop).
+
+Bulbs do not tag their replies (a reply is often just {"result": {"ret": 0}}),
+so replies are matched to requests by address, with at most one request in
+flight per bulb address; further requests to the same bulb wait their turn.
+When a reply does echo the request's func (or setup name) and it names a
+different request, it is a late reply and is dropped, as is any datagram
+from an address whose request already finished. After a retransmitted or
+unanswered request (unicast or broadcast) the address stays reserved for
+one more RTO, so a straggling reply is dropped rather than handed to the
+next request.
+
+Requests are retransmitted on a per-bulb timeout derived from measured
+round trips (see sengled_rtt). The timeout argument of every call is the
+overall deadline for the request, retries included.
+"""
+
+import asyncio
+import json
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+from sengled_metrics import COMMAND_RETRIES, UDP_ROUNDTRIP, UDP_TIMEOUTS
+from sengled_rtt import DEAD_PROBE_TIMEOUT, MAX_RETRIES, RTTEstimator
+
+BULB_PORT = 9080
+DEFAULT_TIMEOUT = 5
+# Bulb addresses with an RTT estimate; the least recently used are forgotten
+MAX_ESTIMATORS = 4096
+
+
+class SengledUDPTransport:
+    def __init__(self, bind_host="0.0.0.0", bind_port=0, default_port=BULB_PORT,
+                 max_retries=MAX_RETRIES):
+        self.bind_host = bind_host
+        self.bind_port = bind_port
+        self.default_port = default_port
+        self.max_retries = max_retries
+
+        self._loop = None
+        self._thread = None
+        self._transport = None
+        self._started = threading.Event()
+        self._start_lock = threading.Lock()
+
+        # (ip, port) -> _Channel of the request in flight to that address
+        self._channels = {}
+        # Callbacks for datagrams nobody is waiting for (broadcast replies)
+        self._listeners = []
+        # (ip, port) -> RTTEstimator, least recently used first
+        self._estimators = OrderedDict()
+
+        # Stats
+        self.retransmissions = 0
+
+    # ------------------------------------------------------------------
+    # Lifecycle
+    # ------------------------------------------------------------------
+
+    def start(self):
+        """Start the event loop thread and open the shared socket"""
+        with self._start_lock:
+            if self._started.is_set():
+                return self
+            self._thread = threading.Thread(target=self._run_loop, name="sengled-udp", daemon=True)
+            self._thread.start()
+            self._started.wait()
+            if self._transport is None:
+                raise OSError(f"Could not open UDP socket on {self.bind_host}:{self.bind_port}")
+        return self
+
+    def _run_loop(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._transport, _ = self._loop.run_until_complete(
+                self._loop.create_datagram_endpoint(
+                    lambda: _BulbProtocol(self),
+                    local_addr=(self.bind_host, self.bind_port),
+                    allow_broadcast=True,
+                )
+            )
+            sock = self._transport.get_extra_info("socket")
+            # Large receive buffer so a subnet sweep's burst of replies is not dropped
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        except Exception as e:
+            print(f"UDP transport error: {e}")
+            self._started.set()
+            return
+
+        self._started.set()
+        self._loop.run_forever()
+
+    def close(self):
+        """Close the socket and stop the event loop"""
+        if not self._started.is_set() or self._loop is None:
+            return
+        self._loop.call_soon_threadsafe(self._shutdown)
+        self._thread.join(timeout=5)
+        self._started.clear()
+
+    def _shutdown(self):
+        if self._transport is not None:
+            self._transport.close()
+        for channel in self._channels.values():
+            if channel.future is not None and not channel.future.done():
+                channel.future.set_exception(ConnectionAbortedError("UDP transport closed"))
+        self._channels.clear()
+        self._loop.stop()
+
+    @property
+    def local_address(self):
+        """(host, port) the shared socket is bound to"""
+        self.start()
+        return self._transport.get_extra_info("sockname")
+
+    # ------------------------------------------------------------------
+    # Loop plumbing
+    # ------------------------------------------------------------------
+
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the transport loop and block for its result"""
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result(timeout)
+
+    def submit(self, coro):
+        """Schedule a coroutine on the transport loop without waiting"""
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    async def _on_loop(self, coro):
+        """Await a coroutine on the transport loop from whichever loop we are on"""
+        self.start()
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            return await coro
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self._loop))
+
+    # ------------------------------------------------------------------
+    # Datagram handling
+    # ------------------------------------------------------------------
+
+    def _dispatch(self, data, addr):
+        key = (addr[0], addr[1])
+        estimator = self._estimators.get(key)
+        if estimator is not None and estimator.failures:
+            estimator.alive()
+
+        channel = self._channels.get(key)
+        if channel is not None:
+            future = channel.future
+            if future is not None and not future.done() and _answers(data, channel.tag):
+                future.set_result(data)
+            # Anything else from a bulb we are talking to is a late reply
+            return
+
+        for listener in list(self._listeners):
+            try:
+                listener(data, addr)
+            except Exception as e:
+                print(f"UDP listener error: {e}")
+
+    def add_listener(self, callback):
+        """Receive datagrams from addresses no request is talking to"""
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    def sendto(self, payload, ip, port=None):
+        """Fire-and-forget a raw datagram (must be called on the loop)"""
+        self._transport.sendto(payload, (ip, port or self.default_port))
+
+    # ------------------------------------------------------------------
+    # One request per address
+    # ------------------------------------------------------------------
+
+    async def _acquire(self, key, deadline):
+        """Wait (until the loop time deadline) for the address to be free"""
+        channel = self._channels.get(key)
+        if channel is None:
+            channel = self._channels[key] = _Channel()
+        channel.users += 1
+        try:
+            if channel.lock.locked():
+                await asyncio.wait_for(channel.lock.acquire(), max(deadline - self._loop.time(), 0))
+            else:
+                await channel.lock.acquire()
+        except BaseException:
+            self._forget(key, channel)
+            raise
+        return channel
+
+    def _release(self, key, channel):
+        channel.future = None
+        channel.tag = None
+        channel.lock.release()
+        self._forget(key, channel)
+
+    def _forget(self, key, channel):
+        channel.users -= 1
+        if not channel.users and self._channels.get(key) is channel:
+            del self._channels[key]
+
+    # ------------------------------------------------------------------
+    # Round-trip estimation
+    # ------------------------------------------------------------------
+
+    def _estimator(self, key):
+        estimator = self._estimators.get(key)
+        if estimator is None:
+            estimator = self._estimators[key] = RTTEstimator()
+            if len(self._estimators) > MAX_ESTIMATORS:
+                self._estimators.popitem(last=False)
+        else:
+            self._estimators.move_to_end(key)
+        return estimator
+
+    def rtt(self, ip, port=None):
+        """The bulb's RTT estimate as a dict, or None if it was never contacted"""
+        estimator = self._estimators.get((ip, port or self.default_port))
+        return None if estimator is None else estimator.to_dict()
+
+    # ------------------------------------------------------------------
+    # Async API
+    # ------------------------------------------------------------------
+
+    async def _request(self, ip, payload, port, timeout, retries=None, probe=False):
+        key = (ip, port or self.default_port)
+        deadline = self._loop.time() + timeout
+        try:
+            channel = await self._acquire(key, deadline)
+        except asyncio.TimeoutError:
+            if not probe:
+                UDP_TIMEOUTS.labels(ip).inc()
+            raise socket.timeout("timed out") from None
+        if probe:
+            # Possibly not a bulb at all: leave no estimate, stats or metrics behind
+            estimator = self._estimators.get(key) or RTTEstimator()
+            if retries is None:
+                retries = 0
+        else:
+            estimator = self._estimator(key)
+        future = channel.future = self._loop.create_future()
+        channel.tag = _request_tag(payload)
+        # Known unresponsive bulbs get one short probe instead of a full retry cycle
+        dead = estimator.dead
+        attempts = 1 if dead else 1 + (self.max_retries if retries is None else retries)
+        sent_at = None
+        clean = False
+        try:
+            started = time.perf_counter()
+            for attempt in range(attempts):
+                remaining = deadline - self._loop.time()
+                if remaining <= 0:
+                    break
+                if attempt:
+                    estimator.backoff()
+                    if not probe:
+                        self.retransmissions += 1
+                        COMMAND_RETRIES.labels(ip).inc()
+                self._transport.sendto(payload, key)
+                sent_at = self._loop.time()
+                if dead:
+                    wait = min(DEAD_PROBE_TIMEOUT, remaining)
+                elif attempts == 1:
+                    # No retransmissions: wait out the whole deadline as a plain request would
+                    wait = remaining
+                else:
+                    wait = min(estimator.rto, remaining)
+                done, _ = await asyncio.wait((future,), timeout=wait)
+                if not done:
+                    continue
+
+                response = future.result()
+                rtt = time.perf_counter() - started
+                if probe:
+                    return response
+                UDP_ROUNDTRIP.observe(rtt)
+                if attempt == 0:
+                    estimator.sample(rtt)
+                    clean = True
+                else:
+                    # Karn's rule: ambiguous round trip, keep the backed-off timeout
+                    estimator.alive()
+                return response
+
+            if not probe:
+                estimator.failed()
+                UDP_TIMEOUTS.labels(ip).inc()
+            raise socket.timeout("timed out")
+        finally:
+            hold_until = 0
+            if sent_at is not None and not clean:
+                # Retransmitted or unanswered: replies to earlier transmissions may
+                # still arrive, so keep the address for a whole RTO after the last send
+                hold_until = sent_at + (DEAD_PROBE_TIMEOUT if dead else estimator.rto)
+            if hold_until > self._loop.time():
+                channel.future = None
+                self._loop.call_at(hold_until, self._release, key, channel)
+            else:
+                self._release(key, channel)
+
+    async def request(self, ip, payload, port=None, timeout=DEFAULT_TIMEOUT, retries=None, probe=False):
+        """Send raw bytes to a bulb and return the raw reply.
+
+        retries overrides the transport's retransmission limit. probe=True is
+        for addresses that may well not be bulbs (scans, neighbour checks):
+        sent once unless retries says otherwise, and nothing is recorded.
+        """
+        return await self._on_loop(self._request(ip, payload, port, timeout, retries, probe))
+
+    async def send_command(self, ip, command, port=None, timeout=DEFAULT_TIMEOUT):
+        """Send a JSON command to a bulb and return the decoded reply"""
+        response = await self.request(ip, encode_command(command), port, timeout)
+        return json.loads(response.decode('utf-8'))
+
+    async def _fan_out(self, targets, timeout):
+        async def one(key, ip, command):
+            start = time.perf_counter()
+            try:
+                payload = command if isinstance(command, bytes) else encode_command(command)
+                response = await self._request(ip, payload, None, timeout)
+                result = json.loads(response.decode('utf-8'))
+            except Exception as e:
+                result = e
+            return key, result, time.perf_counter() - start
+
+        outcomes = await asyncio.gather(*(one(*target) for target in targets))
+        return {key: (result, latency) for key, result, latency in outcomes}
+
+    async def fan_out(self, targets, timeout=DEFAULT_TIMEOUT):
+        """Send many commands at once.
+
+        targets is an iterable of (key, ip, command) where command is a dict or
+        pre-encoded bytes. Returns {key: (reply_or_exception, latency_seconds)}.
+        """
+        return await self._on_loop(self._fan_out(list(targets), timeout))
+
+    async def _broadcast(self, payload, address, expected, port, timeout):
+        port = port or self.default_port
+        deadline = self._loop.time() + timeout
+        payload = encode_command(payload)
+        tag = _request_tag(payload)
+        channels = {}
+        unanswered = set()
+        try:
+            # Same order every time, so overlapping broadcasts cannot deadlock
+            for ip in sorted(expected):
+                try:
+                    channels[ip] = await self._acquire((ip, port), deadline)
+                except asyncio.TimeoutError:
+                    pass
+            for channel in channels.values():
+                channel.future = self._loop.create_future()
+                channel.tag = tag
+
+            start = time.perf_counter()
+            try:
+                self._transport.sendto(payload, (address, port))
+            except OSError as e:
+                for channel in channels.values():
+                    channel.future.set_exception(e)
+
+            async def one(ip):
+                channel = channels.get(ip)
+                try:
+                    if channel is None:
+                        raise asyncio.TimeoutError
+                    response = await asyncio.wait_for(channel.future, max(deadline - self._loop.time(), 0))
+                    # Sent once, so the round trip is unambiguous
+                    self._estimator((ip, port)).sample(time.perf_counter() - start)
+                    result = json.loads(response.decode('utf-8'))
+                except asyncio.TimeoutError:
+                    unanswered.add(ip)
+                    result = socket.timeout("timed out")
+                except Exception as e:
+                    result = e
+                return ip, result, time.perf_counter() - start
+
+            outcomes = await asyncio.gather(*(one(ip) for ip in expected))
+        finally:
+            now = self._loop.time()
+            for ip, channel in channels.items():
+                if ip in unanswered:
+                    # A late reply must not be taken for the next request's: drop
+                    # whatever this address sends for one more RTO, as _request does
+                    channel.future = None
+                    self._loop.call_at(now + self._estimator((ip, port)).rto, self._release, (ip, port), channel)
+                else:
+                    self._release((ip, port), channel)
+        return {ip: (result, latency) for ip, result, latency in outcomes}
+
+    async def broadcast(self, payload, address, expected, port=None, timeout=DEFAULT_TIMEOUT):
+        """Send one datagram to a broadcast address and collect the expected replies.
+
+        expected lists the bulb IPs that should answer. Returns
+        {ip: (reply_or_exception, latency_seconds)} like fan_out().
+        """
+        return await self._on_loop(self._broadcast(payload, address, list(expected), port, timeout))
+
+    # ------------------------------------------------------------------
+    # Blocking API
+    # ------------------------------------------------------------------
+
+    def request_sync(self, ip, payload, port=None, timeout=DEFAULT_TIMEOUT, retries=None, probe=False):
+        return self.run(self._request(ip, payload, port, timeout, retries, probe))
+
+    def send_command_sync(self, ip, command, port=None, timeout=DEFAULT_TIMEOUT):
+        response = self.request_sync(ip, encode_command(command), port, timeout)
+        return json.loads(response.decode('utf-8'))
+
+    def fan_out_sync(self, targets, timeout=DEFAULT_TIMEOUT):
+        return self.run(self._fan_out(list(targets), timeout))
+
+    def broadcast_sync(self, payload, address, expected, port=None, timeout=DEFAULT_TIMEOUT):
+        return self.run(self._broadcast(payload, address, list(expected), port, timeout))
+
+
+class _Channel:
+    """The request in flight to one bulb address"""
+    __slots__ = ("lock", "users", "future", "tag")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        # Requests holding or waiting for the lock; the channel goes when it drops to 0
+        self.users = 0
+        self.future = None
+        self.tag = None
+
+
+def _request_tag(payload):
+    """("func", value) or ("name", value) of a JSON request, None if it has neither"""
+    try:
+        message = json.loads(payload)
+    except ValueError:
+        return None
+    if isinstance(message, dict):
+        for field in ("func", "name"):
+            if isinstance(message.get(field), str):
+                return field, message[field]
+    return None
+
+
+def _answers(data, tag):
+    """False only when the reply echoes a different func/name than the request"""
+    if tag is None or (b'"func"' not in data and b'"name"' not in data):
+        return True
+    try:
+        reply = json.loads(data)
+    except ValueError:
+        return True
+    field, value = tag
+    echoed = reply.get(field) if isinstance(reply, dict) else None
+    if not isinstance(echoed, str):
+        return True
+    if field == "name":
+        # Setup replies answer fooRequest with fooResponse
+        return echoed in (value, value.replace("Request", "Response"))
+    return echoed == value
+
+
+class _BulbProtocol(asyncio.DatagramProtocol):
+    def __init__(self, owner):
+        self.owner = owner
+
+    def datagram_received(self, data, addr):
+        self.owner._dispatch(data, addr)
+
+    def error_received(self, exc):
+        # ICMP port unreachable etc. - the request will simply time out
+        pass
+
+
+class RateLimiter:
+    """Space awaiting callers out to at most `rate` per second"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = 0.0
+
+    async def wait(self):
+        if not self.interval:
+            return
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        slot = max(now, self._next)
+        self._next = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+def encode_command(command):
+    """Encode a command dict the way bulbs expect it"""
+    if isinstance(command, bytes):
+        return command
+    return json.dumps(command).encode('utf-8')
+
+
+_shared_transport = None
+_shared_lock = threading.Lock()
+
+
+def get_transport():
+    """Return the process-wide shared transport, starting it on first use"""
+    global _shared_transport
+    with _shared_lock:
+        if _shared_transport is None:
+            _shared_transport = SengledUDPTransport().start()
+        return _shared_transport
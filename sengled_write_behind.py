@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Sengled Write-Behind Logger
+===========================
+Takes MongoDB logging off the bulb command hot path.
+
+Command documents, last_seen updates, device upserts (discovery,
+address changes) and scene, group and schedule edits are queued in memory
+and a background thread flushes them with insert_many / bulk_write whenever the
+batch fills up or the flush interval passes. The queue is bounded; when it
+is full the overflow policy decides what gives:
+
+- "drop_oldest" (default): discard the oldest queued write, keep the newest
+- "drop_newest": discard the incoming write
+- "block": make the caller wait for room
+
+Everything still queued is flushed on close() and at interpreter exit.
+
+With journal=True, a batch MongoDB cannot take is appended to a local
+journal (see sengled_journal) and replayed once the database is back,
+instead of being lost. Command documents get their _id when they are
+queued, so a replayed batch never inserts a command twice.
+"""
+
+import atexit
+import threading
+import time
+from collections import deque
+from bson import ObjectId
+from pymongo import DeleteOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from sengled_journal import WriteJournal
+from sengled_metrics import MONGO_FLUSH, MONGO_WRITES
+
+OVERFLOW_POLICIES = ("drop_oldest", "drop_newest", "block")
+
+DUPLICATE_KEY = 11000
+
+
+class MongoWriteBehind:
+    def __init__(self, commands, devices, batch_size=500, flush_interval=1.0,
+                 max_queue=10000, overflow="drop_oldest", journal=False, journal_path=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"overflow must be one of {OVERFLOW_POLICIES}")
+
+        self.commands = commands
+        self.devices = devices
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.overflow = overflow
+
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._flushing = False
+        self._flush_requested = False
+
+        # Counters for monitoring
+        self.dropped = 0
+        self.written = 0
+        self.failed_batches = 0
+
+        # Failed batches go to the local journal and are replayed later
+        self.journal = WriteJournal(self._apply, journal_path) if journal else None
+
+        self._thread = threading.Thread(target=self._run, name="sengled-write-behind", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # ------------------------------------------------------------------
+    # Producer side (hot path)
+    # ------------------------------------------------------------------
+
+    def log_command(self, command_doc):
+        """Queue a document for the commands collection"""
+        # A fixed _id makes a retried or replayed insert a no-op
+        command_doc.setdefault("_id", ObjectId())
+        self._put(("command", command_doc))
+
+    def touch_device(self, device_uuid, when):
+        """Queue a last_seen update for a device"""
+        self._put(("seen", device_uuid, when))
+
+    def upsert_device(self, device_uuid, fields):
+        """Queue a $set upsert of a device document"""
+        self._put(("device", device_uuid, fields))
+
+    def upsert(self, collection, query, update):
+        """Queue an upsert in another collection of the database, by name"""
+        self._put(("upsert", collection, query, update))
+
+    def delete(self, collection, query):
+        """Queue a delete_one in another collection of the database, by name"""
+        self._put(("delete", collection, query))
+
+    def _put(self, item):
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("write-behind logger is closed")
+
+            while len(self._queue) >= self.max_queue:
+                if self.overflow == "drop_oldest":
+                    self._queue.popleft()
+                    self.dropped += 1
+                    MONGO_WRITES.labels("dropped").inc()
+                elif self.overflow == "drop_newest":
+                    self.dropped += 1
+                    MONGO_WRITES.labels("dropped").inc()
+                    return
+                else:
+                    self._cond.wait()
+
+            self._queue.append(item)
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify_all()
+
+    # ------------------------------------------------------------------
+    # Consumer side
+    # ------------------------------------------------------------------
+
+    def _run(self):
+        while True:
+            with self._cond:
+                deadline = time.monotonic() + self.flush_interval
+                while (not self._closed and not self._flush_requested
+                       and len(self._queue) < self.batch_size):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+                batch = self._drain()
+                closed = self._closed
+
+            if batch:
+                self._write(batch)
+            if closed:
+                with self._cond:
+                    if not self._queue:
+                        return
+
+    def _drain(self):
+        """Take up to one batch off the queue (caller holds the lock)"""
+        count = min(len(self._queue), self.batch_size)
+        batch = [self._queue.popleft() for _ in range(count)]
+        if not self._queue:
+            self._flush_requested = False
+        if batch:
+            self._flushing = True
+            # Room freed up for blocked producers
+            self._cond.notify_all()
+        return batch
+
+    def _write(self, batch):
+        try:
+            if self.journal is not None and self.journal.append_if_pending(batch):
+                # Older writes are still waiting to be replayed; queue behind them
+                MONGO_WRITES.labels("journaled").inc(len(batch))
+                return
+            started = time.perf_counter()
+            try:
+                self._apply(batch)
+                self.written += len(batch)
+                MONGO_WRITES.labels("written").inc(len(batch))
+            except Exception as e:
+                self.failed_batches += 1
+                if self.journal is None:
+                    MONGO_WRITES.labels("lost").inc(len(batch))
+                    print(f"Write-behind flush error ({len(batch)} writes lost): {e}")
+                    return
+                self.journal.append(batch)
+                MONGO_WRITES.labels("journaled").inc(len(batch))
+                print(f"Write-behind flush error ({len(batch)} writes journaled): {e}")
+            finally:
+                MONGO_FLUSH.observe(time.perf_counter() - started)
+        except OSError as e:
+            MONGO_WRITES.labels("lost").inc(len(batch))
+            print(f"Write-behind journal error ({len(batch)} writes lost): {e}")
+        finally:
+            with self._cond:
+                self._flushing = False
+                self._cond.notify_all()
+
+    def _apply(self, batch):
+        """Write a batch to MongoDB; safe to repeat"""
+        command_docs = []
+        upserts = {}
+        last_seen = {}
+        edits = {}
+        for item in batch:
+            if item[0] == "command":
+                command_docs.append(item[1])
+            elif item[0] == "upsert":
+                _, collection, query, update = item
+                edits.setdefault(collection, []).append(UpdateOne(query, update, upsert=True))
+            elif item[0] == "delete":
+                _, collection, query = item
+                edits.setdefault(collection, []).append(DeleteOne(query))
+            elif item[0] == "device":
+                # Later fields win, as if the upserts ran one after another
+                _, device_uuid, fields = item
+                upserts.setdefault(device_uuid, {}).update(fields)
+            else:
+                _, device_uuid, when = item
+                if device_uuid not in last_seen or when > last_seen[device_uuid]:
+                    last_seen[device_uuid] = when
+
+        if command_docs:
+            try:
+                self.commands.insert_many(command_docs, ordered=False)
+            except BulkWriteError as e:
+                # Documents already inserted by an earlier attempt are fine
+                details = e.details
+                if details.get("writeConcernErrors") or any(
+                        error.get("code") != DUPLICATE_KEY for error in details.get("writeErrors", [])):
+                    raise
+        if upserts:
+            self.devices.bulk_write(
+                [UpdateOne({"device_uuid": uuid}, {"$set": fields}, upsert=True)
+                 for uuid, fields in upserts.items()],
+                ordered=False
+            )
+        if last_seen:
+            self.devices.bulk_write(
+                [UpdateOne({"device_uuid": uuid}, {"$max": {"last_seen": when}})
+                 for uuid, when in last_seen.items()],
+                ordered=False
+            )
+        for collection, requests in edits.items():
+            # In order: a delete after an upsert of the same name must win
+            self.commands.database[collection].bulk_write(requests, ordered=True)
+
+    # ------------------------------------------------------------------
+    # Shutdown
+    # ------------------------------------------------------------------
+
+    def flush(self, timeout=None):
+        """Block until everything queued so far has been written"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._flush_requested = True
+            self._cond.notify_all()
+            while self._queue or self._flushing:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout=30):
+        """Flush everything still queued and stop the writer thread"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        if self.journal is not None:
+            # Anything still journaled stays on disk and is replayed on next start
+            self.journal.close()
+        atexit.unregister(self.close)
+
+    def __len__(self):
+        return len(self._queue)
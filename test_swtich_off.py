@@ -1,25 +1,26 @@
 #!/usr/bin/env python3
 """
 Send switch off command to all bulb IPs. This uses my IP addresses, update to use your known bulb IPs.
+
+All bulbs are switched at once, so the whole run takes about one round-trip
+(plus a retransmission for any lost packet, or the timeout for bulbs that do
+not answer) however many IPs are listed.
 """
 
 import socket
 import json
+from sengled_udp_transport import get_transport
 
 def send_switch_command(ip, switch_value):
     """Send switch command to bulb"""
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(3)
-        
         command = {"func": "set_device_switch", "param": {"switch": switch_value}}
         message = json.dumps(command).encode('utf-8')
         
         print(f"Sending to {ip}: {command}")
-        sock.sendto(message, (ip, 9080))
         
         try:
-            response, addr = sock.recvfrom(1024)
+            response = get_transport().request_sync(ip, message)
             response_text = response.decode('utf-8', errors='ignore')
             print(f"✅ {ip}: {response_text}")
             return True, response_text
@@ -30,8 +31,6 @@ def send_switch_command(ip, switch_value):
     except Exception as e:
         print(f"❌ {ip}: Error - {e}")
         return False, str(e)
-    finally:
-        sock.close()
 
 def main():
     bulb_ips = [
@@ -46,11 +45,22 @@ def main():
     print("Port: 9080 UDP")
     print()
     
-    results = {}
+    command = {"func": "set_device_switch", "param": {"switch": 0}}
+    outcomes = get_transport().fan_out_sync(
+        [(ip, ip, command) for ip in bulb_ips])
     
+    results = {}
     for ip in bulb_ips:
-        success, response = send_switch_command(ip, 0)
-        results[ip] = (success, response)
+        response, latency = outcomes[ip]
+        if isinstance(response, socket.timeout):
+            print(f"❌ {ip}: No response (timeout)")
+            results[ip] = (False, "timeout")
+        elif isinstance(response, Exception):
+            print(f"❌ {ip}: Error - {response}")
+            results[ip] = (False, str(response))
+        else:
+            print(f"✅ {ip}: {json.dumps(response)} ({latency * 1000:.1f} ms)")
+            results[ip] = (True, json.dumps(response))
     
     print(f"\n📊 RESULTS SUMMARY")
     print("=" * 20)